@@ -0,0 +1,21 @@
+import argparse
+import modules
+
+if __name__ == "__main__":
+    # 创建命令行参数解析器
+    parser = argparse.ArgumentParser(description='扫描/拆分/运行/合并各阶段的基准测试(合成FVCOM输出与ptraj替身)')
+    parser.add_argument('--workdir', type=str, default='output/benchmark', help='工作目录 (默认: output/benchmark)')
+    parser.add_argument('--config', type=str, default='configuration/config.toml', help='配置模板 (默认: configuration/config.toml)')
+    parser.add_argument('--files', type=int, nargs='+', default=[10], help='合成FVCOM输出的文件数,可多个 (如: 10 1000 10000)')
+    parser.add_argument('--records', type=int, default=24, help='每个文件的时次数(时间步长1小时) (默认: 24)')
+    parser.add_argument('--nodes', type=int, default=10000, help='合成网格的节点数 (默认: 10000)')
+    parser.add_argument('--particles', type=int, nargs='+', default=[1000, 100000], help='粒子数,可多个 (如: 1000 100000 10000000)')
+    parser.add_argument('--shards', type=int, nargs='+', default=[10, 100], help='子算例数,可多个 (如: 10 100 1000)')
+    parser.add_argument('--hours', type=int, default=24, help='追踪时长(小时) (默认: 24)')
+    parser.add_argument('--rate', type=float, default=50.0, help='ptraj替身的模拟速度(模拟小时/秒),0为不等待 (默认: 50)')
+    parser.add_argument('--keep', action='store_true', help='保留各场景的运行目录')
+
+    # 解析命令行参数
+    args = parser.parse_args()
+    benchmark = modules.PipelineBenchmark(args.workdir, args.config, args.records, args.nodes, args.hours, args.rate, args.keep)
+    benchmark.run(args.files, args.particles, args.shards)
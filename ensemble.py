@@ -0,0 +1,24 @@
+import argparse
+import modules
+from datetime import datetime
+
+if __name__ == "__main__":
+    # 创建命令行参数解析器
+    parser = argparse.ArgumentParser(description='FVCOM离线拉格朗日追踪/追溯集合试验(风拖曳系数/旋转角/释放时间)')
+    parser.add_argument('--config', type=str, default='configuration/config.toml', help='基础配置文件路径,默认: configuration/config.toml')
+    parser.add_argument('--dragc', type=float, nargs='+', default=None, help='风拖曳系数列表 (默认: 使用配置文件)')
+    parser.add_argument('--rotation_angle', type=float, nargs='+', default=None, help='旋转角列表 (默认: 使用配置文件)')
+    parser.add_argument('--starttimes', type=str, nargs='+', default=None, help='释放时间列表,格式: "2025-05-29 06:00:00" (默认: 使用配置文件)')
+    parser.add_argument('--hours', type=float, default=None, help='追踪时长(小时),负值为追溯 (默认: 使用配置文件)')
+
+    # 解析命令行参数
+    args = parser.parse_args()
+    grid = {}
+    if args.dragc is not None:
+        grid['Dragc'] = args.dragc
+    if args.rotation_angle is not None:
+        grid['ROTATE_ANGLE'] = args.rotation_angle
+    if args.starttimes is not None:
+        grid['StartTime'] = [datetime.strptime(starttime, '%Y-%m-%d %H:%M:%S') for starttime in args.starttimes]
+
+    modules.LagrangianEnsemble(args.config, grid, args.hours).run()
@@ -4,7 +4,6 @@ import os
 import pathlib
 import shutil
 import modules
-from datetime import datetime,timedelta
 
 if __name__ == "__main__":
     # 创建命令行参数解析器
@@ -21,6 +20,11 @@ if __name__ == "__main__":
     parser.add_argument('--rotation_angle', type=str, default='0.000', help='旋转角')
     parser.add_argument('--cart_shp', type=str, default='F', help='坐标系统,T为投影坐标,F为球(经纬度)坐标 (默认:F)')
     parser.add_argument('--threads', type=str, default='100', help='线程数量,分为多少个子任务运行')
+    parser.add_argument('--workers', type=str, default=None, help='同时运行的ptraj进程数 (默认: 使用配置文件, 0为可用CPU数)')
+    parser.add_argument('--engine', type=str, default=None, help='追踪引擎,ptraj或numpy (默认: 使用配置文件)')
+    resume = parser.add_mutually_exclusive_group()
+    resume.add_argument('--resume', dest='resume', action='store_const', const=True, default=None, help='配置与输入未变化时由检查点续算 (默认: 使用配置文件General.Resume)')
+    resume.add_argument('--force', dest='resume', action='store_const', const=False, help='忽略检查点,重新运行全部子算例')
 
     # 解析命令行参数
     args = parser.parse_args()
@@ -47,66 +51,13 @@ if __name__ == "__main__":
     # 写入配置文件
     with open(configfile, 'r', encoding='utf-8') as fin:
         data = toml.load(fin)
-        # 计算运算时间
-        endtime = datetime.strptime(args.endtime, '%Y-%m-%d %H:%M:%S')
-        starttime = datetime.strptime(args.starttime, '%Y-%m-%d %H:%M:%S')
-        time_run = (endtime-starttime).total_seconds()//3600
-        # 判断是否异常
-        if starttime == endtime:
-            logger.error('开始结束时间相等，请重新输入')
-            raise RuntimeError
-        if netcdf_data.start_time <= starttime <= netcdf_data.end_time and netcdf_data.start_time <= endtime <= netcdf_data.end_time:   # 正常情况
-            # 判断追踪/追溯
-            if starttime > endtime:
-                inverse = True
-                time_run *= -1
-                logger.info('开始时间:{}, 追溯时长:{}小时'.format(starttime,time_run))
-            else:
-                inverse = False
-                logger.info('开始时间:{}, 追踪时长:{}小时'.format(starttime,time_run))
-            data['Lagrangian']['TimeIntegration']['DTI'] = float(netcdf_data.time_step/20)
-            data['Lagrangian']['TimeIntegration']['INSTP'] = int(netcdf_data.time_step)
-            data['Lagrangian']['TimeIntegration']['TDRIFT'] = int(time_run*(3600/data['Lagrangian']['TimeIntegration']['INSTP']))   # 赋值追踪/追溯时长
-            data['Lagrangian']['General']['CaseName'] = args.casename
-            if inverse:
-                data['Lagrangian']['General']['Inverse'] = True
-            else:
-                data['Lagrangian']['General']['Inverse'] = False
-            data['Lagrangian']['StartTime']['YEARLAG'] = starttime.strftime('%Y')
-            data['Lagrangian']['StartTime']['MONTHLAG'] = starttime.strftime('%m')
-            data['Lagrangian']['StartTime']['DAYLAG'] = starttime.strftime('%d')
-            data['Lagrangian']['StartTime']['HOURLAG'] = starttime.strftime('%H')
-            data['Lagrangian']['IOLocation']['GEOAREA'] = args.geoarea
-            data['Lagrangian']['IOLocation']['LAGINI'] = args.lagini
-            if args.cart_shp == 'F':
-                data['Lagrangian']['ProjectionControl']['CART_SHP'] = False
-            elif args.cart_shp == 'T':
-                data['Lagrangian']['ProjectionControl']['CART_SHP'] = True
-            else:
-                logger.error('坐标系选择T/F错误')
-                raise ValueError
-            try:
-                data['Lagrangian']['General']['Dragc'] = float(args.dragc)
-            except ValueError:
-                logger.error('风拖曳系数设置错误')
-            fin.close()
-            try:
-                data['Lagrangian']['General']['ROTATE_ANGLE'] = float(args.rotation_angle)
-            except ValueError:
-                logger.error('旋转角设置错误')
-            fin.close()
-            try:
-                data['General']['Threads'] = int(args.threads)
-            except ValueError:
-                logger.error('线程数设置错误')
+    if args.resume is not None:
+        data['General']['Resume'] = args.resume
+    modules.LagrangianTracking.configure_run(data, vars(args), netcdf_data, logger)
+    with open(configfile, 'w', encoding='utf-8') as fout:
+        toml.dump(data, fout)
 
-            with open(configfile, 'w', encoding='utf-8') as fout:
-                toml.dump(data, fout)
-
-            # 读取并写入离线拉格朗日粒子追踪namelist
-            logger.info('开始 - 写入粒子追踪namelist并编译运行')
-            modules.LagrangianTracking.LagrangianTracking_FVCOMOffline(configfile)
-            logger.info('结束 - 写入粒子追踪namelist并编译运行')
-        else:
-            logger.error('您输入的时间不在指定目录下输出文件的时间范围内')
-            raise RuntimeError
\ No newline at end of file
+    # 读取并写入离线拉格朗日粒子追踪namelist
+    logger.info('开始 - 写入粒子追踪namelist并编译运行')
+    modules.LagrangianTracking.LagrangianTracking_FVCOMOffline(configfile, netcdf_data=netcdf_data)     # 沿用已扫描的时间索引
+    logger.info('结束 - 写入粒子追踪namelist并编译运行')
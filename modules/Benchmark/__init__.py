@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import itertools
+import toml
+import numpy as np
+import netCDF4 as nc
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from ..Log import AppLogger
+from ..Telemetry import peak_rss
+from ..FVCOMnetCDFReader import FVCOMResultProcessor
+from ..LagrangianTracking import LagrangianTracking_FVCOMOffline
+
+MJD_EPOCH = datetime(1858, 11, 17)  # FVCOM time变量的起点
+STUB_PTRAJ = '''#!{python}
+# 基准测试用的ptraj替身: 读取namelist与粒子文件,按设定速度输出进度行并写出轨迹文件
+import os
+import sys
+import time
+import numpy as np
+import netCDF4 as nc
+
+case = sys.argv[1]
+namelist = {{}}
+with open(case+'_run.dat', 'r') as fin:
+    for line in fin:
+        if '=' in line:
+            key, value = line.split('=', 1)
+            namelist[key.strip()] = value.strip().strip("'")
+hours = max(1, int(round(float(namelist['TDRIFT'])*float(namelist['INSTP'])/3600)))
+rate = float(os.environ.get('PTRAJ_STUB_RATE', {rate}))    # 模拟小时/秒, 0为不等待
+particles = np.loadtxt(os.path.join(namelist['INPDIR'], namelist['LAGINI']+'.dat'), skiprows=1, usecols=(1, 2, 3), ndmin=2)
+num_particles = particles.shape[0]
+dtout = max(1, int(round(float(namelist['DTOUT']))))
+os.makedirs(namelist['OUTDIR'], exist_ok=True)
+with nc.Dataset(os.path.join(namelist['OUTDIR'], case+'_lag.nc'), 'w') as fout:
+    fout.createDimension('time', None)
+    fout.createDimension('nlag', num_particles)
+    fout.createVariable('time', 'f4', ('time',)).units = 'hours'
+    for name in ('x', 'y', 'z'):
+        fout.createVariable(name, 'f4', ('time', 'nlag'))
+    started = time.monotonic()
+    for hour in range(hours+1):
+        if hour % dtout == 0:
+            i_out = hour//dtout
+            fout.variables['time'][i_out] = hour
+            fout.variables['x'][i_out, :] = particles[:, 0] + 1e-3*hour
+            fout.variables['y'][i_out, :] = particles[:, 1]
+            fout.variables['z'][i_out, :] = particles[:, 2]
+        if hour == 0:
+            continue
+        if rate > 0:
+            time.sleep(max(0.0, started + hour/rate - time.monotonic()))
+        print('{{:8d}} / {{:8d}} finished (hours)'.format(hour, hours), flush=True)
+'''
+
+def generate_archive(directory: str, num_files: int, records: int, nodes: int = 10000, start: datetime = datetime(2025, 1, 1),
+                     time_step: float = 3600.0, name: str = 'bench', siglay: int = 2):
+    """
+    生成FVCOM输出格式的合成文件: Times字符变量、time、lon/lat/lonc/latc/x/y/xc/yc/h、nv、静态网格系数a1u/a2u/aw0/awx/awy、
+    随时间旋转的u/v与omega
+
+    Parameters:
+    directory (str): 输出目录,已生成(存在.complete)时直接返回
+    num_files (int): 文件数
+    records (int): 每个文件的时次数
+    nodes (int): 网格节点数(近似,规则三角网格)
+    start (datetime): 第一个时次
+    time_step (float): 时间步长(秒)
+    name (str): 文件名前缀
+    siglay (int): sigma层数
+
+    Returns:
+    dict: 网格范围与时间范围
+    """
+    side = max(2, int(round(math.sqrt(nodes))))
+    info = {'directory': directory, 'num_files': num_files, 'records': records, 'nodes': side*side, 'elements': 2*(side-1)**2,
+            'bounds': [120.0, 33.0, 121.0, 34.0], 'start': start.isoformat(), 'time_step': time_step,
+            'end': (start + timedelta(seconds=time_step*(num_files*records-1))).isoformat()}
+    marker = os.path.join(directory, '.complete')
+    if os.path.exists(marker):
+        return info
+    os.makedirs(directory, exist_ok=True)
+    lon, lat = (grid.ravel() for grid in np.meshgrid(np.linspace(120.0, 121.0, side), np.linspace(33.0, 34.0, side)))
+    corner = (np.arange(side-1)[None, :] + side*np.arange(side-1)[:, None]).ravel()
+    nv = np.concatenate([np.stack([corner, corner+1, corner+side+1]), np.stack([corner, corner+side+1, corner+side])], axis=1) + 1
+    lonc = lon[nv-1].mean(axis=0)
+    latc = lat[nv-1].mean(axis=0)
+    # 绕区域中心旋转、强度随时间变化的流场(用于velocity计算量估计)
+    radius_x, radius_y = lonc - 120.5, latc - 33.5
+    for i_file in range(num_files):
+        times = [start + timedelta(seconds=time_step*(i_file*records + i)) for i in range(records)]
+        path = os.path.join(directory, f"{name}_{i_file+1:05d}.nc")
+        with nc.Dataset(path+'.tmp', 'w', format='NETCDF4') as dst:
+            dst.createDimension('time', None)
+            dst.createDimension('DateStrLen', 26)
+            dst.createDimension('node', lon.size)
+            dst.createDimension('nele', lonc.size)
+            dst.createDimension('three', 3)
+            dst.createDimension('siglay', siglay)
+            dst.createDimension('siglev', siglay+1)
+            dst.createDimension('four', 4)
+            dst.source = 'FVCOM synthetic benchmark archive'
+            strings = np.array([t.strftime('%Y-%m-%dT%H:%M:%S.%f') for t in times], dtype='S26')
+            dst.createVariable('Times', 'S1', ('time', 'DateStrLen'))[:] = strings.view('S1').reshape(records, 26)
+            mjd = dst.createVariable('time', 'f4', ('time',))
+            mjd.units = 'days since 1858-11-17 00:00:00'
+            mjd[:] = [(t - MJD_EPOCH).total_seconds()/86400.0 for t in times]
+            for var_name, values, dim in (('lon', lon, 'node'), ('lat', lat, 'node'), ('lonc', lonc, 'nele'), ('latc', latc, 'nele'),
+                                          ('x', (lon-120.0)*1e5, 'node'), ('y', (lat-33.0)*1e5, 'node'),
+                                          ('xc', (lonc-120.0)*1e5, 'nele'), ('yc', (latc-33.0)*1e5, 'nele'), ('h', 20.0+10.0*(lon-120.0), 'node')):
+                dst.createVariable(var_name, 'f4', (dim,))[:] = values
+            dst.createVariable('nv', 'i4', ('three', 'nele'))[:] = nv
+            for var_name, dims in (('a1u', ('four', 'nele')), ('a2u', ('four', 'nele')), ('aw0', ('three', 'nele')),
+                                   ('awx', ('three', 'nele')), ('awy', ('three', 'nele'))):
+                dst.createVariable(var_name, 'f4', dims)[:] = 1.0/3 if var_name == 'aw0' else 0.0     # 数值不参与ptraj替身计算
+            phase = 1.0 + 0.5*np.sin(2*np.pi*np.arange(i_file*records, (i_file+1)*records)/12.42)[:, None, None]
+            depth = np.linspace(1.0, 0.5, siglay)[None, :, None]
+            dst.createVariable('u', 'f4', ('time', 'siglay', 'nele'))[:] = -radius_y[None, None, :]*phase*depth
+            dst.createVariable('v', 'f4', ('time', 'siglay', 'nele'))[:] = radius_x[None, None, :]*phase*depth
+            dst.createVariable('omega', 'f4', ('time', 'siglev', 'node'))[:] = 0.0
+        os.replace(path+'.tmp', path)
+    with open(marker, 'w') as fout:
+        json.dump(info, fout)
+    return info
+
+def generate_particles(path: str, num_particles: int, bounds: list, seed: int = 0):
+    """
+    生成particles.dat(首行为粒子数,每行: 编号 x y z),约1%的粒子位于网格外
+
+    Parameters:
+    path (str): 文件路径,已存在时直接返回
+    num_particles (int): 粒子数
+    bounds (list): 网格范围 [xmin, ymin, xmax, ymax]
+    seed (int): 随机数种子
+    """
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    pad = 0.005*(xmax-xmin)
+    chunk = 1000000
+    with open(path+'.tmp', 'w') as fout:
+        fout.write(str(num_particles)+'\n')
+        for begin in range(0, num_particles, chunk):
+            count = min(chunk, num_particles-begin)
+            rows = np.empty((count, 3))
+            rows[:, 0] = np.arange(begin+1, begin+count+1)
+            rows[:, 1] = rng.uniform(xmin-pad, xmax+pad, count)
+            rows[:, 2] = rng.uniform(ymin-pad, ymax+pad, count)
+            fout.write(('%d %.6f %.6f 0.000\n'*count) % tuple(rows.ravel()))
+    os.replace(path+'.tmp', path)
+    return path
+
+def write_stub_ptraj(path: str, rate: float = 50.0):
+    """
+    写入ptraj替身(可执行的Python脚本): 读取 {case}_run.dat 与粒子文件,
+    每模拟1小时输出一行 'N / M finished (hours)'(速度为rate模拟小时/秒,可由环境变量PTRAJ_STUB_RATE覆盖),
+    并在OUTDIR写出 {case}_lag.nc
+
+    Returns:
+    str: 可执行文件路径
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as fout:
+        fout.write(STUB_PTRAJ.format(python=sys.executable, rate=float(rate)))
+    os.chmod(path, 0o755)
+    return path
+
+def stage_scan(configfile: str):
+    """扫描FVCOM输出(建立时间索引)"""
+    processor = FVCOMResultProcessor(configfile)
+    return {'records': int(sum(entry['total_timesteps'] for entry in processor.time_index.sorted_entries()))}
+
+def stage_split(configfile: str, executable: str):
+    """写入namelist、定位并拆分粒子、新建检查点"""
+    tracker = LagrangianTracking_FVCOMOffline(configfile, run=False)
+    return {'shards': len(tracker.plan(executable))}
+
+def stage_run(configfile: str, executable: str):
+    """运行检查点中的全部子算例"""
+    tracker = LagrangianTracking_FVCOMOffline(configfile, run=False)
+    tracker.executable = executable
+    tracker.num_shards = len(tracker.load_manifest()['shards'])
+    results = tracker.lag_run(tracker.shard_tasks(), check=False)
+    return {'workers': tracker.worker_count(), 'failed': sum(result['status'] != 'done' for result in results),
+            'children_peak_rss': max([result['peak_rss'] or 0 for result in results], default=0)}
+
+def stage_output(configfile: str):
+    """合并各子算例输出"""
+    tracker = LagrangianTracking_FVCOMOffline(configfile, run=False)
+    tracker.num_shards = len(tracker.load_manifest()['shards'])
+    output = tracker.merge_outputs()
+    return {'output_bytes': os.path.getsize(output) if output else 0}
+
+def measure(function, *args):
+    """
+    在子进程中运行一个阶段并测量耗时与峰值内存(子进程为新进程,峰值内存不受其他阶段影响)
+
+    峰值内存取VmHWM而非ru_maxrss: 后者在fork/exec后保留父进程的峰值
+
+    Returns:
+    dict: seconds, baseline_rss(导入模块后的常驻内存), peak_rss(本进程峰值), 及阶段返回的信息(lag_run含ptraj的最大峰值children_peak_rss)
+    """
+    baseline = peak_rss(os.getpid())
+    started = time.perf_counter()
+    info = function(*args) or {}
+    seconds = time.perf_counter() - started
+    return dict({'children_peak_rss': 0}, **info, seconds=seconds, baseline_rss=baseline, peak_rss=peak_rss(os.getpid()))
+
+class PipelineBenchmark: # 扫描/拆分/运行/合并各阶段的耗时与峰值内存基准测试(合成FVCOM输出 + ptraj替身)
+    def __init__(self, workdir: str, template: str = 'configuration/config.toml', records: int = 24, nodes: int = 10000,
+                 hours: int = 24, rate: float = 50.0, keep: bool = False):
+        """
+        :param workdir: 工作目录(合成输出、粒子文件、各场景的运行目录与报告)
+        :param template: 配置模板,路径与时间相关的项由基准测试覆盖
+        :param records: 每个合成文件的时次数(时间步长1小时)
+        :param nodes: 合成网格的节点数
+        :param hours: 追踪时长(小时)
+        :param rate: ptraj替身的模拟速度(模拟小时/秒)
+        :param keep: 是否保留各场景的运行目录
+        """
+        self.workdir = os.path.abspath(workdir)
+        os.makedirs(self.workdir, exist_ok=True)
+        self.template = toml.load(template)
+        self.records = records
+        self.nodes = nodes
+        self.hours = hours
+        self.keep = keep
+        self.logfile = os.path.join(self.workdir, 'benchmark.log')
+        self.logger = AppLogger('Benchmark', 'INFO', self.logfile)
+        self.executable = write_stub_ptraj(os.path.join(self.workdir, 'bin', 'ptraj'), rate)
+        self.results = []
+
+    def write_config(self, archive: dict, run_dir: str, shards: int):
+        """由模板生成场景的配置文件"""
+        data = toml.loads(toml.dumps(self.template))
+        start = datetime.fromisoformat(archive['start'])
+        time_step = archive['time_step']
+        data['General'].update(Threads=shards, Resume=False, Retries=0)
+        data['Log'].update(Level='INFO', File=self.logfile)
+        data['FVCOMOutputDirectory'].update(Directory=archive['directory'], IndexFile='')
+        data.setdefault('Cache', {})['Directory'] = os.path.join(archive['directory'], 'cache')
+        data.setdefault('Telemetry', {})['PrometheusFile'] = ''
+        data.setdefault('Cluster', {})['Backend'] = 'none'
+        lagrangian = data['Lagrangian']
+        lagrangian['General'].update(Directory=run_dir, CaseName='bench', Inverse=False, Engine='ptraj')
+        lagrangian['TimeIntegration'].update(DTI=time_step/20, INSTP=int(time_step), DTOUT=1.0, TDRIFT=int(self.hours*3600/time_step))
+        lagrangian['StartTime'].update(YEARLAG=start.strftime('%Y'), MONTHLAG=start.strftime('%m'), DAYLAG=start.strftime('%d'),
+                                       HOURLAG=start.strftime('%H'))
+        lagrangian['ProjectionControl']['CART_SHP'] = False
+        lagrangian.setdefault('Merge', {})['Enabled'] = True
+        configfile = os.path.join(run_dir, 'config.toml')
+        with open(configfile, 'w', encoding='utf-8') as fout:
+            toml.dump(data, fout)
+        return configfile
+
+    def record(self, scenario: dict, stage: str, measured: dict):
+        """记录并输出一个阶段的结果"""
+        row = dict(scenario, stage=stage, **measured)
+        self.results.append(row)
+        self.logger.info('{:>6} 文件 {:>9} 粒子 {:>5} 子算例 | {:<11} {:9.2f} 秒, 峰值内存 {:8.1f} MB (基线 {:.1f} MB, 子进程 {:.1f} MB)'.format(
+            scenario['files'], scenario.get('particles', '-'), scenario.get('shards', '-'), stage, measured['seconds'],
+            (measured['peak_rss'] or 0)/2**20, (measured['baseline_rss'] or 0)/2**20, measured['children_peak_rss']/2**20))
+        return row
+
+    def run(self, files: list, particles: list, shards: list):
+        """
+        运行全部场景: 每种文件数生成一次合成输出并测量冷/热扫描,每种(粒子数, 子算例数)测量拆分、运行与合并
+
+        Returns:
+        str: JSON报告路径
+        """
+        context = multiprocessing.get_context('spawn')
+        for num_files in files:
+            span = num_files*self.records
+            if span <= self.hours:
+                self.logger.error(f"{num_files}个文件共{span}小时,不足追踪时长{self.hours}小时")
+                raise ValueError
+            self.logger.info(f"开始 - 生成合成FVCOM输出: {num_files}个文件 x {self.records}个时次, 约{self.nodes}个节点")
+            started = time.perf_counter()
+            archive = generate_archive(os.path.join(self.workdir, f"archive_{num_files}x{self.records}_{self.nodes}"),
+                                       num_files, self.records, self.nodes)
+            self.logger.info(f"结束 - 生成合成FVCOM输出, 耗时 {time.perf_counter()-started:.1f} 秒")
+            cache = os.path.join(archive['directory'], 'cache')
+            shutil.rmtree(cache, ignore_errors=True)     # 冷扫描: 删除时间索引与网格缓存
+            scan_dir = os.path.join(self.workdir, 'scan')
+            os.makedirs(scan_dir, exist_ok=True)
+            scan_config = self.write_config(archive, scan_dir, 1)
+            for stage in ('scan', 'scan_cached'):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    self.record({'files': num_files}, stage, pool.submit(measure, stage_scan, scan_config).result())
+
+            for num_particles, num_shards in itertools.product(particles, shards):
+                scenario = {'files': num_files, 'particles': num_particles, 'shards': num_shards}
+                run_dir = os.path.join(self.workdir, f"run_{num_files}_{num_particles}_{num_shards}")
+                shutil.rmtree(run_dir, ignore_errors=True)
+                inpdir = os.path.join(run_dir, self.template['Lagrangian']['IOLocation']['INPDIR'])
+                os.makedirs(inpdir)
+                os.makedirs(os.path.join(run_dir, self.template['Lagrangian']['IOLocation']['OUTDIR']))
+                os.symlink(generate_particles(os.path.join(self.workdir, f"particles_{num_particles}.dat"), num_particles,
+                                              archive['bounds']), os.path.join(inpdir, 'particles.dat'))
+                configfile = self.write_config(archive, run_dir, num_shards)
+                for stage, function, args in (('split', stage_split, (configfile, self.executable)),
+                                              ('lag_run', stage_run, (configfile, self.executable)),
+                                              ('output', stage_output, (configfile,))):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        self.record(scenario, stage, pool.submit(measure, function, *args).result())
+                if not self.keep:
+                    shutil.rmtree(run_dir, ignore_errors=True)
+        report = os.path.join(self.workdir, 'benchmark_{}.json'.format(datetime.now().strftime('%Y%m%d%H%M%S')))
+        with open(report, 'w', encoding='utf-8') as fout:
+            json.dump({'records': self.records, 'nodes': self.nodes, 'hours': self.hours, 'results': self.results},
+                      fout, ensure_ascii=False, indent=2)
+        self.logger.info(f"基准测试报告已写入: {report}")
+        return report
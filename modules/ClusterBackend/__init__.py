@@ -0,0 +1,221 @@
+import os
+import re
+import abc
+import math
+import time
+import shutil
+import subprocess
+
+class ClusterBackend(abc.ABC): # 集群后端: 将子算例打包为作业数组脚本,提交后收集各子算例的返回值
+    name = None
+
+    def __init__(self, tracker, settings: dict):
+        """
+        :param tracker: LagrangianTracking_FVCOMOffline实例(提供日志、算例名、运行目录与检查点)
+        :param settings: 配置文件的Cluster节
+        """
+        self.tracker = tracker
+        self.logger = tracker.logger
+        self.settings = settings
+        self.array_dir = os.path.join(tracker.directory, '{}_array'.format(tracker.casename))
+        self.status_dir = os.path.join(self.array_dir, 'status')
+        self.log_dir = os.path.join(self.array_dir, 'log')
+
+    def shards_per_node(self, num_tasks: int):
+        """每个数组任务(一个节点)打包的子算例数,不超过节点核数"""
+        return max(1, min(int(self.settings.get('CoresPerNode', 1)), num_tasks))
+
+    @staticmethod
+    def task_key(task: dict):
+        """status与日志文件名: 集合试验各成员的子算例同名,加上成员标识"""
+        return '{}_{}'.format(task['member'], task['case']) if task.get('member') else task['case']
+
+    def pack(self, tasks: list):
+        """
+        将子算例按顺序每shards_per_node个打包为一个数组任务,写入 {array_dir}/{数组序号}.txt(每行: 运行目录\\t可执行文件\\t算例名\\tstatus文件名)
+
+        Returns:
+        int: 数组任务数
+        """
+        per_node = self.shards_per_node(len(tasks))
+        for directory in (self.array_dir, self.status_dir, self.log_dir):
+            os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(self.array_dir):     # 清理上次的打包列表
+            if name.endswith('.txt'):
+                os.remove(os.path.join(self.array_dir, name))
+        num_jobs = math.ceil(len(tasks)/per_node)
+        for job in range(num_jobs):
+            with open(os.path.join(self.array_dir, '{}.txt'.format(job)), 'w') as fout:
+                for task in tasks[job*per_node:(job+1)*per_node]:
+                    fout.write('{}\t{}\t{}\t{}\n'.format(os.path.abspath(task['cwd']), os.path.abspath(task['executable']), task['case'],
+                                                        self.task_key(task)))
+                    status_file = os.path.join(self.status_dir, self.task_key(task)+'.status')
+                    if os.path.exists(status_file):
+                        os.remove(status_file)
+        self.logger.info('{}个子算例打包为{}个数组任务,每个节点{}个'.format(len(tasks), num_jobs, per_node))
+        return num_jobs
+
+    def write_script(self, num_jobs: int, per_node: int):
+        """
+        写入SLURM作业数组脚本: 每个数组任务读取自身的打包列表,在节点内并行运行各子算例,
+        并将返回值与耗时写入 status/{算例名}.status
+
+        Returns:
+        str: 脚本路径
+        """
+        settings = self.settings
+        max_nodes = int(settings.get('MaxConcurrentNodes', 0))
+        array = '0-{}'.format(num_jobs-1) + ('%{}'.format(max_nodes) if max_nodes > 0 else '')
+        lines = [
+            '#!/bin/bash',
+            '#SBATCH --job-name={}'.format(self.tracker.casename),
+            '#SBATCH --partition={}'.format(settings.get('Partition', 'cpu')),
+            '#SBATCH --array={}'.format(array),
+            '#SBATCH --nodes=1',
+            '#SBATCH --ntasks={}'.format(per_node),
+            '#SBATCH --cpus-per-task=1',
+            '#SBATCH --time={}'.format(settings.get('TimeLimit', '144:00:00')),
+            '#SBATCH --output={}/%A_%a.log'.format(self.log_dir),
+            '#SBATCH --error={}/%A_%a.error'.format(self.log_dir),
+            '',
+        ]
+        if settings.get('ModulePath', ''):
+            lines.append('module use {}'.format(settings['ModulePath']))
+        if settings.get('Modules', []):
+            lines.append('module purge')
+            lines.extend('module load {}'.format(module) for module in settings['Modules'])
+        lines += [
+            '',
+            '# 本地执行器将PTRAJ_LAUNCHER设为空,直接运行ptraj',
+            'LAUNCHER=${PTRAJ_LAUNCHER-"srun --exclusive -N1 -n1 -c1"}',
+            'while IFS=$\'\\t\' read -r DIR EXE CASE KEY; do',
+            '    (',
+            '        cd "$DIR" || exit 1',
+            '        START=$(date +%s)',
+            '        $LAUNCHER "$EXE" "$CASE" < /dev/null > "{}/$KEY.log" 2>&1'.format(self.log_dir),
+            '        RC=$?',
+            '        echo "$RC $(( $(date +%s) - START ))" > "{}/$KEY.status"'.format(self.status_dir),
+            '    ) &',
+            'done < "{}/${{SLURM_ARRAY_TASK_ID}}.txt"'.format(self.array_dir),
+            'wait',
+        ]
+        script = os.path.join(self.array_dir, '{}_array.sh'.format(self.tracker.casename))
+        with open(script, 'w') as fout:
+            fout.write('\n'.join(lines)+'\n')
+        os.chmod(script, 0o755)
+        self.logger.info('作业数组脚本已写入: {}'.format(script))
+        return script
+
+    @abc.abstractmethod
+    def submit(self, script: str, num_jobs: int):
+        """提交作业数组; waits为真时阻塞至数组结束(各后端必须实现)"""
+
+    @staticmethod
+    def status_current(task: dict, status_file: str):
+        """status文件晚于子算例的namelist(重新拆分时重写),即属于本次拆分"""
+        namelist = os.path.join(task['cwd'], task['case']+'_run.dat')
+        return os.path.exists(status_file) and (not os.path.exists(namelist) or os.path.getmtime(status_file) >= os.path.getmtime(namelist))
+
+    def collect(self, tasks: list, finished_only: bool = False):
+        """
+        读取各子算例的status文件,并以与run_tasks相同的格式更新检查点; 没有status文件的子算例(节点被抢占等)视为失败
+
+        Parameters:
+        tasks (list): 子算例任务
+        finished_only (bool): 只收集已有status文件的子算例(用于收集此前未等待结束的作业)
+
+        Returns:
+        list: 各子算例的运行结果
+        """
+        results = []
+        for task in tasks:
+            status_file = os.path.join(self.status_dir, self.task_key(task)+'.status')
+            returncode, seconds = None, None
+            if finished_only and not self.status_current(task, status_file):
+                continue
+            if os.path.exists(status_file):
+                with open(status_file, 'r') as fin:
+                    fields = fin.read().split()
+                returncode, seconds = int(fields[0]), float(fields[1])
+            result = dict(task, returncode=returncode, status='done' if returncode == 0 else 'failed', attempts=1,
+                          seconds=seconds, peak_rss=None)
+            self.tracker.record_result(result)
+            results.append(result)
+        return results
+
+    def collect_finished(self, tasks: list):
+        """
+        收集此前提交(如未等待结束)且已成功结束的子算例
+
+        Returns:
+        tuple: (已完成子算例的结果, 仍需运行的子算例任务)
+        """
+        finished = [result for result in self.collect(tasks, finished_only=True) if result['status'] == 'done']
+        if finished:
+            self.logger.info('收集到{}个此前已完成的子算例'.format(len(finished)))
+        done = {self.task_key(result) for result in finished}
+        return finished, [task for task in tasks if self.task_key(task) not in done]
+
+    @property
+    def waits(self):
+        """submit是否阻塞至作业数组结束"""
+        return True
+
+    def run(self, tasks: list):
+        """
+        收集此前已结束的子算例,将其余子算例打包、写入脚本、提交并收集结果
+
+        Returns:
+        list: 各子算例的运行结果,提交后未等待结束时为None(结果在下次运行时由status文件收集)
+        """
+        finished, tasks = self.collect_finished(tasks)
+        if not tasks:
+            return finished
+        num_jobs = self.pack(tasks)
+        self.submit(self.write_script(num_jobs, self.shards_per_node(len(tasks))), num_jobs)
+        if not self.waits:
+            return None
+        return finished + self.collect(tasks)
+
+class SlurmBackend(ClusterBackend): # 通过sbatch提交作业数组
+    name = 'slurm'
+
+    def submit(self, script: str, num_jobs: int):
+        command = ['sbatch', '--parsable']
+        if self.waits:
+            command.append('--wait')    # 阻塞至整个数组结束,之后收集结果并合并输出
+        command.append(script)
+        self.logger.info('提交作业数组: {}'.format(' '.join(command)))
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        job_id = process.stdout.readline().strip()
+        self.logger.info('作业号: {}'.format(job_id))
+        output = process.stdout.read()
+        process.wait()
+        # --wait时数组中有任务失败也会返回非0,以status文件为准
+        if not re.match(r'^\d+', job_id):
+            self.logger.error('sbatch提交失败: {} {}'.format(job_id, output))
+            raise RuntimeError
+        if not self.waits:
+            self.logger.info('未等待作业结束,作业完成后再次运行即可跳过已完成的子算例并合并输出')
+
+    @property
+    def waits(self):
+        return bool(self.settings.get('Wait', True))
+
+class LocalBackend(ClusterBackend): # 在本机按数组序号依次执行同一脚本,用于在没有SLURM的环境中测试提交流程
+    name = 'local'
+
+    def shards_per_node(self, num_tasks: int):
+        return max(1, min(int(self.settings.get('CoresPerNode', 1)), self.tracker.worker_count(), num_tasks))
+
+    def submit(self, script: str, num_jobs: int):
+        environment = dict(os.environ, PTRAJ_LAUNCHER='', SLURM_ARRAY_JOB_ID='local')
+        for job in range(num_jobs):
+            environment['SLURM_ARRAY_TASK_ID'] = str(job)
+            started = time.monotonic()
+            with open(os.path.join(self.log_dir, 'local_{}.log'.format(job)), 'w') as fout:
+                returncode = subprocess.call([shutil.which('bash') or '/bin/bash', script], env=environment,
+                                             stdout=fout, stderr=subprocess.STDOUT)
+            self.logger.info('数组任务 {}/{} 结束, 返回值 {}, 耗时 {:.1f} 秒'.format(job+1, num_jobs, returncode, time.monotonic()-started))
+
+BACKENDS = {backend.name: backend for backend in (SlurmBackend, LocalBackend)}
@@ -0,0 +1,188 @@
+import toml
+import os
+import copy
+import json
+import itertools
+from datetime import datetime, timedelta
+from ..Log import AppLogger
+from ..FVCOMnetCDFReader import FVCOMResultProcessor
+from ..LagrangianTracking import LagrangianTracking_FVCOMOffline
+from ..ParticleTracker import NumPyParticleTracker
+
+class LagrangianEnsemble:   # 风拖曳系数/旋转角/释放时间的集合(敏感性)试验
+    def __init__(self, configfile: str, grid: dict, hours: float = None):
+        """
+        初始化集合试验
+
+        Parameters:
+        configfile (str): 基础配置文件路径,各成员在其基础上修改
+        grid (dict): 参数网格,键为 'Dragc'、'ROTATE_ANGLE'、'StartTime'(datetime),值为取值列表; 缺省的键使用基础配置中的值
+        hours (float): 追踪时长(小时),负值为追溯; 为None时使用基础配置中的TDRIFT与Inverse
+        """
+        self.configpath = configfile
+        self.configfile = toml.load(configfile)
+        self.logger = AppLogger.from_config('LagrangianEnsemble', self.configfile)
+        general = self.configfile['Lagrangian']['General']
+        start = self.configfile['Lagrangian']['StartTime']
+        self.directory = general['Directory']
+        self.casename = general['CaseName']
+        self.inpdir = self.configfile['Lagrangian']['IOLocation']['INPDIR']
+        self.outdir = self.configfile['Lagrangian']['IOLocation']['OUTDIR']
+        self.engine = general.get('Engine', 'ptraj')
+        self.hours = hours
+        self.grid = {
+            'Dragc': [float(value) for value in grid.get('Dragc', [general['Dragc']])],
+            'ROTATE_ANGLE': [float(value) for value in grid.get('ROTATE_ANGLE', [general['ROTATE_ANGLE']])],
+            'StartTime': list(grid.get('StartTime', [datetime(int(start['YEARLAG']), int(start['MONTHLAG']), int(start['DAYLAG']), int(start['HOURLAG']))])),
+        }
+        self.root = os.path.join(self.directory, 'ensemble', self.casename)
+        self.executables = {}   # (追溯, 投影坐标) -> 已编译的ptraj,各成员共用
+
+        # FVCOM输出只扫描一次,所有成员共用
+        self.logger.info('开始 - 读取指定目录下netCDF文件')
+        self.netcdf_data = FVCOMResultProcessor(configfile)
+        self.logger.info('结束 - 读取指定目录下netCDF文件')
+
+    def members(self):
+        """
+        展开参数网格
+
+        Returns:
+        list: 成员列表,每个成员包含 tag(标识), Dragc, ROTATE_ANGLE, StartTime
+        """
+        members = []
+        for dragc, angle, starttime in itertools.product(self.grid['Dragc'], self.grid['ROTATE_ANGLE'], self.grid['StartTime']):
+            members.append({
+                'tag': 'dragc{:g}_rot{:g}_{}'.format(dragc, angle, starttime.strftime('%Y%m%d%H')),
+                'Dragc': dragc,
+                'ROTATE_ANGLE': angle,
+                'StartTime': starttime,
+            })
+        return members
+
+    def setup_member(self, member: dict):
+        """
+        建立成员的独立工作目录: 自身的配置文件与namelist、指向基础INPDIR文件的链接、独立的OUTDIR
+
+        Returns:
+        str: 成员配置文件路径
+        """
+        directory = os.path.join(self.root, member['tag'])
+        inpdir = os.path.join(directory, self.inpdir)
+        os.makedirs(inpdir, exist_ok=True)
+        os.makedirs(os.path.join(directory, self.outdir), exist_ok=True)
+        # 链接基础INPDIR中的FVCOM输出与粒子文件,拆分生成的子算例文件各成员独立
+        base_inpdir = os.path.abspath(os.path.join(self.directory, self.inpdir))
+        for name in os.listdir(base_inpdir):
+            if name.startswith(self.casename+'_') or name.startswith('pbs'):
+                continue
+            link = os.path.join(inpdir, name)
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(base_inpdir, name), link)
+
+        data = copy.deepcopy(self.configfile)
+        starttime = member['StartTime']
+        data['Lagrangian']['General']['Directory'] = directory
+        data['Lagrangian']['General']['Dragc'] = member['Dragc']
+        data['Lagrangian']['General']['ROTATE_ANGLE'] = member['ROTATE_ANGLE']
+        data['Lagrangian']['StartTime']['YEARLAG'] = starttime.strftime('%Y')
+        data['Lagrangian']['StartTime']['MONTHLAG'] = starttime.strftime('%m')
+        data['Lagrangian']['StartTime']['DAYLAG'] = starttime.strftime('%d')
+        data['Lagrangian']['StartTime']['HOURLAG'] = starttime.strftime('%H')
+        if self.hours is not None:
+            data['Lagrangian']['TimeIntegration']['DTI'] = float(self.netcdf_data.time_step/20)
+            data['Lagrangian']['TimeIntegration']['INSTP'] = int(self.netcdf_data.time_step)
+            data['Lagrangian']['TimeIntegration']['TDRIFT'] = int(abs(self.hours)*(3600/data['Lagrangian']['TimeIntegration']['INSTP']))
+            data['Lagrangian']['General']['Inverse'] = self.hours < 0
+        self.check_time_range(member, data)
+
+        configfile = os.path.join(directory, 'config.toml')
+        with open(configfile, 'w', encoding='utf-8') as fout:
+            toml.dump(data, fout)
+        return configfile
+
+    def setup_supervisor(self):
+        """
+        集合层的运行对象: 以集合目录为Directory,所有成员的子算例由它统一监控,
+        遥测快照与作业数组脚本写入集合目录而不是某个成员的目录; 检查点与耗时仍按子算例的运行目录写入各成员
+
+        Returns:
+        LagrangianTracking_FVCOMOffline: 不运行追踪的追踪对象
+        """
+        data = copy.deepcopy(self.configfile)
+        data['Lagrangian']['General']['Directory'] = self.root
+        os.makedirs(self.root, exist_ok=True)
+        configfile = os.path.join(self.root, 'config.toml')
+        with open(configfile, 'w', encoding='utf-8') as fout:
+            toml.dump(data, fout)
+        return LagrangianTracking_FVCOMOffline(configfile, run=False, netcdf_data=self.netcdf_data)
+
+    def check_time_range(self, member: dict, data: dict):
+        """检查成员的起止时间是否在FVCOM输出时间范围内"""
+        integration = data['Lagrangian']['TimeIntegration']
+        duration = timedelta(seconds=float(integration['TDRIFT'])*float(integration['INSTP']))
+        starttime = member['StartTime']
+        endtime = starttime - duration if data['Lagrangian']['General']['Inverse'] else starttime + duration
+        for time in (starttime, endtime):
+            if not self.netcdf_data.start_time <= time <= self.netcdf_data.end_time:
+                self.logger.error('成员{}的时间{}不在输出文件的时间范围内({} - {})'.format(
+                    member['tag'], time, self.netcdf_data.start_time, self.netcdf_data.end_time))
+                raise RuntimeError
+
+    def run(self):
+        """
+        运行全部成员: ptraj按(追溯, 坐标系)模式只编译一次,所有成员的子算例在同一个有限并发进程池中运行
+
+        Returns:
+        list: 成员运行结果
+        """
+        members = self.members()
+        self.logger.info('集合试验共{}个成员,目录: {}'.format(len(members), self.root))
+        results = []
+        if self.engine == 'numpy':          # 进程内追踪,成员依次运行
+            for member in members:
+                configfile = self.setup_member(member)
+                self.logger.info('开始 - 成员{}'.format(member['tag']))
+                output = NumPyParticleTracker(configfile, self.netcdf_data).run()
+                results.append(dict(member, config=configfile, output=output))
+            return self.write_summary(results)
+
+        tasks = []
+        trackers = {}
+        for member in members:
+            configfile = self.setup_member(member)
+            tracker = trackers[member['tag']] = LagrangianTracking_FVCOMOffline(configfile, run=False, netcdf_data=self.netcdf_data)
+            mode = (bool(tracker.inverse), bool(tracker.cart_shp))
+            member_tasks = tracker.plan(self.executables.get(mode))
+            self.executables[mode] = tracker.executable
+            for task in member_tasks:
+                task['idx'] = len(tasks)    # 全局唯一的进度序号
+                task['member'] = member['tag']
+                tasks.append(task)
+            results.append(dict(member, config=configfile, output=os.path.join(tracker.directory, tracker.outdir), shards=[]))
+
+        shard_results = self.setup_supervisor().lag_run(tasks, check=False)
+        if shard_results is None:       # 作业数组已提交但未等待结束,完成后再次运行以收集并合并
+            return self.write_summary(results)
+        for result in shard_results:
+            member = next(item for item in results if item['tag'] == result['member'])
+            member['shards'].append({'case': result['case'], 'returncode': result['returncode'], 'status': result['status'],
+                                     'attempts': result['attempts'], 'seconds': result['seconds'], 'peak_rss': result['peak_rss']})
+        # 各成员分别合并子算例输出
+        for member in results:
+            tracker = trackers[member['tag']]
+            if tracker.merge.get('Enabled', True):
+                member['merged'] = tracker.merge_outputs()
+                if member['merged'] is not None:
+                    member.update(tracker.postprocess(member['merged']))
+        return self.write_summary(results)
+
+    def write_summary(self, results: list):
+        """将按成员标记的结果写入集合目录下的ensemble.json"""
+        summary = os.path.join(self.root, 'ensemble.json')
+        os.makedirs(self.root, exist_ok=True)
+        with open(summary, 'w', encoding='utf-8') as fout:
+            json.dump([dict(result, StartTime=result['StartTime'].strftime('%Y-%m-%d %H:%M:%S')) for result in results],
+                      fout, ensure_ascii=False, indent=2)
+        self.logger.info('集合试验结果已写入: {}'.format(summary))
+        return results
@@ -1,72 +1,771 @@
 import toml
 import os
 import glob
+import json
+import fcntl
+import contextlib
+import hashlib
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import netCDF4 as nc
 import numpy as np
 from datetime import datetime, timedelta
 import pathlib
 from ..Log import AppLogger
 
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'     # 索引文件中时间的存储格式
+
+def get_cache_directory(configfile: dict):
+    """
+    获取缓存目录(时间索引等旁路文件存放位置)
+
+    Parameters:
+    configfile (dict): 已读取的配置
+
+    Returns:
+    str: 缓存目录,不存在时自动创建
+    """
+    cache_dir = configfile.get('Cache', {}).get('Directory', 'output/cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def mesh_hash(lon: np.ndarray, lat: np.ndarray, nv: np.ndarray):
+    """
+    计算网格哈希,用于缓存文件(投影网格、空间索引等)的命名与校验
+
+    Parameters:
+    lon (np.ndarray): 节点经度(或x)
+    lat (np.ndarray): 节点纬度(或y)
+    nv (np.ndarray): 单元节点编号
+
+    Returns:
+    str: sha1十六进制字符串
+    """
+    digest = hashlib.sha1()
+    for array, dtype in ((lon, np.float64), (lat, np.float64), (nv, np.int64)):
+        array = np.ascontiguousarray(array, dtype=dtype)
+        digest.update(str(array.shape).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+class FVCOMTimeError(RuntimeError): # FVCOM输出时间不连续/非单调,附带具体的缺失区间
+    def __init__(self, message: str, gaps=None, irregular=None):
+        """
+        Parameters:
+        message (str): 错误信息
+        gaps (list): 缺失区间 [(缺失开始, 缺失结束, 缺失步数), ...]
+        irregular (list): 非递增或间隔异常的相邻时间 [(前一时间, 后一时间), ...]
+        """
+        super().__init__(message)
+        self.gaps = gaps or []
+        self.irregular = irregular or []
+
+def to_datetime(value):
+    """numpy.datetime64 转换为 datetime"""
+    return np.datetime64(value, 'us').astype(datetime)
+
+def decode_times(time_data):
+    """
+    批量解码FVCOM的Times变量
+
+    Parameters:
+    time_data (np.ndarray): (时间, DateStrLen)的字符数组,或已拼接的字符串数组
+
+    Returns:
+    np.ndarray: datetime64[us]数组
+    """
+    raw = np.asarray(time_data)
+    if raw.ndim == 2:       # 字符数组按行视为定长字符串,无需逐字符拼接
+        raw = np.ascontiguousarray(raw).view('{}{}'.format(raw.dtype.kind, raw.shape[1])).ravel()
+    if raw.dtype.kind == 'S':
+        raw = np.char.decode(raw, 'ascii')
+    return np.char.strip(raw).astype('datetime64[us]')
+
+def infer_time_step(times: np.ndarray):
+    """
+    由相邻时间差的众数推断时间步长
+
+    Parameters:
+    times (np.ndarray): datetime64数组
+
+    Returns:
+    np.timedelta64: 时间步长,记录不足两个时为None
+    """
+    diffs = np.diff(times)
+    diffs = diffs[diffs > np.timedelta64(0)]
+    if diffs.size == 0:
+        return None
+    values, counts = np.unique(diffs, return_counts=True)
+    return values[np.argmax(counts)]
+
+def find_time_gaps(starts: np.ndarray, ends: np.ndarray, time_step: np.timedelta64):
+    """
+    检查相邻记录之间的缺失区间与异常间隔(向量化)
+
+    Parameters:
+    starts (np.ndarray): 每段之前的时间(单文件检查时为 times[:-1])
+    ends (np.ndarray): 每段之后的时间(单文件检查时为 times[1:])
+    time_step (np.timedelta64): 时间步长
+
+    Returns:
+    tuple: (gaps, irregular) gaps为[(缺失开始, 缺失结束, 缺失步数)], irregular为[(前一时间, 后一时间)]
+    """
+    diffs = ends - starts
+    is_irregular = (diffs <= np.timedelta64(0)) | (diffs % time_step != np.timedelta64(0))
+    i_gaps = np.flatnonzero((diffs > time_step) & ~is_irregular)
+    i_irregular = np.flatnonzero(is_irregular)
+    gaps = [(to_datetime(starts[i]+time_step), to_datetime(ends[i]-time_step), int(diffs[i]//time_step)-1) for i in i_gaps]
+    irregular = [(to_datetime(starts[i]), to_datetime(ends[i])) for i in i_irregular]
+    return gaps, irregular
+
+class FVCOMTimeIndex: # FVCOM输出文件时间索引,文件未变化时直接复用,新增文件才扫描
+    VERSION = 1
+
+    def __init__(self, index_file: str, logger):
+        """
+        初始化时间索引
+
+        Parameters:
+        index_file (str): 索引旁路文件路径(json)
+        logger: 日志记录器
+        """
+        self.index_file = index_file
+        self.logger = logger
+        self.entries = {}       # 文件路径 -> 文件时间信息
+        self.load()
+
+    def load(self):
+        """读取索引文件,版本不符或损坏时重新建立"""
+        if not os.path.exists(self.index_file):
+            self.logger.info('时间索引不存在,将新建: {}'.format(self.index_file))
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            self.logger.warning('时间索引读取失败,将重新建立: {}'.format(self.index_file))
+            return
+        if data.get('version') != self.VERSION:
+            self.logger.info('时间索引版本不符,将重新建立: {}'.format(self.index_file))
+            return
+        for entry in data['files']:
+            entry['start_time'] = datetime.strptime(entry['start_time'], TIME_FORMAT)
+            entry['end_time'] = datetime.strptime(entry['end_time'], TIME_FORMAT)
+            self.entries[entry['path']] = entry
+
+    def save(self):
+        """写入索引文件(先写临时文件再替换,避免并发读取到不完整文件)"""
+        files = []
+        for entry in self.sorted_entries():
+            record = dict(entry)
+            record['start_time'] = entry['start_time'].strftime(TIME_FORMAT)
+            record['end_time'] = entry['end_time'].strftime(TIME_FORMAT)
+            files.append(record)
+        tmp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as fout:
+                json.dump({'version': self.VERSION, 'files': files}, fout, ensure_ascii=False, indent=1)
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            self.logger.warning('时间索引写入失败: {}'.format(self.index_file))
+
+    def is_current(self, path: str, stat: os.stat_result):
+        """判断索引中的记录是否仍与文件一致(大小与修改时间)"""
+        entry = self.entries.get(path)
+        return entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+
+    def update(self, files: list, scanner):
+        """
+        根据文件列表更新索引,仅扫描新增或发生变化的文件
+
+        Parameters:
+        files (list): 当前目录下的全部文件
+        scanner (callable): 扫描单个文件的函数,返回时间信息字典
+
+        Returns:
+        int: 重新扫描的文件数量
+        """
+        changed = False
+        for path in set(self.entries) - set(files):     # 删除已不存在的文件
+            self.logger.info('{} 已不存在,从时间索引中移除'.format(path))
+            del self.entries[path]
+            changed = True
+        scanned = 0
+        for path in files:
+            stat = os.stat(path)
+            if self.is_current(path, stat):
+                continue
+            time_info = scanner(path)
+            self.entries[path] = {
+                'path': path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'start_time': time_info['start_time'],
+                'end_time': time_info['end_time'],
+                'total_timesteps': time_info['total_timesteps'],
+                'time_step': time_info['time_step'],
+            }
+            scanned += 1
+            changed = True
+        if changed:
+            self.save()
+        return scanned
+
+    def sorted_entries(self):
+        """按文件名排序的索引记录"""
+        return [self.entries[path] for path in sorted(self.entries)]
+
+def harmonize_file(path: str, renames: dict, static_names: list, grid_file: str = None, lock_dir: str = None):
+    """
+    检查(grid_file给定时并修复)单个FVCOM输出中ptraj所需的变量: 在本进程或工作进程中运行
+
+    修复只通过NetCDF API原地进行: 改名不复制数据; 缺少的静态网格系数(a1u等)从共用的网格文件追加;
+    检查时对文件加共享锁、修复时加排他锁(fcntl)并在加锁后重新检查,同时运行的多个追踪不会重复修改同一文件,
+    也不会读取正在修复的文件
+
+    Parameters:
+    path (str): FVCOM输出文件
+    renames (dict): 旧变量名 -> ptraj使用的变量名(如 wts -> omega)
+    static_names (list): 不随时间变化、每个文件都须包含的变量
+    grid_file (str): 共用网格文件,为None时只检查
+    lock_dir (str): 锁文件目录(缓存目录),为None时不加锁
+
+    Returns:
+    dict: path, size, mtime, data_model, renames(待改名), missing(缺少且无法修复), actions(已执行的修复)
+    """
+    def inspect():
+        with nc.Dataset(path, 'r') as dataset:
+            names = set(dataset.variables)
+            data_model = dataset.data_model
+        pending = [(old, new) for old, new in renames.items() if old in names and new not in names]
+        absent = [new for old, new in renames.items() if old not in names and new not in names]
+        missing = [name for name in static_names if name not in names]
+        return data_model, pending, absent, missing
+
+    with file_lock(path, lock_dir, fcntl.LOCK_SH):
+        data_model, pending, absent, missing = inspect()
+    actions = []
+    if grid_file is not None and (pending or missing):
+        with file_lock(path, lock_dir, fcntl.LOCK_EX):
+            # 等待锁期间可能已被另一个进程修复
+            data_model, pending, absent, missing = inspect()
+            if pending or missing:
+                actions = repair_file(path, pending, missing, grid_file)
+                pending = []
+    stat = os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'data_model': data_model,
+            'renames': pending, 'missing': missing + absent, 'actions': actions}
+
+@contextlib.contextmanager
+def file_lock(path: str, lock_dir: str, operation: int):
+    """
+    对FVCOM输出加锁(fcntl.LOCK_SH或LOCK_EX): 锁文件放在lock_dir,不能锁文件本身(HDF5打开文件时也会加锁)
+
+    Parameters:
+    path (str): 加锁的文件
+    lock_dir (str): 锁文件目录,为None时不加锁
+    operation (int): fcntl.LOCK_SH或fcntl.LOCK_EX
+    """
+    if lock_dir is None:
+        yield
+        return
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file = os.path.join(lock_dir, hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16] + '.lock')
+    with open(lock_file, 'a') as lock:
+        fcntl.flock(lock, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def repair_file(path: str, pending: list, missing: list, grid_file: str):
+    """
+    原地改名并从共用网格文件追加缺少的静态变量(调用方已对文件加锁)
+
+    Parameters:
+    path (str): FVCOM输出文件
+    pending (list): 待改名的(旧变量名, 新变量名)
+    missing (list): 缺少的静态变量,追加成功的从中移除
+    grid_file (str): 共用网格文件
+
+    Returns:
+    list: 已执行的修复
+    """
+    actions = []
+    with nc.Dataset(path, 'a') as dataset:
+        for old, new in pending:
+            dataset.renameVariable(old, new)
+            actions.append('rename {} -> {}'.format(old, new))
+        if missing and os.path.exists(grid_file):
+            with nc.Dataset(grid_file, 'r') as grid:
+                grid.set_auto_mask(False)
+                for name in [name for name in missing if name in grid.variables]:
+                    var = grid.variables[name]
+                    for dim in var.dimensions:
+                        size = len(grid.dimensions[dim])
+                        if dim not in dataset.dimensions:
+                            dataset.createDimension(dim, size)
+                        elif len(dataset.dimensions[dim]) != size:
+                            raise ValueError('{}的维度{}长度为{},与网格文件的{}不符'.format(path, dim, len(dataset.dimensions[dim]), size))
+                    fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                    out = dataset.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+                    out.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs() if attr != '_FillValue'})
+                    out[...] = var[...]
+                    actions.append('append {}'.format(name))
+                    missing.remove(name)
+    return actions
+
+class FVCOMVariableHarmonizer: # 扫描时检查并原地修复ptraj所需变量的缺失/命名,已处理的文件记入台账不再重复
+    VERSION = 1
+
+    def __init__(self, ledger_file: str, grid_file: str, logger, renames: dict = None, static_names: list = None,
+                 mode: str = 'check', workers: int = 1):
+        """
+        :param ledger_file: 台账文件(json),记录各文件(大小与修改时间)的检查/修复结果
+        :param grid_file: 共用网格文件,保存从含有静态网格系数的文件中复制的变量
+        :param logger: 日志记录器
+        :param renames: 旧变量名 -> ptraj使用的变量名
+        :param static_names: 每个文件都须包含的静态变量
+        :param mode: 'check'只检查并报告, 'inplace'原地修复
+        :param workers: 并行检查/修复的进程数
+        """
+        self.ledger_file = ledger_file
+        self.grid_file = grid_file
+        self.logger = logger
+        self.renames = dict(renames or {})
+        self.static_names = list(static_names or [])
+        self.mode = mode
+        self.workers = max(1, int(workers))
+        self.lock_dir = os.path.join(os.path.dirname(os.path.abspath(grid_file)), 'locks')    # 各文件的检查/修复锁
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        """读取台账,版本不符或损坏时重新检查全部文件"""
+        if not os.path.exists(self.ledger_file):
+            return
+        try:
+            with open(self.ledger_file, 'r', encoding='utf-8') as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            self.logger.warning('变量台账读取失败,将重新检查: {}'.format(self.ledger_file))
+            return
+        if data.get('version') == self.VERSION and data.get('settings') == self.settings_key():
+            self.entries = {entry['path']: entry for entry in data['files']}
+
+    def save(self):
+        """写入台账(先写临时文件再替换)"""
+        tmp_file = '{}.{}.tmp'.format(self.ledger_file, os.getpid())
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as fout:
+                json.dump({'version': self.VERSION, 'settings': self.settings_key(),
+                           'files': [self.entries[path] for path in sorted(self.entries)]}, fout, ensure_ascii=False, indent=1)
+            os.replace(tmp_file, self.ledger_file)
+        except OSError:
+            self.logger.warning('变量台账写入失败: {}'.format(self.ledger_file))
+
+    def settings_key(self):
+        """台账对应的设置,改名表或静态变量变化时重新检查"""
+        return {'renames': self.renames, 'static_names': self.static_names, 'mode': self.mode}
+
+    def is_current(self, path: str):
+        """台账中的记录仍与文件一致(大小与修改时间)"""
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        stat = os.stat(path)
+        return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+
+    def process(self, files: list, grid_file: str = None):
+        """并行检查(grid_file给定时并修复)一组文件"""
+        if not files:
+            return []
+        if self.workers == 1 or len(files) == 1:
+            return [harmonize_file(path, self.renames, self.static_names, grid_file, self.lock_dir) for path in files]
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(files))) as pool:
+            return list(pool.map(harmonize_file, files, itertools.repeat(self.renames), itertools.repeat(self.static_names),
+                                 itertools.repeat(grid_file), itertools.repeat(self.lock_dir), chunksize=max(1, len(files)//(4*self.workers))))
+
+    def build_grid_file(self, files: list):
+        """
+        从按时间顺序第一个含有各静态变量的文件中复制这些变量到共用网格文件(已包含全部静态变量时不再建立)
+
+        Returns:
+        list: 所有文件中都没有的静态变量
+        """
+        if os.path.exists(self.grid_file):
+            with nc.Dataset(self.grid_file, 'r') as grid:
+                if all(name in grid.variables for name in self.static_names):
+                    return []
+        remaining = list(self.static_names)
+        tmp_file = '{}.{}.tmp'.format(self.grid_file, os.getpid())
+        with nc.Dataset(tmp_file, 'w', format='NETCDF4') as grid:
+            for path in files:
+                if not remaining:
+                    break
+                with nc.Dataset(path, 'r') as src:
+                    src.set_auto_mask(False)
+                    for name in [name for name in remaining if name in src.variables]:
+                        var = src.variables[name]
+                        for dim in var.dimensions:
+                            if dim not in grid.dimensions:
+                                grid.createDimension(dim, len(src.dimensions[dim]))
+                        fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                        out = grid.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+                        out.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs() if attr != '_FillValue'})
+                        out[...] = var[...]
+                        out.setncattr('source_file', path)
+                        remaining.remove(name)
+        if len(remaining) == len(self.static_names):
+            os.remove(tmp_file)
+        else:
+            os.replace(tmp_file, self.grid_file)
+            self.logger.info('共用网格文件已写入: {}'.format(self.grid_file))
+        return remaining
+
+    def run(self, files: list):
+        """
+        检查新增或变化的文件; mode为'inplace'时原地改名并追加缺少的静态变量
+
+        Returns:
+        dict: 文件路径 -> 台账记录
+        """
+        pending = [path for path in files if not self.is_current(path)]
+        for path in set(self.entries) - set(files):
+            del self.entries[path]
+        if pending:
+            self.logger.info('检查{}个文件的变量(共{}个, {}个进程)'.format(len(pending), len(files), self.workers))
+            results = self.process(pending)
+            statics = set(self.static_names)
+            if self.mode == 'inplace' and any(result['renames'] or set(result['missing']) & statics for result in results):
+                if any(set(result['missing']) & statics for result in results):
+                    unavailable = self.build_grid_file(files)
+                    if unavailable:
+                        self.logger.warning('所有文件中都没有静态变量{},无法补齐'.format(unavailable))
+                        statics -= set(unavailable)
+                broken = [result['path'] for result in results if result['renames'] or set(result['missing']) & statics]
+            else:
+                broken = []
+            if broken:
+                classic = [result['path'] for result in results if result['path'] in broken and result['data_model'].startswith('NETCDF3')]
+                if classic:
+                    self.logger.warning('{}个文件为NetCDF3格式,改名或追加变量可能重写整个文件(如{})'.format(len(classic), classic[0]))
+                self.logger.info('原地修复{}个文件'.format(len(broken)))
+                fixed = {result['path']: result for result in self.process(broken, self.grid_file)}
+                results = [fixed.get(result['path'], result) for result in results]
+                for result in fixed.values():
+                    self.logger.debug('{}: {}'.format(result['path'], ', '.join(result['actions'])))
+            for result in results:
+                self.entries[result['path']] = result
+            self.save()
+        self.report(files)
+        return self.entries
+
+    def report(self, files: list):
+        """汇总仍需改名或缺少变量的文件"""
+        renames = [path for path in files if self.entries[path]['renames']]
+        missing = [path for path in files if self.entries[path]['missing']]
+        if renames:
+            self.logger.warning('{}个文件的变量需要改名{}(如{}),设置FVCOMOutputDirectory.Harmonize = "inplace"可自动处理'.format(
+                len(renames), self.entries[renames[0]]['renames'], renames[0]))
+        if missing:
+            self.logger.warning('{}个文件缺少ptraj所需变量{}(如{})'.format(len(missing), self.entries[missing[0]]['missing'], missing[0]))
+
+class FVCOMMultiFileDataset: # 全部FVCOM输出文件组成的只读虚拟数据集,按需打开文件、按时间窗读取
+    def __init__(self, entries: list, time_step: float, max_open_files: int = 8, logger=None):
+        """
+        初始化虚拟数据集(不打开任何文件)
+
+        Parameters:
+        entries (list): 时间索引记录(按时间顺序),需包含path与total_timesteps
+        time_step (float): 时间步长(秒)
+        max_open_files (int): 同时保持打开的文件句柄上限(LRU)
+        logger: 日志记录器
+        """
+        self.files = [entry['path'] for entry in entries]
+        counts = np.array([entry['total_timesteps'] for entry in entries], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))     # 每个文件首个时次的全局索引
+        self.total_timesteps = int(self.offsets[-1])
+        self.file_of_index = np.repeat(np.arange(len(self.files), dtype=np.int32), counts)   # 全局索引 -> 文件,O(1)查找
+        self.start_time = np.datetime64(entries[0]['start_time'], 'us')
+        self.time_step = np.timedelta64(int(round(time_step*1e6)), 'us')
+        self.max_open_files = max(1, int(max_open_files))
+        self.logger = logger
+        self.handles = OrderedDict()    # 文件序号 -> 打开的Dataset
+        self.static_cache = {}          # 不随时间变化的变量(网格等)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.total_timesteps
+
+    @property
+    def end_time(self):
+        return self.start_time + (self.total_timesteps-1)*self.time_step
+
+    def time_to_index(self, time, method: str = 'exact'):
+        """
+        时间 -> 全局时间索引,时间等间隔因此为O(1)
+
+        Parameters:
+        time (datetime | np.datetime64): 时间
+        method (str): 'exact' 必须恰好落在时次上, 'floor' 取不晚于该时间的时次, 'nearest' 取最近时次
+
+        Returns:
+        int: 全局时间索引
+        """
+        offset = np.datetime64(time, 'us') - self.start_time
+        if method == 'exact':
+            if offset % self.time_step != np.timedelta64(0):
+                raise ValueError('{} 不在FVCOM输出时次上'.format(time))
+            index = offset // self.time_step
+        elif method == 'floor':
+            index = offset // self.time_step
+        elif method == 'nearest':
+            index = int(np.rint(offset/self.time_step))
+        else:
+            raise ValueError('未知的时间匹配方式: {}'.format(method))
+        index = int(index)
+        if not 0 <= index < self.total_timesteps:
+            raise IndexError('{} 超出FVCOM输出时间范围 {} 至 {}'.format(time, self.start_time, self.end_time))
+        return index
+
+    def index_to_time(self, index):
+        """全局时间索引 -> datetime64"""
+        return self.start_time + np.asarray(index)*self.time_step
+
+    def locate(self, index: int):
+        """
+        全局时间索引 -> (文件路径, 文件内索引)
+
+        Parameters:
+        index (int): 全局时间索引,支持负数
+
+        Returns:
+        tuple: (文件路径, 文件内索引)
+        """
+        if index < 0:
+            index += self.total_timesteps
+        if not 0 <= index < self.total_timesteps:
+            raise IndexError('时间索引 {} 超出范围 [0, {})'.format(index, self.total_timesteps))
+        i_file = self.file_of_index[index]
+        return self.files[i_file], int(index - self.offsets[i_file])
+
+    def locate_time(self, time, method: str = 'exact'):
+        """时间 -> (文件路径, 文件内索引)"""
+        return self.locate(self.time_to_index(time, method))
+
+    def get_handle(self, i_file: int):
+        """获取文件句柄,超出上限时关闭最久未使用的文件"""
+        handle = self.handles.get(i_file)
+        if handle is not None:
+            self.handles.move_to_end(i_file)
+            return handle
+        while len(self.handles) >= self.max_open_files:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        handle = nc.Dataset(self.files[i_file], 'r')
+        handle.set_auto_mask(False)
+        self.handles[i_file] = handle
+        if self.logger:
+            self.logger.debug('{} 打开(只读)'.format(self.files[i_file]))
+        return handle
+
+    @property
+    def variables(self):
+        """第一个文件中的变量(用于查询维度、属性)"""
+        return self.get_handle(0).variables
+
+    def read_static(self, name: str):
+        """读取不随时间变化的变量(如lon/lat/nv/h),结果缓存"""
+        if name not in self.static_cache:
+            self.static_cache[name] = np.asarray(self.get_handle(0).variables[name][:])
+        return self.static_cache[name]
+
+    def read(self, name: str, start: int, stop: int, *index):
+        """
+        读取时间窗[start, stop)内变量的超块,仅读取所需文件的所需部分
+
+        Parameters:
+        name (str): 变量名(第一维须为时间),如u/v/ww/zeta
+        start (int): 起始全局时间索引
+        stop (int): 终止全局时间索引(不含)
+        index: 其余维度的索引/切片,如 (slice(None), elements)
+
+        Returns:
+        np.ndarray: 沿时间维拼接的数据
+        """
+        start, stop, _ = slice(start, stop).indices(self.total_timesteps)
+        if stop <= start:
+            raise IndexError('时间窗为空: [{}, {})'.format(start, stop))
+        first_file = self.file_of_index[start]
+        last_file = self.file_of_index[stop-1]
+        parts = []
+        for i_file in range(first_file, last_file+1):
+            local_start = max(start, self.offsets[i_file]) - self.offsets[i_file]
+            local_stop = min(stop, self.offsets[i_file+1]) - self.offsets[i_file]
+            variable = self.get_handle(i_file).variables[name]
+            parts.append(np.asarray(variable[(slice(int(local_start), int(local_stop)),) + index]))
+        return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=0)
+
+    def read_time(self, name: str, start_time, end_time, *index):
+        """
+        按时间读取[start_time, end_time](含两端)的超块
+
+        Parameters:
+        name (str): 变量名
+        start_time (datetime | np.datetime64): 起始时间
+        end_time (datetime | np.datetime64): 终止时间
+        index: 其余维度的索引/切片
+
+        Returns:
+        tuple: (datetime64时间数组, 数据)
+        """
+        start = self.time_to_index(start_time, 'floor')
+        stop = self.time_to_index(end_time, 'floor') + 1
+        return self.index_to_time(np.arange(start, stop)), self.read(name, start, stop, *index)
+
+    def close(self):
+        """关闭全部文件句柄"""
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
 class FVCOMResultProcessor: # 用于提取FVCOM输出文件中的时间信息
     def __init__(self, configfile: str):
         """
         初始化类
 
         Parameters:
-        filename (str): FVCOM输出文件的路径
+        configfile (str): 配置文件路径
         """
         self.configfile = toml.load(configfile)
         self.dataset = None
         self.time_var = None
         self.time_info = None
         self.filename = None
-        self.all_times = []
-        self.logger = AppLogger('FVCOM_Reader', self.configfile['Log']['Level'], pathlib.Path(self.configfile['Log']['File']))
+        self.logger = AppLogger.from_config('FVCOM_Reader', self.configfile)
         # 提取FVCOM文件
-        self.fvcom_files = sorted(glob.glob(os.path.join(self.configfile['FVCOMOutputDirectory']['Directory'],'*.nc')))
+        directory = self.configfile['FVCOMOutputDirectory']['Directory']
+        self.fvcom_files = sorted(glob.glob(os.path.join(directory,'*.nc')))
         self.logger.info('Found FVCOM output files: {}'.format(self.fvcom_files))
-        for i_fvcom_file,fvcom_file in enumerate(self.fvcom_files):
-            self.filename = fvcom_file
-            self.open_dataset()
-            self.time_info = self.get_time_info()
-            self.all_times.extend(self.time_info['all_times'])
-            self.logger.info('{} Time info: 开始 {};结束 {}'.format(fvcom_file,self.time_info['start_time'],self.time_info['end_time']))
-            self.close_dataset()
-        self.all_times = np.array(self.all_times)
-        temp = np.array(sorted(self.all_times))
-        if not np.array_equal(self.all_times, temp):
-            self.logger.error('FVCOM 输出文件时间存在问题，请检查')
-            raise RuntimeError
-        i_found = True
-        time_rec = []
-        i_time_rec = []
-        for i_time,time in enumerate(self.all_times):
-            if time.strftime('%M:%S') == '00:00':
-                i_found = not i_found
-                time_rec.append(time)
-                i_time_rec.append(i_time)
-                if i_found:         # 再次为真，即找到两次
-                    self.time_step = (time_rec[1]-time_rec[0]).total_seconds()/(i_time_rec[1]-i_time_rec[0])
-                    break
-        self.start_time = self.all_times[0]
-        self.end_time = self.all_times[-1]
-        self.logger.debug('FVCOM 输出文件的全部时间: {}'.format(self.all_times))
-        # 时间连续性检查
-        full_time = []
-        time_now = self.start_time
-        while time_now <= self.end_time:
-            full_time.append(time_now)
-            time_now += timedelta(seconds=self.time_step)
-        full_time = np.array(full_time)
-        if not np.array_equal(full_time,self.all_times):
-            self.logger.error('FVCOM 输出文件时间不连续,请检查!')
+        directory_hash = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:12]
+        # 检查(并修复)ptraj所需变量,须在时间索引之前: 修复会改变文件的大小与修改时间
+        settings = self.configfile['FVCOMOutputDirectory']
+        harmonize = settings.get('Harmonize', 'off')
+        if harmonize not in ('off', 'check', 'inplace'):
+            self.logger.error('未知的变量检查方式: {}'.format(harmonize))
+            raise ValueError
+        if harmonize != 'off' and self.fvcom_files:
+            cache_dir = get_cache_directory(self.configfile)
+            FVCOMVariableHarmonizer(os.path.join(cache_dir, 'variables_{}.json'.format(directory_hash)),
+                                    os.path.join(cache_dir, 'grid_metrics_{}.nc'.format(directory_hash)), self.logger,
+                                    settings.get('Renames', {}), settings.get('StaticVariables', []), harmonize,
+                                    int(settings.get('HarmonizeWorkers', 1))).run(self.fvcom_files)
+        # 读取时间索引,仅扫描新增/变化的文件
+        index_file = self.configfile['FVCOMOutputDirectory'].get('IndexFile', '')
+        if not index_file:
+            index_file = os.path.join(get_cache_directory(self.configfile), 'time_index_{}.json'.format(directory_hash))
+        self.time_index = FVCOMTimeIndex(index_file, self.logger)
+        scanned = self.time_index.update(self.fvcom_files, self.scan_file)
+        self.logger.info('时间索引: 共{}个文件, 本次扫描{}个'.format(len(self.fvcom_files), scanned))
+        if not self.fvcom_files:
+            self.logger.error('{} 下未找到FVCOM输出文件'.format(directory))
             raise RuntimeError
+        # 基于索引检查时间单调性与连续性,无需打开文件
+        self.check_time_continuity()
         self.logger.info('FVCOM 输出文件的时间: {} 至 {}, 时间步长为{}秒'.format(self.start_time,self.end_time,self.time_step))
 
-    def open_dataset(self):
-            """打开NetCDF数据集"""
+    def scan_file(self, path: str):
+        """
+        扫描单个文件的时间信息,并检查文件内部时间是否等间隔
+
+        Parameters:
+        path (str): FVCOM输出文件路径
+
+        Returns:
+        dict: 时间信息
+        """
+        self.filename = path
+        self.open_dataset()
+        try:
+            time_info = self.get_time_info()
+        finally:
+            self.close_dataset()
+        self.logger.info('{} Time info: 开始 {};结束 {}'.format(path,time_info['start_time'],time_info['end_time']))
+        times = time_info['all_times']
+        time_step = infer_time_step(times)
+        time_info['time_step'] = None
+        if time_step is not None:
+            gaps, irregular = find_time_gaps(times[:-1], times[1:], time_step)
+            self.report_time_problems(gaps, irregular, path)
+            time_info['time_step'] = float(time_step/np.timedelta64(1, 's'))
+        elif times.size > 1:
+            self.report_time_problems([], [(to_datetime(times[0]), to_datetime(times[-1]))], path)
+        return time_info
+
+    def report_time_problems(self, gaps: list, irregular: list, where: str):
+        """
+        记录缺失区间与异常间隔,存在问题时抛出FVCOMTimeError
+
+        Parameters:
+        gaps (list): 缺失区间
+        irregular (list): 非递增或间隔异常的相邻时间
+        where (str): 问题所在位置(文件或文件区间),用于日志
+        """
+        if not gaps and not irregular:
+            return
+        for gap_start, gap_end, gap_count in gaps:
+            self.logger.error('{} 时间不连续: 缺失 {} 至 {} (共{}个时次)'.format(where, gap_start, gap_end, gap_count))
+        for before, after in irregular:
+            self.logger.error('{} 时间非递增或间隔异常: {} -> {}'.format(where, before, after))
+        raise FVCOMTimeError('FVCOM 输出文件时间不连续,请检查! {}'.format(where), gaps, irregular)
+
+    def check_time_continuity(self):
+        """基于时间索引检查文件间的时间单调性与连续性"""
+        entries = self.time_index.sorted_entries()
+        steps = {entry['time_step'] for entry in entries if entry['time_step'] is not None}
+        if len(steps) > 1:
+            self.logger.error('FVCOM 输出文件的时间步长不一致: {}'.format(sorted(steps)))
+            raise FVCOMTimeError('FVCOM 输出文件的时间步长不一致')
+        if not steps:
+            self.logger.error('FVCOM 输出文件时间记录不足,无法确定时间步长')
+            raise FVCOMTimeError('FVCOM 输出文件时间记录不足')
+        self.time_step = steps.pop()
+        # 相邻文件的首尾时间差应恰为一个时间步长
+        starts = np.array([entry['start_time'] for entry in entries], dtype='datetime64[us]')
+        ends = np.array([entry['end_time'] for entry in entries], dtype='datetime64[us]')
+        gaps, irregular = find_time_gaps(ends[:-1], starts[1:], np.timedelta64(int(round(self.time_step*1e6)), 'us'))
+        self.report_time_problems(gaps, irregular, self.configfile['FVCOMOutputDirectory']['Directory'])
+        self.start_time = entries[0]['start_time']
+        self.end_time = entries[-1]['end_time']
+        self.total_timesteps = sum(entry['total_timesteps'] for entry in entries)
+
+    def open_multifile_dataset(self):
+        """
+        基于时间索引建立只读虚拟数据集,供预处理/后处理按时间窗读取变量
+
+        Returns:
+        FVCOMMultiFileDataset: 虚拟数据集
+        """
+        max_open_files = self.configfile['FVCOMOutputDirectory'].get('MaxOpenFiles', 8)
+        return FVCOMMultiFileDataset(self.time_index.sorted_entries(), self.time_step, max_open_files, self.logger)
+
+    @property
+    def all_times(self):
+        """FVCOM 输出文件的全部时间(由索引生成, datetime64[us])"""
+        step = np.timedelta64(int(round(self.time_step*1e6)), 'us')
+        return np.datetime64(self.start_time, 'us') + np.arange(self.total_timesteps)*step
+
+    def open_dataset(self, mode='r'):
+            """打开NetCDF数据集(默认只读,避免修改文件时间戳导致索引失效)"""
             try:
-                self.dataset = nc.Dataset(self.filename, 'r+')
+                self.dataset = nc.Dataset(self.filename, mode)
                 self.logger.info('{} 打开成功'.format(self.filename))
                 self.time_var = 'Times'
             except Exception as e:
@@ -77,6 +776,7 @@ class FVCOMResultProcessor: # 用于提取FVCOM输出文件中的时间信息
         """关闭数据集"""
         if self.dataset:
             self.dataset.close()
+            self.dataset = None
             self.logger.info('{} 读取结束'.format(self.filename))
 
     def get_time_info(self):
@@ -84,24 +784,18 @@ class FVCOMResultProcessor: # 用于提取FVCOM输出文件中的时间信息
         获取时间信息
 
         Returns:
-        dict: 包含时间信息的字典
+        dict: 包含时间信息的字典, all_times为datetime64[us]数组
         """
         if self.dataset is None:
             self.open_dataset()
 
         try:
             time_data = self.dataset.variables[self.time_var][:]
-
-            datetimes = []
-            for i_time in range(len(time_data)):
-                temp = ''
-                for j in range(len(time_data[i_time])):
-                    temp+=time_data[i_time][j].decode('utf-8')
-                datetimes.append(datetime.strptime(temp, '%Y-%m-%dT%H:%M:%S.%f'))
+            datetimes = decode_times(time_data)
 
             # 获取起止时间
-            start_time = datetimes[0]
-            end_time = datetimes[-1]
+            start_time = to_datetime(datetimes[0])
+            end_time = to_datetime(datetimes[-1])
 
             time_info = {
                 'start_time': start_time,
@@ -116,24 +810,79 @@ class FVCOMResultProcessor: # 用于提取FVCOM输出文件中的时间信息
             self.logger.error('Time Variables Read Error'.format(self.filename))
             raise
 
-    def latlon2projection(self):
+    def latlon2projection(self, crs: str = None):
+        """
+        将节点(lat/lon)与单元中心(latc/lonc)坐标整体投影到目标坐标系,
+        结果写入按网格哈希与坐标系区分的缓存网格文件,不修改原始输出文件
+
+        Parameters:
+        crs (str): 目标坐标系,默认取 Lagrangian.ProjectionControl.PROJECTION_REFERENCE
+
+        Returns:
+        str: 缓存网格文件路径(含x/y/xc/yc)
+        """
         from pyproj import Transformer
 
-        transformer = Transformer.from_crs("epsg:4326", "epsg:32630")
+        if crs is None:
+            crs = self.configfile['Lagrangian']['ProjectionControl']['PROJECTION_REFERENCE']
+        with self.open_multifile_dataset() as dataset:
+            lon = dataset.read_static('lon')
+            lat = dataset.read_static('lat')
+            lonc = dataset.read_static('lonc')
+            latc = dataset.read_static('latc')
+            grid_hash = mesh_hash(lon, lat, dataset.read_static('nv'))
+        crs_hash = hashlib.sha1(crs.encode('utf-8')).hexdigest()[:8]
+        grid_file = os.path.join(get_cache_directory(self.configfile), 'grid_{}_{}.nc'.format(grid_hash[:16], crs_hash))
+        if os.path.exists(grid_file):
+            with nc.Dataset(grid_file, 'r') as grid:
+                if grid.getncattr('mesh_hash') == grid_hash and grid.getncattr('crs') == crs:
+                    self.logger.info('使用已缓存的投影网格: {}'.format(grid_file))
+                    return grid_file
+        self.logger.info('开始 - 投影坐标转换({})'.format(crs))
+        transformer = Transformer.from_crs('epsg:4326', crs, always_xy=True)
+        x, y = transformer.transform(lon, lat)
+        xc, yc = transformer.transform(lonc, latc)
+        # 先写临时文件再替换,避免并发任务读到不完整的网格文件
+        tmp_file = '{}.{}.tmp'.format(grid_file, os.getpid())
+        with nc.Dataset(tmp_file, 'w') as grid:
+            grid.createDimension('node', x.size)
+            grid.createDimension('nele', xc.size)
+            grid.setncattr('mesh_hash', grid_hash)
+            grid.setncattr('crs', crs)
+            for name, dim, values in (('x', 'node', x), ('y', 'node', y), ('xc', 'nele', xc), ('yc', 'nele', yc)):
+                variable = grid.createVariable(name, 'f8', (dim,))
+                variable[:] = values
+        os.replace(tmp_file, grid_file)
+        self.logger.info('结束 - 投影坐标转换, 网格文件: {}'.format(grid_file))
+        return grid_file
 
-        # 读取经纬度数据
-        lat = self.dataset.variables['lat'][:]
-        lon = self.dataset.variables['lon'][:]
-        latc = self.dataset.variables['latc'][:]
-        lonc = self.dataset.variables['lonc'][:]
+    def projected_grid(self, crs: str = None):
+        """
+        读取投影后的网格坐标(必要时先生成缓存)
+
+        Returns:
+        dict: x, y, xc, yc 数组
+        """
+        with nc.Dataset(self.latlon2projection(crs), 'r') as grid:
+            return {name: np.asarray(grid.variables[name][:]) for name in ('x', 'y', 'xc', 'yc')}
+
+    def mesh_coordinates(self, cart_shp: bool):
+        """
+        网格定位索引(拆分粒子、NumPy引擎、后处理)使用的节点坐标
+
+        Parameters:
+        cart_shp (bool): 是否为投影坐标
 
-        # 转换坐标并直接覆盖原有变量
-        for i in range(len(lat)):
-            x_temp, y_temp = transformer.transform(lat[i], lon[i])
-            self.dataset.variables['x'][i] = x_temp
-            self.dataset.variables['y'][i] = y_temp
+        Returns:
+        tuple: 投影坐标且PROJECTION_REFERENCE为投影坐标系时为缓存网格文件中的(x, y);
+               经纬度坐标,或PROJECTION_REFERENCE为经纬度(不做投影,输出文件中的x/y即为投影坐标)时为None,由输出文件读取
+        """
+        if not cart_shp:
+            return None
+        from pyproj import CRS
 
-        for i in range(len(latc)):
-            xc_temp, yc_temp = transformer.transform(latc[i], lonc[i])
-            self.dataset.variables['xc'][i] = xc_temp
-            self.dataset.variables['yc'][i] = yc_temp
\ No newline at end of file
+        crs = self.configfile['Lagrangian']['ProjectionControl']['PROJECTION_REFERENCE']
+        if CRS.from_user_input(crs).is_geographic:
+            return None
+        grid = self.projected_grid(crs)
+        return grid['x'], grid['y']
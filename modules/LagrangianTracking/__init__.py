@@ -3,18 +3,200 @@ import os
 import shutil
 import pathlib
 from ..Log import AppLogger
+from ..FVCOMnetCDFReader import FVCOMResultProcessor, get_cache_directory
+from ..MeshIndex import FVCOMMeshIndex
+from ..ParticleTracker import NumPyParticleTracker, read_particle_chunks, RANDOM_WALK_MODES
+from ..TrajectoryOutput import TrajectoryMerger
+from ..Telemetry import RunTelemetry
+from ..ClusterBackend import BACKENDS
+from ..Staging import FVCOMInputStager
+from ..TimeStep import CFLTimeStepSelector
+from ..PostProcessing import TrajectoryPostProcessor
+from ..TrajectoryIndex import TrajectoryIndex
 import subprocess
-import threading
 import re
+import fcntl
+import fnmatch
+import hashlib
+import json
+import time
 import numpy as np
+from datetime import datetime, timedelta
+import asyncio
+import signal
+
+BUILD_ARTIFACTS = ('*.o', '*.mod', '*.a', 'ptraj', 'makefile', '.git')    # 不参与源码哈希、不复制到编译目录的文件
+PARTICLE_CHUNK = 500000     # 拆分粒子时每次读取/写出的粒子数
+WRITE_ROWS = 8192           # 写出子算例粒子文件时每次格式化的行数(字符串约0.3MB)
+PARTICLE_FORMAT = '%3d %10.6f %10.7f 0.000\n'   # 子算例粒子文件的行格式: 编号 x y z
+MANIFEST_VERSION = 1        # 检查点文件格式版本
+SUPERVISOR_TICK = 5.0       # 检查超时与采样内存的间隔(秒),与子进程有无输出无关
+PROGRESS_PATTERN = re.compile(r'\s*(\d+)\s*/\s*(\d+)\s*finished\s*\(hours\)')    # ptraj进度行
+
+def source_tree_hash(sourcepath: str):
+    """
+    计算ptraj源码树的内容哈希(忽略编译产物)
+
+    Parameters:
+    sourcepath (str): 源码目录
+
+    Returns:
+    str: sha1十六进制字符串
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(sourcepath):
+        dirs[:] = sorted(d for d in dirs if not any(fnmatch.fnmatch(d, pattern) for pattern in BUILD_ARTIFACTS))
+        for name in sorted(files):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in BUILD_ARTIFACTS):
+                continue
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, sourcepath).encode('utf-8'))
+            with open(path, 'rb') as fin:
+                digest.update(fin.read())
+    return digest.hexdigest()
+
+def available_memory():
+    """
+    当前可用内存(字节),优先读取/proc/meminfo的MemAvailable
+
+    Returns:
+    int: 可用内存,无法获取时为None
+    """
+    try:
+        with open('/proc/meminfo', 'r') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def cost_bounds(cost: np.ndarray, num_shards: int):
+    """
+    按累计计算量将有序粒子切分为num_shards段,每段计算量之和相近且至少一个粒子
+
+    Parameters:
+    cost (np.ndarray): (n,) 按顺序排列的每个粒子的计算量
+    num_shards (int): 段数
+
+    Returns:
+    np.ndarray: (num_shards+1,) 各段边界
+    """
+    num_particles = cost.size
+    if num_shards <= 0:
+        return np.zeros(1, dtype=np.int64)
+    cumulative = np.cumsum(cost)
+    targets = cumulative[-1]*np.arange(1, num_shards)/num_shards
+    inner = np.searchsorted(cumulative, targets, side='left') + 1
+    # 保证边界严格递增且每段至少一个粒子
+    shift = np.arange(1, num_shards)
+    inner = np.clip(np.maximum.accumulate(inner - shift), 0, num_particles - num_shards) + shift
+    return np.concatenate([[0], inner, [num_particles]]).astype(np.int64)
+
+def configure_run(data: dict, params: dict, netcdf_data: FVCOMResultProcessor, logger):
+    """
+    按main.py的命令行参数修改配置: 起止时间(追踪/追溯与时长)、算例名、网格位置、粒子文件名、风拖曳系数、旋转角、
+    坐标系、子算例数、并发进程数与追踪引擎; 常驻服务的作业使用同一组参数
+
+    Parameters:
+    data (dict): 已读取的配置,原地修改
+    params (dict): 参数,键与main.py的命令行参数相同; starttime与endtime必需(格式 '%Y-%m-%d %H:%M:%S'),其余为None或缺省时保留配置中的值
+    netcdf_data (FVCOMResultProcessor): 已扫描的FVCOM输出,用于检查时间范围与确定INSTP
+    logger: 日志记录器
+
+    Returns:
+    dict: 修改后的配置
+    """
+    # 计算运算时间
+    endtime = datetime.strptime(params['endtime'], '%Y-%m-%d %H:%M:%S')
+    starttime = datetime.strptime(params['starttime'], '%Y-%m-%d %H:%M:%S')
+    time_run = (endtime-starttime).total_seconds()//3600
+    # 判断是否异常
+    if starttime == endtime:
+        logger.error('开始结束时间相等，请重新输入')
+        raise RuntimeError('开始结束时间相等')
+    if not (netcdf_data.start_time <= starttime <= netcdf_data.end_time and netcdf_data.start_time <= endtime <= netcdf_data.end_time):
+        logger.error('您输入的时间不在指定目录下输出文件的时间范围内')
+        raise RuntimeError('时间不在输出文件的时间范围内({} - {})'.format(netcdf_data.start_time, netcdf_data.end_time))
+    # 判断追踪/追溯
+    if starttime > endtime:
+        inverse = True
+        time_run *= -1
+        logger.info('开始时间:{}, 追溯时长:{}小时'.format(starttime,time_run))
+    else:
+        inverse = False
+        logger.info('开始时间:{}, 追踪时长:{}小时'.format(starttime,time_run))
+    data['Lagrangian']['TimeIntegration']['DTI'] = float(netcdf_data.time_step/20)
+    data['Lagrangian']['TimeIntegration']['INSTP'] = int(netcdf_data.time_step)
+    data['Lagrangian']['TimeIntegration']['TDRIFT'] = int(time_run*(3600/data['Lagrangian']['TimeIntegration']['INSTP']))   # 赋值追踪/追溯时长
+    data['Lagrangian']['General']['Inverse'] = inverse
+    data['Lagrangian']['StartTime']['YEARLAG'] = starttime.strftime('%Y')
+    data['Lagrangian']['StartTime']['MONTHLAG'] = starttime.strftime('%m')
+    data['Lagrangian']['StartTime']['DAYLAG'] = starttime.strftime('%d')
+    data['Lagrangian']['StartTime']['HOURLAG'] = starttime.strftime('%H')
+    if params.get('casename') is not None:
+        data['Lagrangian']['General']['CaseName'] = params['casename']
+    if params.get('geoarea') is not None:
+        data['Lagrangian']['IOLocation']['GEOAREA'] = params['geoarea']
+    if params.get('lagini') is not None:
+        data['Lagrangian']['IOLocation']['LAGINI'] = params['lagini']
+    if params.get('cart_shp') is not None:
+        if params['cart_shp'] == 'F':
+            data['Lagrangian']['ProjectionControl']['CART_SHP'] = False
+        elif params['cart_shp'] == 'T':
+            data['Lagrangian']['ProjectionControl']['CART_SHP'] = True
+        else:
+            logger.error('坐标系选择T/F错误')
+            raise ValueError('坐标系选择T/F错误')
+    if params.get('dragc') is not None:
+        try:
+            data['Lagrangian']['General']['Dragc'] = float(params['dragc'])
+        except ValueError:
+            logger.error('风拖曳系数设置错误')
+    if params.get('rotation_angle') is not None:
+        try:
+            data['Lagrangian']['General']['ROTATE_ANGLE'] = float(params['rotation_angle'])
+        except ValueError:
+            logger.error('旋转角设置错误')
+    if params.get('threads') is not None:
+        try:
+            data['General']['Threads'] = int(params['threads'])
+        except ValueError:
+            logger.error('线程数设置错误')
+    if params.get('workers') is not None:
+        try:
+            data['General']['Workers'] = int(params['workers'])
+        except ValueError:
+            logger.error('并发进程数设置错误')
+    if params.get('engine') is not None:
+        if params['engine'] not in ('ptraj', 'numpy'):
+            logger.error('追踪引擎选择ptraj/numpy错误')
+            raise ValueError('追踪引擎选择ptraj/numpy错误')
+        data['Lagrangian']['General']['Engine'] = params['engine']
+    return data
 
 class LagrangianTracking_FVCOMOffline:
-    def __init__(self, configfile: str):
+    def __init__(self, configfile: str, run: bool = True, netcdf_data: FVCOMResultProcessor = None):
+        """
+        :param configfile: 配置文件路径
+        :param run: 是否立即运行(写入namelist、编译、拆分并运行); 为False时由调用者分步调用prepare/lag_run
+        :param netcdf_data: 已扫描的FVCOM输出,为None时按需重新读取(集合运行时各成员共用)
+        """
         self.total_progress = 0.0
+        self.executable = None
+        self.netcdf_data = netcdf_data
+        self.mesh = None
+        self.num_shards = None
+        self.configpath = configfile
         self.configfile = toml.load(configfile)
         # 创建日志
-        self.logger = AppLogger('LagrangianTracking(FVCOM_offline)', self.configfile['Log']['Level'], pathlib.Path(self.configfile['Log']['File']))
-        # 总线程数
+        self.logger = AppLogger.from_config('LagrangianTracking(FVCOM_offline)', self.configfile)
+        # ptraj输出单独记录并限流(Log.OutputRate条/秒)
+        self.output_logger = AppLogger.from_config('LagrangianTracking(FVCOM_offline).output', self.configfile, 'OutputRate')
+        # 子算例(分片)数,由有限个并发进程依次运行
         self.thread_nums = int(self.configfile['General']['Threads'])
 
         # 读取粒子追踪设置
@@ -43,26 +225,233 @@ class LagrangianTracking_FVCOMOffline:
         self.p_sigma = self.configfile['Lagrangian']['Coor']['P_SIGMA']
         self.out_sigma = self.configfile['Lagrangian']['Coor']['OUTSIGMA']
         self.irw = self.configfile['Lagrangian']['RandomWalk']['IRW']
+        if self.irw not in RANDOM_WALK_MODES:
+            self.logger.error('IRW只能为{}: {}'.format(', '.join('{}({})'.format(key, value) for key, value in RANDOM_WALK_MODES.items()), self.irw))
+            raise ValueError
         self.dhor = self.configfile['Lagrangian']['RandomWalk']['DHOR']
         self.dtrw = self.configfile['Lagrangian']['RandomWalk']['DTRW']
         self.cart_shp = self.configfile['Lagrangian']['ProjectionControl']['CART_SHP']
         self.projection_reference = self.configfile['Lagrangian']['ProjectionControl']['PROJECTION_REFERENCE']
+        self.engine = self.configfile['Lagrangian']['General'].get('Engine', 'ptraj')
+        split = self.configfile['Lagrangian'].get('Split', {})
+        self.split_mode = split.get('Mode', 'sequential')
+        self.split_cost = split.get('Cost', 'uniform')
+        self.merge = self.configfile['Lagrangian'].get('Merge', {})
+        self.cluster = self.configfile.get('Cluster', {})
+        self.staging = self.configfile['Lagrangian'].get('Staging', {})
+        self.cfl = self.configfile['Lagrangian'].get('CFL', {})
+        self.postprocessing = self.configfile.get('PostProcessing', {})
+        self.trajectory_index = self.configfile.get('TrajectoryIndex', {})
+        self.particle_bounds = None     # 网格内粒子的范围 [xmin, ymin, xmax, ymax],拆分时记录
         self.logger.info('结束 - 读取FVCOM离线拉格朗日追踪配置')
 
+        if run:
+            self.run()
+
+    def run(self, executable: str = None):
+        """
+        按所选引擎运行追踪
+
+        Parameters:
+        executable (str): 已编译的ptraj,给定时跳过编译(常驻服务的各作业共用)
+
+        Returns:
+        dict: 轨迹文件(output, ptraj为合并后的文件)与后处理产品的路径; 作业数组未等待结束或未合并时为空
+        """
+        if self.engine == 'numpy':          # 进程内NumPy追踪,无需编译与拆分
+            self.logger.info('使用NumPy追踪引擎')
+            output = NumPyParticleTracker(self.configpath, self.netcdf_data, self.mesh).run()
+            return dict(self.postprocess(output), output=output)
+        elif self.engine != 'ptraj':
+            self.logger.error('未知的追踪引擎: {}'.format(self.engine))
+            raise ValueError
+        # 运行(同一配置与输入的检查点存在时只运行未完成的子算例)
+        results = self.lag_run(self.plan(executable))
+        # 合并各子算例输出(作业数组未等待结束时,完成后再次运行再合并)
+        if results is not None and self.merge.get('Enabled', True):
+            merged = self.merge_outputs()
+            if merged is not None:
+                return dict(self.postprocess(merged), output=merged)
+        return {}
+
+    def postprocess(self, trajectory_file: str):
+        """
+        由合并后的轨迹计算粒子密度、滞留时间与连通矩阵(PostProcessing.Enabled),并建立时空查询索引(TrajectoryIndex.Enabled)
+
+        Returns:
+        dict: 各产品的路径
+        """
+        products = {}
+        if self.postprocessing.get('Enabled', False):
+            products['density'] = TrajectoryPostProcessor(self, self.postprocessing).run(trajectory_file)
+        if self.trajectory_index.get('Enabled', False):
+            products['index'] = self.build_trajectory_index(trajectory_file).directory
+        return products
+
+    def build_trajectory_index(self, trajectory_file: str):
+        """
+        建立(轨迹文件未变化时直接打开)轨迹的时空查询索引,默认目录 OUTDIR/{CaseName}_index
+
+        Returns:
+        TrajectoryIndex: 索引
+        """
+        settings = self.trajectory_index
+        directory = settings.get('Directory', '') or os.path.join(self.directory, self.outdir, f"{self.casename}_index")
+        bounds = settings.get('Bounds', [])
+        if not bounds:
+            mesh = self.load_mesh()
+            bounds = [mesh.x0, mesh.y0, mesh.x1, mesh.y1]
+        return TrajectoryIndex.build(trajectory_file, directory, bounds, float(settings.get('TileSize', 0.05)),
+                                     int(settings.get('TimeChunk', 24)), int(settings.get('ParticleChunk', 250000)),
+                                     tuple(settings.get('Variables', ['x', 'y'])), bool(settings.get('Positions', False)),
+                                     self.logger)
+
+    def prepare(self, executable: str = None):
+        """
+        写入namelist、编译并拆分算例,返回待运行的子算例任务
+
+        Parameters:
+        executable (str): 已编译的ptraj,给定时跳过编译
+
+        Returns:
+        list: 子算例任务
+        """
+        # 按追踪时段内的流场选择DTI
+        if self.cfl.get('Enabled', False):
+            self.dti = CFLTimeStepSelector(self, self.cfl).select()
         # 写入dat文件
         self.nml_writer()
         # 编译适合的程序
-        self.compile_ptraj()
+        if executable is None:
+            self.compile_ptraj()
+        else:
+            self.executable = executable
         # 拆分算例
         self.particle_spliter()
-        # 运行
-        self.lag_run()
+        # 只链接(或裁剪)追踪时段所需的FVCOM输出
+        if self.staging.get('Enabled', False):
+            FVCOMInputStager(self, self.staging).stage()
+        return self.shard_tasks()
+
+    def plan(self, executable: str = None):
+        """
+        确定需要运行的子算例: General.Resume为真且检查点(manifest)的配置与输入哈希一致时,
+        沿用已有的拆分结果,只返回未完成(返回值非0或缺少输出)的子算例; 否则重新准备全部子算例并新建检查点
+
+        Parameters:
+        executable (str): 已编译的ptraj,给定时跳过编译
+
+        Returns:
+        list: 待运行的子算例任务
+        """
+        self.executable = executable if executable is not None else self.compile_ptraj()
+        hashes = self.run_hashes()
+        manifest = self.load_manifest()
+        if manifest is not None:
+            if not self.configfile['General'].get('Resume', True):
+                self.logger.info('忽略已有的检查点,重新运行全部子算例')
+            elif all(manifest.get(key) == value for key, value in hashes.items()) and self.shard_inputs_exist(manifest):
+                self.num_shards = len(manifest['shards'])
+                tasks = [task for task, shard in zip(self.shard_tasks(), manifest['shards']) if not self.shard_complete(shard)]
+                self.logger.info('由检查点续算: 共{}个子算例, 已完成{}个, 待运行{}个'.format(
+                    self.num_shards, self.num_shards-len(tasks), len(tasks)))
+                return tasks
+            else:
+                self.logger.info('配置或输入已变化,检查点失效,重新运行全部子算例')
+        tasks = self.prepare(self.executable)
+        self.save_manifest(dict(hashes, version=MANIFEST_VERSION, shards=[
+            {'case': task['case'], 'status': 'pending', 'returncode': None, 'attempts': 0, 'output': None} for task in tasks]))
+        return tasks
+
+    def run_hashes(self):
+        """
+        检查点的键: 影响结果的配置(Lagrangian节与子算例数)与输入(粒子文件内容、FVCOM输出文件、ptraj可执行文件)的哈希
+
+        Returns:
+        dict: config_hash, input_hash
+        """
+        settings = {key: value for key, value in self.configfile['Lagrangian'].items() if key not in ('Merge', 'NumPyEngine')}
+        settings['General'] = {key: value for key, value in settings['General'].items() if key not in ('Directory', 'Engine')}
+        settings['Threads'] = self.thread_nums
+        config_hash = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        digest = hashlib.sha1()
+        with open(os.path.join(self.directory, self.inpdir, 'particles.dat'), 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                digest.update(block)
+        if self.netcdf_data is None:
+            self.netcdf_data = FVCOMResultProcessor(self.configpath)
+        for entry in self.netcdf_data.time_index.sorted_entries():
+            digest.update('{}:{}:{}'.format(entry['path'], entry['size'], entry['mtime']).encode('utf-8'))
+        digest.update(str(self.executable).encode('utf-8'))     # 编译目录名即编译缓存键
+        return {'config_hash': config_hash, 'input_hash': digest.hexdigest()}
+
+    def manifest_file(self, directory: str = None):
+        return os.path.join(directory or self.directory, f"{self.casename}_manifest.json")
 
-    def nml_writer(self):
-        """写入namelist文件，保持相对路径"""
+    def load_manifest(self, directory: str = None):
+        """读取检查点,不存在或无法读取时为None"""
+        manifest_file = self.manifest_file(directory)
+        if not os.path.exists(manifest_file):
+            return None
+        try:
+            with open(manifest_file, 'r') as fin:
+                manifest = json.load(fin)
+        except (OSError, ValueError):
+            self.logger.warning('检查点读取失败,将重新运行: {}'.format(manifest_file))
+            return None
+        return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+    def save_manifest(self, manifest: dict, directory: str = None):
+        """原子地写入检查点"""
+        manifest_file = self.manifest_file(directory)
+        tmp_file = manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(manifest, fout, indent=2)
+        os.replace(tmp_file, manifest_file)
+
+    def record_result(self, result: dict):
+        """子算例结束后立即更新其所在目录的检查点(状态、返回值、输出文件)"""
+        manifest = self.load_manifest(result['cwd'])
+        if manifest is None:
+            return
+        outdir = os.path.join(result['cwd'], self.outdir)
+        for shard in manifest['shards']:
+            if shard['case'] == result['case']:
+                shard.update(status=result['status'], returncode=result['returncode'], attempts=shard['attempts']+result['attempts'],
+                             output=TrajectoryMerger.find_output(outdir, result['case'], self.merge.get('Pattern', '{case}*.nc')))
+        self.save_manifest(manifest, result['cwd'])
+
+    def shard_complete(self, shard: dict):
+        """子算例已完成: 返回值为0且输出文件存在"""
+        if shard['status'] != 'done' or shard['returncode'] != 0:
+            return False
+        output = TrajectoryMerger.find_output(os.path.join(self.directory, self.outdir), shard['case'], self.merge.get('Pattern', '{case}*.nc'))
+        return output is not None
 
-        nml_file = os.path.join(self.directory,self.casename+'_run.dat')
-        self.logger.info("开始 - 离线拉格朗日追踪的namelist文件已写入: {nml_file}")
+    def shard_inputs_exist(self, manifest: dict):
+        """检查点记录的各子算例的粒子文件与namelist仍然存在(启用分阶段输入时须在分阶段目录中)"""
+        for shard in manifest['shards']:
+            for path in (os.path.join(self.directory, self.namelist_inpdir(), shard['case']+'.dat'),
+                         os.path.join(self.directory, self.inpdir, shard['case']+'.ids.npy'),
+                         os.path.join(self.directory, shard['case']+'_run.dat')):
+                if not os.path.exists(path):
+                    return False
+        return True
+
+    def nml_writer(self, nml_file: str = None, lagini: str = None):
+        """
+        写入namelist文件，保持相对路径
+
+        Parameters:
+        nml_file (str): namelist文件路径,默认 Directory/{CaseName}_run.dat
+        lagini (str): 粒子文件名(不含.dat),默认为配置中的LAGINI; 子算例使用各自的粒子文件
+        """
+        if nml_file is None:
+            nml_file = os.path.join(self.directory,self.casename+'_run.dat')
+        if lagini is None:
+            lagini = self.lagini
+        self.logger.info(f"开始 - 写入离线拉格朗日追踪的namelist文件: {nml_file}")
 
         with open(nml_file, 'w') as f:
             # 时间积分参数
@@ -78,11 +467,11 @@ class LagrangianTracking_FVCOMOffline:
             f.write(f"HOURLAG = {self.hourlag}\n")
 
             # IO位置参数 - 保持相对路径结构
-            f.write(f"INPDIR = {self.inpdir}\n")
+            f.write(f"INPDIR = {self.namelist_inpdir()}\n")
             f.write(f"GEOAREA = {self.geoarea}\n")
             f.write(f"OUTDIR = {self.outdir}\n")
             f.write(f"INFOFILE = {self.infofile}\n")
-            f.write(f"LAGINI = {self.lagini}\n")
+            f.write(f"LAGINI = {lagini}\n")
 
             # SIGMA或CARTESIAN参数
             if self.f_depth:
@@ -115,28 +504,29 @@ class LagrangianTracking_FVCOMOffline:
 
         self.logger.info(f"结束 - 离线拉格朗日追踪的namelist文件已写入: {nml_file}")
 
+    def namelist_inpdir(self):
+        """namelist中的INPDIR: 启用分阶段输入时为分阶段目录"""
+        if self.staging.get('Enabled', False):
+            return FVCOMInputStager.relative_directory(self, self.staging)
+        return self.inpdir
+
     def compile_ptraj(self):
         '''
-        检查例子追踪namelist与编译程序
+        编译ptraj: 按(源码哈希, makefile版本, CPPFLAGS)在缓存目录中进行源码树外编译,
+        源码与编译选项均未变化时直接复用已编译的可执行文件,不修改共享的源码目录
         '''
-
-        self.logger.info('更改当前目录至拉格朗日追踪源代码目录:{}'.format(self.sourcepath))
-        os.chdir(self.sourcepath)
-        self.logger.info('进行make clean')
-        os.system('make clean')
         self.logger.info('开始 - 修改ptraj的makefile')
         self.logger.info('开始 - 选择球面(经纬度)/投影坐标系')
         if self.cart_shp:                   # 投影坐标系
             self.logger.info('您选择了:投影坐标系')
-            shutil.copyfile('makefile_proj','makefile')
+            variant = 'makefile_proj'
         else:                               # 球面坐标系
             self.logger.info('您选择了:球面(经纬度)坐标系')
-            shutil.copyfile('makefile_latlon','makefile')
+            variant = 'makefile_latlon'
         self.logger.info('结束 - 选择球面(经纬度)/投影坐标系')
 
-        with open('makefile', 'r') as fin:
+        with open(os.path.join(self.sourcepath, variant), 'r') as fin:
             lines = fin.readlines()
-            fin.close()
         # 判断makefile未注释的'CPPFLAGS ='行中是否有'-DINVERSE',即追溯
         self.logger.info('开始 - 选择追踪或追溯')
         if self.inverse:                    # 逆向追溯
@@ -155,168 +545,544 @@ class LagrangianTracking_FVCOMOffline:
                         lines[i_line] = line.replace('-DINVERSE','').rstrip()+'\n'
         self.logger.info('结束 - 选择追踪或追溯')
         # 删除空行和行尾空白
-        self.logger.info('开始 - 更新makefile(追踪/追溯)')
         cleaned_lines = []
         for line in lines:
             stripped_line = line.rstrip()
             if stripped_line:  # 如果不是空行
                 cleaned_lines.append(stripped_line + '\n')
-        with open('makefile', 'w') as fout:
-            fout.writelines(cleaned_lines)
-            fout.close()
-        self.logger.info('结束 - 修改ptraj的makefile(追踪/追溯)')
+        makefile = ''.join(cleaned_lines)
         self.logger.info('结束 - 修改ptraj的makefile(全部)')
-        self.logger.info('开始 - 编译ptraj可执行文件')
-        os.system('make')
-        self.logger.info('结束 - 编译ptraj可执行文件')
 
-    def lag_run(self):
+        # 编译缓存键: 源码内容 + makefile版本 + 修改后的makefile(含CPPFLAGS)
+        key = hashlib.sha1()
+        key.update(source_tree_hash(self.sourcepath).encode('utf-8'))
+        key.update(variant.encode('utf-8'))
+        key.update(makefile.encode('utf-8'))
+        build_root = os.path.join(get_cache_directory(self.configfile), 'ptraj_build')
+        os.makedirs(build_root, exist_ok=True)
+        build_dir = os.path.join(build_root, key.hexdigest()[:16])
+        self.executable = os.path.join(build_dir, 'ptraj')
+        done_marker = os.path.join(build_dir, '.build_ok')
+
+        # 文件锁: 并发任务共用同一次编译
+        with open(build_dir + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(done_marker) and os.path.exists(self.executable):
+                    self.logger.info('使用已编译的ptraj: {}'.format(self.executable))
+                    return self.executable
+                self.logger.info('开始 - 编译ptraj可执行文件: {}'.format(build_dir))
+                if os.path.exists(build_dir):
+                    shutil.rmtree(build_dir)
+                shutil.copytree(self.sourcepath, build_dir, symlinks=True, ignore=shutil.ignore_patterns(*BUILD_ARTIFACTS))
+                with open(os.path.join(build_dir, 'makefile'), 'w') as fout:
+                    fout.write(makefile)
+                result = subprocess.run(['make'], cwd=build_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        universal_newlines=True, encoding='utf-8', errors='replace')
+                for line in result.stdout.splitlines():
+                    self.logger.debug('[make] {}'.format(line))
+                if result.returncode != 0 or not os.path.exists(self.executable):
+                    self.logger.error('ptraj编译失败(返回值{}),编译输出:\n{}'.format(result.returncode, result.stdout[-4000:]))
+                    raise RuntimeError
+                with open(done_marker, 'w') as fout:
+                    fout.write(key.hexdigest()+'\n')
+                self.logger.info('结束 - 编译ptraj可执行文件')
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return self.executable
+
+    def shard_tasks(self):
+        """每个子算例为一个任务,由有限个工作线程从队列中依次领取"""
+        tasks = []
+        for i in range(self.thread_nums if self.num_shards is None else self.num_shards):
+            tasks.append({
+                'idx': i,
+                'case': f"{self.casename}_{i:03d}",
+                'cwd': self.directory,
+                'executable': self.executable,
+            })
+        return tasks
+
+    def lag_run(self, tasks: list = None, check: bool = True):
+        """
+        运行子算例
+
+        Parameters:
+        tasks (list): 子算例任务,默认为本算例的全部子算例
+        check (bool): 有子算例最终失败(重试后)时是否抛出异常
+
+        Returns:
+        list: 各子算例的运行结果,作业数组已提交但未等待结束时为None
+        """
         self.logger.info('开始 - 并行运行追踪程序')
-        self.logger.info(f'更改当前目录至:{self.directory}, 以运行离线粒子追踪')
-        os.chdir(self.directory)
-        compiled_executable_file = os.path.join(self.sourcepath, 'ptraj')
-        destination_path = os.path.join(self.directory, 'ptraj')
-
-        if os.path.exists(destination_path):
-            os.remove(destination_path)
-        os.symlink(compiled_executable_file, destination_path)
-
-        # -------------------------
-        # 新增：并行运行多个算例
-        # -------------------------
-        num_threads = self.thread_nums
-        self.logger.info(f"共检测到 {num_threads} 个算例，将并行运行。")
-
-        # 各线程的当前进度（百分比）
-        progress_list = [0.0 for _ in range(num_threads)]
-
-        # 定义锁以防止多线程竞争
-        progress_lock = threading.Lock()
-
-        # 正则表达式模式复用
-        pattern = re.compile(r'\s*(\d+)\s*/\s*(\d+)\s*finished\s*\(hours\)')
-
-        def parse_progress(line):
-            match = pattern.search(line)
-            if match:
-                current = int(match.group(1))
-                total = int(match.group(2))
-                if total > 0:
-                    return (current / total) * 100
+        if tasks is None:
+            tasks = self.shard_tasks()
+        backend = self.cluster.get('Backend', 'none')
+        if backend == 'none':   # 本机进程池(asyncio监控)
+            results = self.run_tasks(tasks, on_result=self.record_result)
+        elif backend in BACKENDS:   # 作业数组脚本: 提交到SLURM或在本机按数组序号执行
+            results = BACKENDS[backend](self, self.cluster).run(tasks)
+            if results is None:     # 已提交但未等待结束
+                return None
+        else:
+            self.logger.error('未知的集群后端: {}'.format(backend))
+            raise RuntimeError
+        if results:
+            self.write_timings(results)
+        failed = [result for result in results if result['status'] != 'done']
+        if failed:
+            self.logger.error('{}个子算例运行失败: {}'.format(len(failed), ', '.join(
+                '{}({}, 返回值{}, 尝试{}次)'.format(result['case'], result['status'], result['returncode'], result['attempts']) for result in failed)))
+            if check:
+                raise RuntimeError
+        else:
+            self.logger.info("全部粒子追踪算例运行完毕！")
+        return results
+
+    def write_timings(self, results: list):
+        """按运行目录记录各子算例耗时({CaseName}_timings.json),供下次按耗时均衡拆分"""
+        directories = {}
+        for result in results:
+            directories.setdefault(result['cwd'], []).append(
+                {'case': result['case'], 'seconds': result['seconds'], 'returncode': result['returncode'], 'status': result['status'],
+                 'attempts': result['attempts'], 'peak_rss': result['peak_rss']})
+        for directory, timings in directories.items():
+            # 续算时只运行部分子算例,与已有记录按算例名合并
+            timings_file = os.path.join(directory, f"{self.casename}_timings.json")
+            previous = {}
+            if os.path.exists(timings_file):
+                with open(timings_file, 'r') as fin:
+                    previous = {timing['case']: timing for timing in json.load(fin)}
+            previous.update({timing['case']: timing for timing in timings})
+            with open(timings_file, 'w') as fout:
+                json.dump([previous[case] for case in sorted(previous)], fout, indent=2)
+
+    def merge_outputs(self, output_file: str = None):
+        """
+        将各子算例在OUTDIR中的输出流式合并为一个文件,粒子维度使用particles.dat中的原始编号
+
+        Parameters:
+        output_file (str): 合并文件路径,默认 Lagrangian.Merge.Output 或 OUTDIR/{CaseName}_merged.nc
+
+        Returns:
+        str: 合并文件路径,没有子算例输出时为None
+        """
+        outdir = os.path.join(self.directory, self.outdir)
+        if output_file is None:
+            output_file = self.merge.get('Output', '') or os.path.join(outdir, f"{self.casename}_merged.nc")
+        pattern = self.merge.get('Pattern', '{case}*.nc')
+        shards, missing = [], []
+        for task in self.shard_tasks():
+            path = TrajectoryMerger.find_output(outdir, task['case'], pattern)
+            if path is None or os.path.abspath(path) == os.path.abspath(output_file):
+                missing.append(task['case'])
+                continue
+            shards.append((path, os.path.join(self.directory, self.inpdir, task['case']+'.ids.npy')))
+        if missing:
+            self.logger.warning('{}个子算例没有输出文件,不参与合并: {}'.format(len(missing), missing[:10]))
+        if not shards:
             return None
+        merger = TrajectoryMerger(self.logger, complevel=int(self.merge.get('CompLevel', 4)),
+                                  source_dim=self.merge.get('ParticleDimension', 'nlag'))
+        return merger.merge(shards, output_file)
+
+    def worker_count(self):
+        """
+        计算并发运行的ptraj进程数: 默认为可用CPU数,
+        配置了单进程内存(General.MemoryPerProcess, GB)时不超过可用内存所能容纳的进程数
+
+        Returns:
+        int: 并发进程数
+        """
+        general = self.configfile['General']
+        try:
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = os.cpu_count() or 1
+        workers = int(general.get('Workers', 0)) or cpus
+        memory_per_process = float(general.get('MemoryPerProcess', 0.0))
+        if memory_per_process > 0:
+            available = available_memory()
+            if available is not None:
+                limit = max(1, int(available/(memory_per_process*1024**3)))
+                if limit < workers:
+                    self.logger.info(f"可用内存 {available/1024**3:.1f}GB, 单进程约 {memory_per_process}GB, 并发数限制为 {limit}")
+                    workers = limit
+        return max(1, workers)
 
-        def handle_output(idx, line):
-            """处理子进程输出并更新对应线程的进度"""
-            line = line.strip()
-            self.logger.info(f"[{idx:02d}] 输出: {line}")
-            progress_percent = parse_progress(line)
-            if progress_percent is not None:
-                with progress_lock:
-                    progress_list[idx] = progress_percent
-                    self.total_progress = sum(progress_list) / num_threads
-                self.logger.info(f"[{idx:02d}] 当前进度: {progress_percent:.1f}%，总体进度: {self.total_progress:.1f}%")
-
-        def run_case(idx):
-            """运行单个粒子追踪算例"""
-            case_name = f"{self.casename}_{idx:03d}"
-            command = ['./ptraj', case_name]
-            self.logger.info(f"[{idx:02d}] 启动命令: {' '.join(command)}")
-
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1,
-                encoding='utf-8',
-                errors='replace'
-            )
-
-            for line in iter(process.stdout.readline, ''):
-                handle_output(idx, line)
-
-            process.wait()
-            self.logger.info(f"[{idx:02d}] 进程结束")
-
-        # -------------------------
-        # 启动所有线程
-        # -------------------------
-        threads = []
-        for i in range(num_threads):
-            t = threading.Thread(target=run_case, args=(i,))
-            threads.append(t)
-            t.start()
-
-        # -------------------------
-        # 等待所有线程结束
-        # -------------------------
-        for t in threads:
-            t.join()
-
-        self.logger.info("全部粒子追踪算例运行完毕！")
+    def supervisor_settings(self):
+        """
+        子算例监控设置(General节): 运行时长上限、无进度超时(分钟)、重试次数与重试间隔(秒,每次翻倍)
+
+        Returns:
+        dict: wall_timeout, stall_timeout(秒,None为不限制), retries, backoff
+        """
+        general = self.configfile['General']
+        wall_timeout = float(general.get('ShardTimeout', 0.0))*60
+        stall_timeout = float(general.get('StallTimeout', 0.0))*60
+        return {
+            'wall_timeout': wall_timeout if wall_timeout > 0 else None,
+            'stall_timeout': stall_timeout if stall_timeout > 0 else None,
+            'retries': int(general.get('Retries', 0)),
+            'backoff': float(general.get('RetryBackoff', 30.0)),
+        }
+
+    def run_tasks(self, tasks, on_result=None):
+        """
+        以有限并发运行ptraj任务: 在一个asyncio事件循环中管理全部子进程,非阻塞读取输出,
+        空闲名额依次领取下一个任务,避免所有子算例同时启动造成CPU超额占用与内存压力;
+        超过运行时长上限或长时间无进度的子算例被终止,失败的子算例按退避间隔重试;
+        收到SIGINT/SIGTERM时终止所有子进程组
+
+        Parameters:
+        tasks (list): 任务列表,每个任务包含 idx(进度序号), case(算例名), cwd(运行目录), executable(可执行文件)
+        on_result (callable): 每个任务最终结束(含重试)时以其结果调用,用于及时记录检查点
+
+        Returns:
+        list: 各任务的运行结果(任务字典附加returncode、status、attempts、耗时seconds与峰值内存peak_rss),顺序与tasks相同
+        """
+        num_tasks = len(tasks)
+        workers = min(self.worker_count(), num_tasks)
+        self.logger.info(f"共 {num_tasks} 个算例, 最多同时运行 {workers} 个")
+        if num_tasks == 0:
+            return []
+        # 运行遥测: 各算例的进度、速度、剩余时间与峰值内存,按间隔汇总输出
+        telemetry = self.create_telemetry(tasks)
+        try:
+            results = asyncio.run(self.supervise(tasks, workers, telemetry, on_result=on_result, **self.supervisor_settings()))
+        except asyncio.CancelledError:
+            telemetry.maybe_emit(force=True)
+            self.logger.error('运行被中断,已终止全部ptraj进程')
+            raise KeyboardInterrupt
+        telemetry.maybe_emit(force=True)
+        return results
+
+    async def supervise(self, tasks: list, workers: int, telemetry, wall_timeout: float = None, stall_timeout: float = None,
+                        retries: int = 0, backoff: float = 30.0, on_result=None):
+        """在事件循环中以workers个名额运行全部任务,返回各任务结果; 每个任务最终结束时调用on_result(结果)"""
+        slots = asyncio.Semaphore(workers)
+        main_task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        handled = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, main_task.cancel)
+                handled.append(signum)
+            except (RuntimeError, ValueError, NotImplementedError):   # 非主线程中运行时无法注册
+                pass
+
+        async def run_with_retries(i_task, task):
+            started = time.monotonic()
+            for attempt in range(retries+1):
+                if attempt > 0:
+                    delay = backoff*2**(attempt-1)
+                    self.logger.warning(f"[{task['idx']:02d}] {task['case']} 将在 {delay:.0f} 秒后第 {attempt} 次重试")
+                    await asyncio.sleep(delay)
+                async with slots:
+                    returncode, status = await self.run_case(i_task, task, telemetry, wall_timeout, stall_timeout)
+                if status == 'done':
+                    break
+            result = dict(task, returncode=returncode, status=status, attempts=attempt+1,
+                          seconds=time.monotonic()-started, peak_rss=telemetry.shards[i_task]['peak_rss'])
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        try:
+            return await asyncio.gather(*(run_with_retries(i_task, task) for i_task, task in enumerate(tasks)))
+        finally:
+            for signum in handled:
+                loop.remove_signal_handler(signum)
+
+    async def run_case(self, i_task: int, task: dict, telemetry, wall_timeout: float = None, stall_timeout: float = None):
+        """
+        运行单个粒子追踪算例(独立进程组),逐行读取输出并更新进度
+
+        Returns:
+        tuple: (返回值, 状态 done/failed/timeout/stalled)
+        """
+        idx = task['idx']
+        command = [task['executable'], task['case']]
+        self.logger.info(f"[{idx:02d}] 启动命令: {' '.join(command)}")
+        try:
+            process = await asyncio.create_subprocess_exec(*command, cwd=task['cwd'], stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+        except OSError as error:    # 可执行文件或运行目录不存在、无权限等,按失败重试
+            self.logger.error(f"[{idx:02d}] 无法启动: {error}")
+            telemetry.start(i_task, None)
+            telemetry.finish(i_task, None, status='failed')
+            return None, 'failed'
+        telemetry.start(i_task, process.pid)
+        started = last_progress = last_sample = time.monotonic()
+        status = None
+        try:
+            while True:
+                # 每读到一行或等待超时后都检查运行时长与进度,按SUPERVISOR_TICK采样内存,与输出多少无关
+                now = time.monotonic()
+                deadlines = [last_sample + SUPERVISOR_TICK]
+                if wall_timeout is not None:
+                    deadlines.append(started + wall_timeout)
+                if stall_timeout is not None:
+                    deadlines.append(last_progress + stall_timeout)
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), max(min(deadlines) - now, 0.0))
+                except asyncio.TimeoutError:
+                    line = None
+                except (ValueError, asyncio.LimitOverrunError):     # 单行输出超过流缓冲区上限(64KiB)
+                    status = 'failed'
+                    self.logger.error(f"[{idx:02d}] 输出行超过缓冲区上限,终止")
+                    break
+                if line is not None:
+                    if not line:
+                        break
+                    line = line.decode('utf-8', errors='replace').strip()
+                    self.output_logger.debug(f"[{idx:02d}] 输出: {line}")
+                    match = PROGRESS_PATTERN.search(line)
+                    if match:
+                        last_progress = time.monotonic()
+                        telemetry.update(i_task, int(match.group(1)), int(match.group(2)))
+                        self.total_progress = telemetry.progress
+                now = time.monotonic()
+                if wall_timeout is not None and now - started >= wall_timeout:
+                    status = 'timeout'
+                    self.logger.error(f"[{idx:02d}] 运行超过 {wall_timeout:.0f} 秒,终止")
+                    break
+                if stall_timeout is not None and now - last_progress >= stall_timeout:
+                    status = 'stalled'
+                    self.logger.error(f"[{idx:02d}] 超过 {stall_timeout:.0f} 秒无进度输出,终止")
+                    break
+                if now - last_sample >= SUPERVISOR_TICK:
+                    telemetry.sample(i_task)
+                    last_sample = now
+            if status is not None:
+                await self.kill_process_group(process)
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            await asyncio.shield(self.kill_process_group(process))
+            raise
+        if status is None:
+            status = 'done' if returncode == 0 else 'failed'
+        telemetry.finish(i_task, returncode, status=status)
+        self.total_progress = telemetry.progress
+        self.logger.info(f"[{idx:02d}] 进程结束, 返回值 {returncode}, 状态 {status}")
+        return returncode, status
+
+    @staticmethod
+    async def kill_process_group(process, grace: float = 10.0):
+        """先SIGTERM,超过grace秒仍未退出则SIGKILL整个进程组"""
+        if process.returncode is not None:
+            return
+        for signum, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, None)):
+            try:
+                os.killpg(process.pid, signum)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(process.wait(), wait)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    def create_telemetry(self, tasks: list):
+        """按Telemetry配置创建运行遥测(快照文件默认写入Directory)"""
+        settings = self.configfile.get('Telemetry', {})
+        jsonl_file = settings.get('JsonLines', '') or os.path.join(self.directory, f"{self.casename}_telemetry.jsonl")
+        prometheus_file = settings.get('PrometheusFile', '') or None
+        return RunTelemetry(tasks, self.logger, float(settings.get('Interval', 30.0)), jsonl_file, prometheus_file)
 
     def particle_spliter(self):
-        current_dir = os.getcwd()
-        os.chdir(os.path.join(self.directory,self.inpdir))
-        # 读取粒子
-        self.particles = np.loadtxt('particles.dat', skiprows=1, dtype=float, usecols=[1,2])
-        num_particles_all = self.particles.shape[0]
+        """
+        流式拆分粒子文件: 分块读取INPDIR/particles.dat并剔除网格外粒子,
+        切分为子算例 {CaseName}_{i:03d}.dat(每行: 子算例内编号 x y z),
+        同时写入原始粒子编号 {CaseName}_{i:03d}.ids.npy 与子算例namelist {CaseName}_{i:03d}_run.dat
+
+        切分方式由 Lagrangian.Split 决定:
+        Mode = 'sequential' 按文件顺序切分; 'spatial' 按所在单元中心的Morton顺序切分,每个子算例占据紧凑的区域
+        Cost = 'uniform' 各子算例粒子数相同; 'velocity' 按所在单元的流速估计计算量; 'timings' 按上次运行各子算例的耗时估计
+        各子算例的估计计算量之和相近,使其大致同时结束
+        """
+        if self.split_mode not in ('sequential', 'spatial'):
+            self.logger.error('未知的粒子拆分方式: {}'.format(self.split_mode))
+            raise ValueError
+        if self.split_cost not in ('uniform', 'velocity', 'timings'):
+            self.logger.error('未知的粒子计算量估计方式: {}'.format(self.split_cost))
+            raise ValueError
+        inpdir = os.path.join(self.directory,self.inpdir)
+        particle_file = os.path.join(inpdir,'particles.dat')
+        cost_model = self.cost_model()      # 须在覆盖上次的子算例文件前读取
+        # 第一遍: 分块读取、定位,网格内粒子(编号, x, y, 单元, 计算量)追加写入临时二进制文件
+        staging = os.path.join(inpdir,f".{self.casename}_particles.tmp")
+        num_particles_all = 0
+        self.particle_bounds = None
+        with open(staging,'wb') as fstage:
+            num_read = 0
+            for chunk in read_particle_chunks(particle_file, PARTICLE_CHUNK):
+                element = self.locate_particles(chunk[:,1], chunk[:,2], offset=num_read)
+                inside = element >= 0
+                rows = np.empty((int(inside.sum()),5))
+                rows[:,:3] = chunk[inside]
+                rows[:,3] = element[inside]
+                rows[:,4] = cost_model(rows[:,0], element[inside])
+                rows.tofile(fstage)
+                num_read += chunk.shape[0]
+                num_particles_all += rows.shape[0]
+                if rows.shape[0]:
+                    bounds = [rows[:,1].min(), rows[:,2].min(), rows[:,1].max(), rows[:,2].max()]
+                    if self.particle_bounds is not None:
+                        bounds = [min(bounds[0], self.particle_bounds[0]), min(bounds[1], self.particle_bounds[1]),
+                                  max(bounds[2], self.particle_bounds[2]), max(bounds[3], self.particle_bounds[3])]
+                    self.particle_bounds = [float(value) for value in bounds]
+        self.logger.info(f"网格内粒子共 {num_particles_all} 个")
         if num_particles_all < self.thread_nums:
-            print(f"警告:  总粒子数 ({num_particles_all}) 小于总线程数 ({self.thread_nums})")
-        num_shouldbe = num_particles_all//self.thread_nums              # 最少每个有多少 +1为其他
-        num_error = num_particles_all - num_shouldbe*self.thread_nums   # 多少个+1
-        j_all = 0
-        for i in range(self.thread_nums):
-            with open(f"{self.casename}_{i:03d}.dat", 'w') as fout:
-                if i < num_error:                                       # 未达到组数,为n+1个
-                    j_max = num_shouldbe+1
-                else:                                                   # 达到组数,为n个
-                    j_max = num_shouldbe
-                    if j_max == 0:                                      # 不足每线程一个粒子则停止
-                        break
-                # 处理nml文件
-                os.system(f'cp ../{self.casename}_run.dat ../{self.casename}_{i:3d}_run.dat')
-                with open ('../{self.casename}_{i:3d}_run.dat') as f_nml:
-                    lines = f_nml.readlines()
-                    for i_line,line in enumerate(lines):
-                        if 'LAGINI =' in line:
-                            lines[i_line] = line.rstrip()+f'_{i:3d}\n'
-                    f_nml.writelines(lines)
-                # 开始写入粒子文件
-                fout.write(str(j_max)+'\n')
-                for j in range(j_max):
-                    fout.write(f'{j+1:3d} {self.particles[j_all,0]:10.6f} {self.particles[j_all,1]:10.7f} 0.000\n')
-                    j_all += 1
-            # 写入运行脚本
-            with open('pbs{:03d}_'.format(i-1)+str(self.configfile['Lagrangian']['General']['Dragc']), 'w') as fout:
-                fout.write("""#!/bin/bash
-#SBATCH --job-name="{:03d}_""".format(i-1)+str(self.configfile['Lagrangian']['General']['Dragc'])+""""
-#SBATCH --partition="cpu"
-#SBATCH -N 1
-#SBATCH -n 1
-#SBATCH -t 144:00:00
-#SBATCH --output={:03d}_""".format(i-1)+str(self.configfile['Lagrangian']['General']['Dragc'])+""".log
-#SBATCH --error={:03d}_""".format(i-1)+str(self.configfile['Lagrangian']['General']['Dragc'])+""".error
-
-
-###以上部分说明：###
-####第一段部分，后面不可以有注释，不可以有空格！！！！！
-#SBATCH 
-#SBATCH -t 144:00:00                            ###作业强制终止时间.可自定义时长。格式为“小时：分钟：秒”
-
-echo "SLURM_JOBID= "$SLURM_JOBID
-echo "SLURM_JOB_NODELIST= "$SLURM_JOB_NODELIST
-echo "SLURM_NNODES= "$SLURM_NNODES
-echo "SLURMTMPDIR= "$SLURMTMPDIR
-echo "working directory= "$SLURM_SUBMIT_DIR
-
-NPROCS=`srun --nodes=${SLURM_NNODES} bash -c 'hostname' | wc -l`
-echo "Number of Processors = "$NPROCS
-
-module use /public/software/modulefiles
-module purge
-module load netcdf-fortran/4.6.2
-./ptraj_inverse_"""+str(self.configfile['Lagrangian']['General']['Dragc'])+""" Jun_2025_{:03d}_""".format(i-1)+str(self.configfile['Lagrangian']['General']['Dragc']))
-        shutil.rmtree(f"{self.lagini}_run.dat")
-        shutil.rmtree(f"../{self.casename}_run.dat")
-        os.chdir(current_dir)
\ No newline at end of file
+            self.logger.warning(f"总粒子数 ({num_particles_all}) 小于总线程数 ({self.thread_nums})")
+
+        # 第二遍: 排序并按估计计算量切分,分块写出各子算例
+        particles = np.memmap(staging, dtype=float, mode='r', shape=(num_particles_all,5)) if num_particles_all else np.zeros((0,5))
+        if self.split_mode == 'spatial':
+            element_code = self.load_mesh().element_order()
+            order = np.argsort(element_code[particles[:,3].astype(np.int64)], kind='stable')
+            cost = np.asarray(particles[:,4])[order]
+        else:
+            order = None
+            cost = np.asarray(particles[:,4])
+        bounds = cost_bounds(cost, min(self.thread_nums, num_particles_all))
+        del cost
+        self.num_shards = bounds.size - 1
+        for i in range(self.num_shards):
+            shard = f"{self.casename}_{i:03d}"
+            if order is None:
+                rows = particles[bounds[i]:bounds[i+1],:3]
+            else:   # 子算例内保持文件顺序,按块读取临时文件时更连续
+                rows = particles[np.sort(order[bounds[i]:bounds[i+1]]),:3]
+            self.write_shard(os.path.join(inpdir,shard), rows)
+            self.nml_writer(os.path.join(self.directory,shard+'_run.dat'), lagini=shard)
+        del particles, order
+        os.remove(staging)
+        self.logger.info(f"粒子已拆分为 {self.num_shards} 个子算例(方式: {self.split_mode}, 计算量: {self.split_cost})")
+
+    def cost_model(self):
+        """
+        每个粒子的估计计算量
+
+        Returns:
+        callable: (原始编号, 所在单元) -> 估计计算量
+        """
+        if self.split_cost == 'timings':
+            previous = self.previous_costs()
+            if previous is not None:
+                previous_ids, previous_cost = previous
+                default = float(previous_cost.mean())
+                def timings_cost(ids, element):
+                    position = np.clip(np.searchsorted(previous_ids, ids), 0, previous_ids.size-1)
+                    return np.where(previous_ids[position] == ids, previous_cost[position], default)
+                return timings_cost
+            self.logger.warning('未找到上次运行的子算例耗时,按粒子数均分')
+        elif self.split_cost == 'velocity':
+            speed = self.element_speed()
+            # 基础开销(每步定位、输出) + 与流速成正比的开销(跨越单元更多)
+            element_cost = 1.0 + speed/max(float(speed.mean()), 1e-12)
+            return lambda ids, element: element_cost[element]
+        return lambda ids, element: np.ones(ids.shape)
+
+    def element_speed(self, num_samples: int = 8):
+        """
+        追踪时段内各单元的平均流速(表层,均匀抽取若干时次)
+
+        Returns:
+        np.ndarray: (nele,) 流速大小
+        """
+        start = datetime(int(self.yearlag), int(self.monthlag), int(self.daylag), int(self.hourlag))
+        duration = timedelta(seconds=float(self.tdrift)*float(self.instp))
+        end = start - duration if self.inverse else start + duration
+        if self.netcdf_data is None:
+            self.netcdf_data = FVCOMResultProcessor(self.configpath)
+        with self.netcdf_data.open_multifile_dataset() as dataset:
+            first, last = sorted((dataset.time_to_index(start, 'nearest'), dataset.time_to_index(end, 'nearest')))
+            first, last = max(first, 0), min(last, len(dataset)-1)
+            speed = None
+            samples = np.unique(np.linspace(first, last, num_samples).round().astype(int))
+            for index in samples:
+                u = dataset.read('u', index, index+1, 0)[0]
+                v = dataset.read('v', index, index+1, 0)[0]
+                speed = np.hypot(u, v) if speed is None else speed + np.hypot(u, v)
+        return speed/samples.size
+
+    def previous_costs(self):
+        """
+        由上次运行的子算例耗时({CaseName}_timings.json)与原始粒子编号估计每个粒子的计算量
+
+        Returns:
+        tuple: (排序后的原始编号, 对应的计算量), 无可用记录时为None
+        """
+        timings_file = os.path.join(self.directory, f"{self.casename}_timings.json")
+        if not os.path.exists(timings_file):
+            return None
+        with open(timings_file, 'r') as fin:
+            timings = json.load(fin)
+        ids, costs = [], []
+        for timing in timings:
+            ids_file = os.path.join(self.directory, self.inpdir, timing['case']+'.ids.npy')
+            if timing['returncode'] != 0 or timing.get('status', 'done') != 'done' or not os.path.exists(ids_file):
+                continue
+            shard_ids = np.load(ids_file)
+            if shard_ids.size == 0:
+                continue
+            ids.append(shard_ids)
+            costs.append(np.full(shard_ids.size, timing['seconds']/shard_ids.size))
+        if not ids:
+            return None
+        ids, costs = np.concatenate(ids), np.concatenate(costs)
+        order = np.argsort(ids)
+        return ids[order].astype(float), costs[order]
+
+    @staticmethod
+    def write_shard(path: str, particles: np.ndarray):
+        """
+        写入一个子算例的粒子文件(path.dat)与原始粒子编号(path.ids.npy)
+
+        Parameters:
+        path (str): 不含扩展名的文件路径
+        particles (np.ndarray): (n,3) 原始编号, x, y
+        """
+        num_particles = particles.shape[0]
+        ids = np.lib.format.open_memmap(path+'.ids.npy', mode='w+', dtype=np.int64, shape=(num_particles,))
+        with open(path+'.dat', 'w') as fout:
+            fout.write(str(num_particles)+'\n')
+            for start in range(0, num_particles, PARTICLE_CHUNK):
+                chunk = np.asarray(particles[start:start+PARTICLE_CHUNK])
+                ids[start:start+chunk.shape[0]] = chunk[:,0]
+                # 子算例内编号(从1开始) x y z: 每WRITE_ROWS行格式化后直接写入文件,不拼接整块的字符串
+                rows = np.empty((chunk.shape[0],3))
+                rows[:,0] = np.arange(start+1, start+chunk.shape[0]+1)
+                rows[:,1:] = chunk[:,1:]
+                for block in range(0, rows.shape[0], WRITE_ROWS):
+                    values = rows[block:block+WRITE_ROWS]
+                    fout.write((PARTICLE_FORMAT*values.shape[0]) % tuple(values.ravel().tolist()))
+        ids.flush()
+        del ids
+
+    def load_mesh(self):
+        """读取(或由缓存加载)网格定位索引"""
+        if self.mesh is None:
+            if self.netcdf_data is None:
+                self.netcdf_data = FVCOMResultProcessor(self.configpath)
+            coordinates = self.netcdf_data.mesh_coordinates(self.cart_shp)
+            with self.netcdf_data.open_multifile_dataset() as dataset:
+                self.mesh = FVCOMMeshIndex.from_dataset(dataset, self.cart_shp, get_cache_directory(self.configfile), self.logger, coordinates)
+        return self.mesh
+
+    def locate_particles(self, px, py, offset: int = 0):
+        """
+        定位粒子所在单元,网格外(陆地或计算域外)的粒子不交给ptraj
+
+        Parameters:
+        offset (int): 本块第一个粒子在粒子文件中的位置,用于日志中的序号
+
+        Returns:
+        np.ndarray: 所在单元(从0开始),网格外为-1
+        """
+        element = self.load_mesh().locate(px, py)
+        if np.any(element < 0):
+            outside = np.flatnonzero(element < 0)
+            self.logger.warning('{}个粒子不在网格内,已剔除(前10个序号: {})'.format(outside.size, (outside[:10]+offset+1).tolist()))
+        return element
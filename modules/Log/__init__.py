@@ -1,42 +1,151 @@
 import pathlib
 import logging
+import logging.handlers
 import sys
+import os
+import queue
+import time
+import atexit
+import threading
+
+_listeners = {}                 # 日志文件 -> (队列, QueueListener), 同一文件的所有记录器共用
+_listeners_lock = threading.Lock()
+_inherited = {}                 # fork出的子进程中: 日志文件 -> (父进程的队列, 文件与控制台处理程序)
+
+def stop_listeners():
+    """写完队列中剩余的日志并停止后台线程(进程退出前调用; fork出的子进程以os._exit退出,不执行atexit,须自行调用)"""
+    with _listeners_lock:
+        for _, listener in _listeners.values():
+            listener.stop()
+        _listeners.clear()
+
+def _reset_listeners():
+    """fork出的子进程中没有父进程的后台线程: 丢弃继承的监听器,子进程创建日志时重新建立"""
+    global _listeners_lock
+    _listeners_lock = threading.Lock()
+    _inherited.clear()
+    _inherited.update({key: (records, listener.handlers) for key, (records, listener) in _listeners.items()})
+    _listeners.clear()
+
+def restart_listeners():
+    """
+    fork出的子进程中恢复继承的日志: 否则父进程中创建的记录器仍写入父进程的队列,子进程中无人读取,记录丢失。
+    为每个日志文件新建队列与后台线程(沿用继承的文件与控制台处理程序),继承的QueueHandler改写到新队列;
+    父进程队列中fork时尚未写出的记录由父进程写出,子进程不重复写出。子进程退出前须调用stop_listeners
+    """
+    with _listeners_lock:
+        queues = {}
+        for key, (records, handlers) in _inherited.items():
+            if key not in _listeners:
+                new_records = queue.SimpleQueue()
+                listener = logging.handlers.QueueListener(new_records, *handlers, respect_handler_level=True)
+                listener.start()
+                _listeners[key] = (new_records, listener)
+            queues[id(records)] = _listeners[key][0]
+        _inherited.clear()
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values() if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.handlers.QueueHandler) and id(handler.queue) in queues:
+                handler.queue = queues[id(handler.queue)]
+
+atexit.register(stop_listeners)
+os.register_at_fork(after_in_child=_reset_listeners)
+
+class RateLimitFilter(logging.Filter): # 令牌桶限流: 每秒最多rate条,允许burst条突发,被丢弃的条数附在下一条记录后
+    def __init__(self, rate: float, burst: int = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:   # 警告与错误不限流
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+            self.updated = now
+            if self.tokens < 1.0:
+                self.dropped += 1
+                return False
+            self.tokens -= 1.0
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            record.msg = '{} (限流丢弃{}条)'.format(record.getMessage(), dropped)
+            record.args = None
+        return True
 
 class AppLogger:
-    def __init__(self, name, log_level:str, logpath:pathlib.Path): #初始化
+    def __init__(self, name, log_level:str, logpath:pathlib.Path, max_bytes:int = 0, backup_count:int = 5, rate:float = 0.0): #初始化
         """
         :param name: 日志记录器名称
         :param log_level: 默认日志级别 level_name (str): 日志级别名称 ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
         :param logpath: 日志文件目录
+        :param max_bytes: 日志文件达到该大小(字节)时轮转,0为不轮转
+        :param backup_count: 轮转保留的文件数
+        :param rate: 每秒最多记录的条数(用于子进程输出等大量日志),0为不限制
         """
         self.logger = logging.getLogger(name)
         self.logger.setLevel(log_level)
+        self.logger.propagate = False
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
         # 确保只添加一个控制台处理程序
         self.console_handler = None
         # 初始化基础配置
         self._setup_base_config()
         self.add_file_handler(file_path=logpath, level=log_level)
+        if rate > 0:
+            self.logger.addFilter(RateLimitFilter(rate))
+
+    @classmethod
+    def from_config(cls, name, configfile: dict, rate_key: str = None):
+        """
+        按配置文件的[Log]节创建日志
+
+        :param name: 日志记录器名称
+        :param configfile: 已读取的配置
+        :param rate_key: [Log]中限流条数的键(如'OutputRate'),为None时不限流
+        """
+        log = configfile['Log']
+        return cls(name, log['Level'], pathlib.Path(log['File']), int(log.get('MaxBytes', 0)), int(log.get('BackupCount', 5)),
+                   float(log.get(rate_key, 0.0)) if rate_key else 0.0)
 
     def _setup_base_config(self):
         for handler in self.logger.handlers[:]:
             self.logger.removeHandler(handler) # 移除所有现有处理程序
+        for log_filter in self.logger.filters[:]:
+            self.logger.removeFilter(log_filter)
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s') # 格式化输出log
-        # 创建并配置控制台处理程序
+        # 创建并配置控制台处理程序(由日志文件的后台线程输出)
         self.console_handler = logging.StreamHandler(sys.stdout)
         self.console_handler.setFormatter(formatter)
-        self.logger.addHandler(self.console_handler)
 
     def add_file_handler(self, file_path, level=None): # 添加文件日志处理程序
-        file_handler = logging.FileHandler(file_path)
-        file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s : %(message)s')
-        file_handler.setFormatter(file_formatter)
-
-        if level:
-            file_handler.setLevel(getattr(logging, level, logging.INFO))
-
-        self.logger.addHandler(file_handler)
+        """同一日志文件只打开一次: 各记录器通过QueueHandler写入队列,由该文件唯一的后台线程写文件与控制台"""
+        key = os.path.abspath(str(file_path))
+        with _listeners_lock:
+            if key not in _listeners:
+                if self.max_bytes > 0:
+                    file_handler = logging.handlers.RotatingFileHandler(file_path, maxBytes=self.max_bytes, backupCount=self.backup_count)
+                else:
+                    file_handler = logging.FileHandler(file_path)
+                file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+                file_handler.setFormatter(file_formatter)
+                if level:
+                    file_handler.setLevel(getattr(logging, level, logging.INFO))
+                records = queue.SimpleQueue()
+                listener = logging.handlers.QueueListener(records, file_handler, self.console_handler, respect_handler_level=True)
+                listener.start()
+                _listeners[key] = (records, listener)
+            records, _ = _listeners[key]
+        self.logger.addHandler(logging.handlers.QueueHandler(records))
         self.logger.info("添加文件日志处理程序: %s", file_path)
 
     def __getattr__(self, name):
         # 将未定义的属性调用转发给self.logger
-        return getattr(self.logger, name)
\ No newline at end of file
+        return getattr(self.logger, name)
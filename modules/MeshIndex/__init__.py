@@ -0,0 +1,292 @@
+import os
+import numpy as np
+from ..FVCOMnetCDFReader import mesh_hash
+
+def element_neighbors(nv: np.ndarray):
+    """
+    由单元节点编号计算相邻单元表(向量化)
+
+    Parameters:
+    nv (np.ndarray): (nele, 3) 单元节点编号, 从0开始
+
+    Returns:
+    np.ndarray: (nele, 3) 第k列为与第k个节点相对的边的相邻单元, 边界为-1(与FVCOM的nbe约定一致)
+    """
+    nele = nv.shape[0]
+    # 与节点k相对的边由另外两个节点组成
+    a = np.concatenate([nv[:, 1], nv[:, 2], nv[:, 0]])
+    b = np.concatenate([nv[:, 2], nv[:, 0], nv[:, 1]])
+    keys = np.minimum(a, b).astype(np.int64)*(int(nv.max())+1) + np.maximum(a, b)
+    owner = np.tile(np.arange(nele), 3)
+    local = np.repeat(np.arange(3), nele)
+    order = np.argsort(keys, kind='stable')
+    keys, owner, local = keys[order], owner[order], local[order]
+    pair = np.flatnonzero(keys[1:] == keys[:-1])     # 内部边恰好出现两次
+    nbe = np.full((nele, 3), -1, dtype=np.int64)
+    nbe[owner[pair], local[pair]] = owner[pair+1]
+    nbe[owner[pair+1], local[pair+1]] = owner[pair]
+    return nbe
+
+def barycentric(px: np.ndarray, py: np.ndarray, tx: np.ndarray, ty: np.ndarray):
+    """
+    计算点在三角形中的重心坐标
+
+    Parameters:
+    px, py (np.ndarray): (n,) 点坐标
+    tx, ty (np.ndarray): (n, 3) 对应三角形顶点坐标
+
+    Returns:
+    np.ndarray: (n, 3) 重心坐标
+    """
+    x1, x2, x3 = tx[:, 0], tx[:, 1], tx[:, 2]
+    y1, y2, y3 = ty[:, 0], ty[:, 1], ty[:, 2]
+    det = (y2-y3)*(x1-x3) + (x3-x2)*(y1-y3)
+    l1 = ((y2-y3)*(px-x3) + (x3-x2)*(py-y3))/det
+    l2 = ((y3-y1)*(px-x3) + (x1-x3)*(py-y3))/det
+    return np.stack([l1, l2, 1.0-l1-l2], axis=1)
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray):
+    """将若干[start, start+count)区间展开为一维索引(向量化)"""
+    total = int(counts.sum())
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+
+def morton_code(x: np.ndarray, y: np.ndarray, bits: int = 16):
+    """
+    二维Morton(Z序)编码: 将坐标在包围盒内量化为bits位整数后按位交错,编码相近的点在空间上也相近
+
+    Parameters:
+    x, y (np.ndarray): (n,) 坐标
+    bits (int): 每个方向的量化位数(不超过32)
+
+    Returns:
+    np.ndarray: (n,) uint64 编码
+    """
+    def spread(value):  # 在相邻位之间插入0
+        value = value.astype(np.uint64)
+        for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                            (2, 0x3333333333333333), (1, 0x5555555555555555)):
+            value = (value | (value << np.uint64(shift))) & np.uint64(mask)
+        return value
+    scale = (1 << bits) - 1
+    def quantize(value):
+        span = value.max() - value.min()
+        return np.round((value - value.min())/(span if span > 0 else 1.0)*scale)
+    return spread(quantize(np.asarray(x, dtype=float))) | (spread(quantize(np.asarray(y, dtype=float))) << np.uint64(1))
+
+class FVCOMMeshIndex: # FVCOM非结构网格的点-单元定位索引(均匀分桶网格 + 三角形行走)
+    VERSION = 1
+    EPSILON = 1e-10     # 重心坐标容差,落在边上的点视为在单元内
+
+    def __init__(self, node_x: np.ndarray, node_y: np.ndarray, nv: np.ndarray, nbe: np.ndarray = None, elements_per_bucket: float = 1.0):
+        """
+        建立索引
+
+        Parameters:
+        node_x, node_y (np.ndarray): 节点坐标(经纬度或投影坐标,需与查询点一致)
+        nv (np.ndarray): (nele, 3) 单元节点编号, 从0开始
+        nbe (np.ndarray): (nele, 3) 相邻单元表, 从0开始, 边界为-1; 为None时由nv计算
+        elements_per_bucket (float): 平均每个桶中的单元数
+        """
+        self.node_x = np.asarray(node_x, dtype=np.float64)
+        self.node_y = np.asarray(node_y, dtype=np.float64)
+        self.nv = np.asarray(nv, dtype=np.int64)
+        self.nbe = element_neighbors(self.nv) if nbe is None else np.asarray(nbe, dtype=np.int64)
+        self.tri_x = self.node_x[self.nv]      # (nele, 3) 单元顶点坐标
+        self.tri_y = self.node_y[self.nv]
+        self.build_buckets(elements_per_bucket)
+
+    @property
+    def nele(self):
+        return self.nv.shape[0]
+
+    @property
+    def centroids(self):
+        """单元中心坐标"""
+        return self.tri_x.mean(axis=1), self.tri_y.mean(axis=1)
+
+    def element_order(self):
+        """单元中心的Morton编码,按其排序即得到空间上连续的单元顺序"""
+        return morton_code(*self.centroids)
+
+    def build_buckets(self, elements_per_bucket: float):
+        """按单元包围盒将单元分入均匀网格桶(CSR存储)"""
+        self.x0, self.x1 = float(self.node_x.min()), float(self.node_x.max())
+        self.y0, self.y1 = float(self.node_y.min()), float(self.node_y.max())
+        width = max(self.x1-self.x0, 1e-12)
+        height = max(self.y1-self.y0, 1e-12)
+        n_buckets = max(1.0, self.nele/elements_per_bucket)
+        self.bucket_size = float(np.sqrt(width*height/n_buckets))
+        self.nx = max(1, int(np.ceil(width/self.bucket_size)))
+        self.ny = max(1, int(np.ceil(height/self.bucket_size)))
+        i0, j0 = self.bucket_of(self.tri_x.min(axis=1), self.tri_y.min(axis=1))
+        i1, j1 = self.bucket_of(self.tri_x.max(axis=1), self.tri_y.max(axis=1))
+        span_i = i1-i0+1
+        counts = span_i*(j1-j0+1)
+        owner = np.repeat(np.arange(self.nele), counts)
+        offset = expand_ranges(np.zeros(self.nele, dtype=np.int64), counts)
+        bucket = (j0[owner] + offset//span_i[owner])*self.nx + i0[owner] + offset % span_i[owner]
+        order = np.argsort(bucket, kind='stable')
+        self.bucket_elements = owner[order]
+        self.bucket_start = np.searchsorted(bucket[order], np.arange(self.nx*self.ny+1))
+
+    def bucket_of(self, px: np.ndarray, py: np.ndarray):
+        """点所在桶的行列号(截断到网格范围内)"""
+        i = np.clip(((px-self.x0)/self.bucket_size).astype(np.int64), 0, self.nx-1)
+        j = np.clip(((py-self.y0)/self.bucket_size).astype(np.int64), 0, self.ny-1)
+        return i, j
+
+    def locate(self, px, py, chunk_size: int = 1000000):
+        """
+        批量定位点所在单元
+
+        Parameters:
+        px, py (array_like): 点坐标
+        chunk_size (int): 每批处理的点数,用于限制内存
+
+        Returns:
+        np.ndarray: 单元编号(从0开始), 网格外为-1
+        """
+        px = np.atleast_1d(np.asarray(px, dtype=np.float64))
+        py = np.atleast_1d(np.asarray(py, dtype=np.float64))
+        element = np.full(px.size, -1, dtype=np.int64)
+        for start in range(0, px.size, chunk_size):
+            stop = min(start+chunk_size, px.size)
+            element[start:stop] = self.locate_chunk(px[start:stop], py[start:stop])
+        return element
+
+    def locate_chunk(self, px: np.ndarray, py: np.ndarray):
+        """单批点的定位: 逐轮检查所在桶中的第k个候选单元,已定位的点不再参与后续轮次"""
+        element = np.full(px.size, -1, dtype=np.int64)
+        inside = (px >= self.x0) & (px <= self.x1) & (py >= self.y0) & (py <= self.y1)
+        point = np.flatnonzero(inside)
+        i, j = self.bucket_of(px[point], py[point])
+        bucket = j*self.nx + i
+        first = self.bucket_start[bucket]
+        n_candidates = self.bucket_start[bucket+1] - first
+        k = 0
+        while point.size:
+            keep = n_candidates > k
+            point, first, n_candidates = point[keep], first[keep], n_candidates[keep]
+            candidate = self.bucket_elements[first+k]
+            hit = self.contains(px[point], py[point], candidate)
+            element[point[hit]] = candidate[hit]
+            point, first, n_candidates = point[~hit], first[~hit], n_candidates[~hit]
+            k += 1
+        return element
+
+    def contains(self, px: np.ndarray, py: np.ndarray, element: np.ndarray):
+        """判断点是否位于对应单元内(含边界)"""
+        tx = self.tri_x[element]
+        ty = self.tri_y[element]
+        x3, y3 = tx[:, 2], ty[:, 2]
+        a, b = ty[:, 1]-y3, x3-tx[:, 1]
+        c, d = y3-ty[:, 0], tx[:, 0]-x3
+        det = a*(tx[:, 0]-x3) + b*(ty[:, 0]-y3)
+        dx, dy = px-x3, py-y3
+        l1 = (a*dx + b*dy)/det
+        l2 = (c*dx + d*dy)/det
+        return (l1 >= -self.EPSILON) & (l2 >= -self.EPSILON) & (1.0-l1-l2 >= -self.EPSILON)
+
+    def walk(self, px: np.ndarray, py: np.ndarray, element: np.ndarray, max_iterations: int = 100):
+        """
+        从已知单元沿相邻单元逐步查找点所在单元(向量化三角形行走),
+        适用于粒子每步移动距离较小的情况; 未收敛或走到网格边界的点退回分桶查找
+        (非凸区域中终点可能仍在网格内,如越过岛屿或凹入的岸线)
+
+        Parameters:
+        px, py (np.ndarray): 点坐标
+        element (np.ndarray): 起始单元(如上一时刻所在单元)
+        max_iterations (int): 最大行走步数
+
+        Returns:
+        tuple: (单元编号,越出网格边界为-1; 所在单元内的重心坐标,越界为nan)
+        """
+        element = np.array(element, dtype=np.int64)
+        weights_all = np.full((px.size, 3), np.nan)
+        pending = np.arange(px.size)
+        boundary = []
+        for _ in range(max_iterations):
+            if pending.size == 0:
+                break
+            current = element[pending]
+            weights = barycentric(px[pending], py[pending], self.tri_x[current], self.tri_y[current])
+            k = np.argmin(weights, axis=1)
+            outside = weights[np.arange(pending.size), k] < -self.EPSILON
+            weights_all[pending[~outside]] = weights[~outside]
+            pending = pending[outside]
+            element[pending] = self.nbe[current[outside], k[outside]]
+            boundary.append(pending[element[pending] < 0])
+            pending = pending[element[pending] >= 0]
+        pending = np.concatenate([pending] + boundary)
+        if pending.size:
+            found = self.locate(px[pending], py[pending])
+            element[pending] = found
+            pending = pending[found >= 0]
+            weights_all[pending] = barycentric(px[pending], py[pending], self.tri_x[element[pending]], self.tri_y[element[pending]])
+        return element, weights_all
+
+    def save(self, path: str):
+        """保存索引(先写临时文件再替换)"""
+        tmp_file = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp_file, version=self.VERSION, node_x=self.node_x, node_y=self.node_y, nv=self.nv, nbe=self.nbe,
+                 bucket_elements=self.bucket_elements, bucket_start=self.bucket_start,
+                 grid=np.array([self.x0, self.x1, self.y0, self.y1, self.bucket_size, self.nx, self.ny]))
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """读取已保存的索引,版本不符时返回None"""
+        with np.load(path) as data:
+            if int(data['version']) != cls.VERSION:
+                return None
+            index = cls.__new__(cls)
+            index.node_x = data['node_x']
+            index.node_y = data['node_y']
+            index.nv = data['nv']
+            index.nbe = data['nbe']
+            index.bucket_elements = data['bucket_elements']
+            index.bucket_start = data['bucket_start']
+            x0, x1, y0, y1, bucket_size, nx, ny = data['grid']
+        index.x0, index.x1, index.y0, index.y1, index.bucket_size = float(x0), float(x1), float(y0), float(y1), float(bucket_size)
+        index.nx, index.ny = int(nx), int(ny)
+        index.tri_x = index.node_x[index.nv]
+        index.tri_y = index.node_y[index.nv]
+        return index
+
+    @classmethod
+    def from_dataset(cls, dataset, cart_shp: bool, cache_dir: str = None, logger=None, coordinates: tuple = None):
+        """
+        由FVCOM输出建立索引,按网格哈希缓存在磁盘上
+
+        Parameters:
+        dataset (FVCOMMultiFileDataset): FVCOM多文件数据集
+        cart_shp (bool): True使用x/y投影坐标, False使用lon/lat
+        cache_dir (str): 缓存目录, None时不缓存
+        logger: 日志记录器
+        coordinates (tuple): 节点坐标(node_x, node_y),如缓存网格文件中投影后的x/y; None时由数据集读取
+
+        Returns:
+        FVCOMMeshIndex: 网格索引
+        """
+        if coordinates is not None:
+            node_x, node_y = coordinates
+        else:
+            node_x = dataset.read_static('x' if cart_shp else 'lon')
+            node_y = dataset.read_static('y' if cart_shp else 'lat')
+        nv = dataset.read_static('nv')
+        cache_file = None
+        if cache_dir:
+            cache_file = os.path.join(cache_dir, 'mesh_index_{}_{}.npz'.format(mesh_hash(node_x, node_y, nv)[:16], 'xy' if cart_shp else 'lonlat'))
+            if os.path.exists(cache_file):
+                index = cls.load(cache_file)
+                if index is not None:
+                    if logger:
+                        logger.info('使用已缓存的网格索引: {}'.format(cache_file))
+                    return index
+        nbe = dataset.read_static('nbe').T - 1 if 'nbe' in dataset.variables else None
+        index = cls(node_x, node_y, nv.T - 1, nbe)
+        if cache_file:
+            index.save(cache_file)
+            if logger:
+                logger.info('网格索引已建立并缓存: {}'.format(cache_file))
+        return index
@@ -0,0 +1,285 @@
+import toml
+import os
+import warnings
+import netCDF4 as nc
+import numpy as np
+from datetime import datetime
+from ..Log import AppLogger
+from ..FVCOMnetCDFReader import FVCOMResultProcessor, get_cache_directory
+from ..MeshIndex import FVCOMMeshIndex, barycentric
+
+EARTH_RADIUS = 6371000.0    # 地球半径(米)
+PARTICLE_CHUNK = 500000     # 读取粒子文件时每次读取的粒子数
+RANDOM_WALK_MODES = {0: '无', 1: '水平', 2: '垂向', 3: '水平与垂向'}     # ptraj的IRW取值
+
+def read_particle_chunks(particle_file: str, chunk_size: int = PARTICLE_CHUNK):
+    """
+    分块读取粒子文件(首行为粒子数,之后每行: 编号 x y z),内存只与块大小有关
+
+    Parameters:
+    particle_file (str): 粒子文件
+    chunk_size (int): 每块的粒子数
+
+    Yields:
+    np.ndarray: (n,3) 编号, x, y
+    """
+    with open(particle_file, 'r') as fin:
+        fin.readline()                                              # 首行为粒子数
+        while True:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)       # 读到文件末尾时为空块
+                chunk = np.loadtxt(fin, dtype=float, usecols=[0,1,2], max_rows=chunk_size, ndmin=2)
+            if chunk.shape[0] == 0:
+                return
+            yield chunk
+            if chunk.shape[0] < chunk_size:
+                return
+
+class NumPyParticleTracker: # 纯NumPy向量化离线拉格朗日粒子追踪(RK4),与ptraj使用同一配置文件
+    def __init__(self, configfile: str, netcdf_data: FVCOMResultProcessor = None, mesh: FVCOMMeshIndex = None):
+        """
+        初始化追踪器
+
+        Parameters:
+        configfile (str): 配置文件路径(与ptraj相同的TOML配置)
+        netcdf_data (FVCOMResultProcessor): 已扫描的FVCOM输出,为None时重新读取(索引未变化时无需打开文件)
+        mesh (FVCOMMeshIndex): 已建立的网格定位索引(坐标系须与CART_SHP一致),为None时读取网格并建立
+        """
+        self.configfile = toml.load(configfile)
+        self.logger = AppLogger.from_config('LagrangianTracking(NumPy)', self.configfile)
+        self.netcdf_data = netcdf_data if netcdf_data is not None else FVCOMResultProcessor(configfile)
+
+        general = self.configfile['Lagrangian']['General']
+        self.inverse = general['Inverse']
+        self.directory = general['Directory']
+        self.casename = general['CaseName']
+        self.dragc = float(general['Dragc'])
+        self.rotate_angle = float(general['ROTATE_ANGLE'])
+        integration = self.configfile['Lagrangian']['TimeIntegration']
+        self.dti = float(integration['DTI'])
+        self.instp = float(integration['INSTP'])
+        self.dtout = float(integration['DTOUT'])
+        self.tdrift = int(integration['TDRIFT'])
+        start = self.configfile['Lagrangian']['StartTime']
+        self.start_time = datetime(int(start['YEARLAG']), int(start['MONTHLAG']), int(start['DAYLAG']), int(start['HOURLAG']))
+        io_location = self.configfile['Lagrangian']['IOLocation']
+        self.inpdir = io_location['INPDIR']
+        self.outdir = io_location['OUTDIR']
+        random_walk = self.configfile['Lagrangian']['RandomWalk']
+        self.irw = int(random_walk['IRW'])
+        if self.irw not in RANDOM_WALK_MODES:
+            self.logger.error('IRW只能为{}: {}'.format(', '.join('{}({})'.format(key, value) for key, value in RANDOM_WALK_MODES.items()), self.irw))
+            raise ValueError
+        if self.irw in (2, 3):
+            self.logger.warning('NumPy引擎只追踪单层(二维),IRW={}的垂向随机游走不施加'.format(self.irw))
+        self.dhor = float(random_walk['DHOR'])
+        self.dtrw = float(random_walk['DTRW'])
+        self.cart_shp = self.configfile['Lagrangian']['ProjectionControl']['CART_SHP']
+        engine = self.configfile['Lagrangian'].get('NumPyEngine', {})
+        self.layer = int(engine.get('Layer', 0))
+        self.rng = np.random.default_rng(engine.get('Seed', None))
+
+        self.mesh = mesh
+        self.dataset = None
+        self.window = None      # 内存中的两个时次: (全局时间索引, 节点u, 节点v) x 2
+        self.nodal_cache = None # 最近一次插值得到的节点速度: (时刻, 节点u, 节点v)
+
+    def run(self, particle_file: str = None, output_file: str = None):
+        """
+        运行追踪
+
+        Parameters:
+        particle_file (str): 粒子文件(首行为粒子数,之后每行: 编号 x y z),默认 INPDIR/particles.dat
+        output_file (str): 输出文件,默认 OUTDIR/{CaseName}_numpy.nc
+
+        Returns:
+        str: 输出文件路径
+        """
+        if particle_file is None:
+            particle_file = os.path.join(self.directory, self.inpdir, 'particles.dat')
+        if output_file is None:
+            output_file = os.path.join(self.directory, self.outdir, '{}_numpy.nc'.format(self.casename))
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+        self.logger.info('开始 - NumPy离线粒子追踪({})'.format('追溯' if self.inverse else '追踪'))
+        with self.netcdf_data.open_multifile_dataset() as self.dataset:
+            self.load_mesh()
+            particle_id, px, py = self.load_particles(particle_file)
+            element = self.mesh.locate(px, py)
+            active = element >= 0
+            if not np.all(active):
+                self.logger.warning('{}个粒子不在网格内,将不参与计算'.format(int(np.sum(~active))))
+
+            dt = -self.dti if self.inverse else self.dti
+            total_seconds = self.tdrift*self.instp
+            n_steps = int(round(total_seconds/self.dti))
+            steps_per_output = max(1, int(round(self.dtout*3600/self.dti)))
+            t = (np.datetime64(self.start_time, 'us') - self.dataset.start_time)/np.timedelta64(1, 's')
+            self.check_time_range(t, t + (n_steps*dt))
+            self.logger.info('积分步数:{}, 步长:{}秒, 每{}步输出一次, 粒子数:{}'.format(n_steps, self.dti, steps_per_output, px.size))
+
+            with nc.Dataset(output_file, 'w') as fout:
+                self.create_output(fout, particle_id)
+                self.write_output(fout, 0, 0.0, px, py, active)
+                i_out = 1
+                for i_step in range(1, n_steps+1):
+                    px, py, element, active = self.rk4_step(t, dt, px, py, element, active)
+                    if self.irw in (1, 3):     # 水平随机游走(垂向部分在初始化时已提示不施加)
+                        px, py, element, active = self.random_walk(t, dt, px, py, element, active)
+                    t += dt
+                    if i_step % steps_per_output == 0 or i_step == n_steps:
+                        self.write_output(fout, i_out, i_step*dt, px, py, active)
+                        i_out += 1
+                        self.logger.info('{:6d} / {:6d} finished (hours), 剩余有效粒子:{}'.format(int(abs(i_step*dt)//3600), int(total_seconds//3600), int(np.sum(active))))
+        self.dataset = None
+        self.window = None
+        self.nodal_cache = None
+        self.logger.info('结束 - NumPy离线粒子追踪, 输出: {}'.format(output_file))
+        return output_file
+
+    def load_mesh(self):
+        """读取网格并建立(或读取已缓存的)网格定位索引,已给定时直接使用"""
+        if self.mesh is None:
+            self.mesh = FVCOMMeshIndex.from_dataset(self.dataset, self.cart_shp, get_cache_directory(self.configfile), self.logger,
+                                                    self.netcdf_data.mesh_coordinates(self.cart_shp))
+        self.nv = self.mesh.nv
+        self.tri_x = self.mesh.tri_x
+        self.tri_y = self.mesh.tri_y
+        self.node_count = np.bincount(self.nv.ravel(), minlength=self.mesh.node_x.size).astype(np.float64)
+        self.node_count[self.node_count == 0] = 1.0
+        self.has_wind = 'uwind_speed' in self.dataset.variables and 'vwind_speed' in self.dataset.variables
+        if self.dragc != 0 and not self.has_wind:
+            self.logger.warning('FVCOM输出中缺少uwind_speed/vwind_speed,忽略风拖曳项')
+
+    def load_particles(self, particle_file: str):
+        """分块读取粒子初始位置(与拆分粒子相同的读取方式),只保留编号与水平坐标"""
+        particle_id, px, py = [], [], []
+        for chunk in read_particle_chunks(particle_file):
+            particle_id.append(chunk[:, 0].astype(np.int64))
+            px.append(chunk[:, 1].copy())
+            py.append(chunk[:, 2].copy())
+        if not particle_id:
+            self.logger.error('粒子文件中没有粒子: {}'.format(particle_file))
+            raise RuntimeError
+        return np.concatenate(particle_id), np.concatenate(px), np.concatenate(py)
+
+    def check_time_range(self, t_start: float, t_end: float):
+        """检查追踪时段是否在FVCOM输出时间范围内"""
+        t_max = (self.dataset.total_timesteps-1)*(self.dataset.time_step/np.timedelta64(1, 's'))
+        if not (0 <= min(t_start, t_end) and max(t_start, t_end) <= t_max):
+            self.logger.error('追踪时段超出FVCOM输出时间范围')
+            raise RuntimeError
+
+    def load_level(self, index: int):
+        """读取一个时次的漂移速度(流速+风拖曳),并由单元中心平均到节点"""
+        u = self.dataset.read('u', index, index+1, self.layer, slice(None))[0].astype(np.float64)
+        v = self.dataset.read('v', index, index+1, self.layer, slice(None))[0].astype(np.float64)
+        if self.has_wind and self.dragc != 0:
+            uw = self.dataset.read('uwind_speed', index, index+1, slice(None))[0]
+            vw = self.dataset.read('vwind_speed', index, index+1, slice(None))[0]
+            # 风向按ROTATE_ANGLE(度,顺时针为正)旋转
+            angle = np.deg2rad(self.rotate_angle)
+            u = u + self.dragc*(uw*np.cos(angle) + vw*np.sin(angle))
+            v = v + self.dragc*(-uw*np.sin(angle) + vw*np.cos(angle))
+        node_u = np.bincount(self.nv.ravel(), weights=np.repeat(u, 3), minlength=self.node_count.size)/self.node_count
+        node_v = np.bincount(self.nv.ravel(), weights=np.repeat(v, 3), minlength=self.node_count.size)/self.node_count
+        return index, node_u, node_v
+
+    def velocity_levels(self, t: float):
+        """保证内存中的两个时次覆盖时刻t,仅在越过时次时读取下一时次"""
+        step = self.dataset.time_step/np.timedelta64(1, 's')
+        lower = min(int(np.floor(t/step)), self.dataset.total_timesteps-2)
+        if self.window is None or self.window[0][0] != lower:
+            levels = {level[0]: level for level in (self.window or ())}
+            self.window = tuple(levels.get(i) or self.load_level(i) for i in (lower, lower+1))
+        return self.window, (t - lower*step)/step
+
+    def nodal_velocity(self, t: float):
+        """时刻t的节点漂移速度(两个时次间线性插值),同一时刻重复调用时直接复用"""
+        if self.nodal_cache is None or self.nodal_cache[0] != t:
+            (level_a, level_b), weight = self.velocity_levels(t)
+            self.nodal_cache = (t, (1-weight)*level_a[1] + weight*level_b[1], (1-weight)*level_a[2] + weight*level_b[2])
+        return self.nodal_cache[1], self.nodal_cache[2]
+
+    def velocity(self, t: float, py: np.ndarray, element: np.ndarray, weights: np.ndarray):
+        """时刻t粒子处的漂移速度(单元内重心坐标插值),返回坐标变化率"""
+        node_u, node_v = self.nodal_velocity(t)
+        nodes = self.nv[element]
+        u = np.einsum('ij,ij->i', weights, node_u[nodes])
+        v = np.einsum('ij,ij->i', weights, node_v[nodes])
+        if self.cart_shp:
+            return u, v
+        # 球坐标: 米/秒 -> 度/秒
+        return np.rad2deg(u/(EARTH_RADIUS*np.cos(np.deg2rad(py)))), np.rad2deg(v/EARTH_RADIUS)
+
+    def rk4_step(self, t: float, dt: float, px: np.ndarray, py: np.ndarray, element: np.ndarray, active: np.ndarray):
+        """对有效粒子做一步四阶Runge-Kutta积分,越出网格的粒子停留在原位置并失效"""
+        idx = np.flatnonzero(active)
+        x, y, e = px[idx], py[idx], element[idx]
+        alive = np.ones(idx.size, dtype=bool)
+
+        def stage(time, sx, sy):
+            se, weights = self.mesh.walk(sx, sy, e)
+            lost = se < 0
+            alive[lost] = False
+            se[lost] = e[lost]
+            weights[lost] = 1.0/3      # 越界粒子取原单元中心速度,本步结束后失效
+            return self.velocity(time, sy, se, weights)
+
+        k1x, k1y = self.velocity(t, y, e, barycentric(x, y, self.tri_x[e], self.tri_y[e]))
+        k2x, k2y = stage(t+dt/2, x+dt/2*k1x, y+dt/2*k1y)
+        k3x, k3y = stage(t+dt/2, x+dt/2*k2x, y+dt/2*k2y)
+        k4x, k4y = stage(t+dt, x+dt*k3x, y+dt*k3y)
+        nx = x + dt/6*(k1x + 2*k2x + 2*k3x + k4x)
+        ny = y + dt/6*(k1y + 2*k2y + 2*k3y + k4y)
+        ne, _ = self.mesh.walk(nx, ny, e)
+        alive &= ne >= 0
+        px, py, element, active = px.copy(), py.copy(), element.copy(), active.copy()
+        px[idx[alive]] = nx[alive]
+        py[idx[alive]] = ny[alive]
+        element[idx[alive]] = ne[alive]
+        active[idx[~alive]] = False
+        return px, py, element, active
+
+    def random_walk(self, t: float, dt: float, px: np.ndarray, py: np.ndarray, element: np.ndarray, active: np.ndarray):
+        """水平随机游走: 每DTRW秒施加一次 sqrt(2*DHOR*DTRW) 的随机位移,越出网格的位移被舍弃"""
+        n_kicks = abs(int(np.floor((t+dt)/self.dtrw)) - int(np.floor(t/self.dtrw)))
+        idx = np.flatnonzero(active)
+        if n_kicks == 0 or idx.size == 0:
+            return px, py, element, active
+        sigma = np.sqrt(2*self.dhor*self.dtrw*n_kicks)
+        dx = self.rng.standard_normal(idx.size)*sigma
+        dy = self.rng.standard_normal(idx.size)*sigma
+        if not self.cart_shp:
+            dx = np.rad2deg(dx/(EARTH_RADIUS*np.cos(np.deg2rad(py[idx]))))
+            dy = np.rad2deg(dy/EARTH_RADIUS)
+        nx, ny = px[idx]+dx, py[idx]+dy
+        ne, _ = self.mesh.walk(nx, ny, element[idx])
+        keep = ne >= 0
+        px, py, element = px.copy(), py.copy(), element.copy()
+        px[idx[keep]] = nx[keep]
+        py[idx[keep]] = ny[keep]
+        element[idx[keep]] = ne[keep]
+        return px, py, element, active
+
+    def create_output(self, fout: nc.Dataset, particle_id: np.ndarray):
+        """建立输出文件结构"""
+        fout.createDimension('time', None)
+        fout.createDimension('nlag', particle_id.size)
+        time = fout.createVariable('time', 'f8', ('time',))
+        time.units = 'seconds since {}'.format(self.start_time.strftime('%Y-%m-%d %H:%M:%S'))
+        fout.createVariable('particle_id', 'i8', ('nlag',))[:] = particle_id
+        units = 'm' if self.cart_shp else 'degree'
+        for name in ('x', 'y'):
+            variable = fout.createVariable(name, 'f8', ('time', 'nlag'), zlib=True)
+            variable.units = units
+        fout.createVariable('active', 'i1', ('time', 'nlag'), zlib=True)
+        fout.setncattr('inverse', int(self.inverse))
+        fout.setncattr('cart_shp', int(self.cart_shp))
+
+    def write_output(self, fout: nc.Dataset, i_out: int, seconds: float, px: np.ndarray, py: np.ndarray, active: np.ndarray):
+        """写入一个输出时次"""
+        fout.variables['time'][i_out] = seconds
+        fout.variables['x'][i_out, :] = px
+        fout.variables['y'][i_out, :] = py
+        fout.variables['active'][i_out, :] = active
@@ -0,0 +1,335 @@
+import os
+import collections
+import numpy as np
+import netCDF4 as nc
+from concurrent.futures import ProcessPoolExecutor
+
+EARTH_RADIUS = 6371000.0    # 地球半径(米)
+INVALID_POSITION = 1e30     # 绝对值超过该值的坐标视为缺测(填充值)
+
+_BINS = None                # 进程池各进程中的分箱对象,由init_worker设置
+
+def init_worker(bins):
+    """进程池初始化: 分箱对象(含网格索引)每个进程只传递一次"""
+    global _BINS
+    _BINS = bins
+
+def read_block(variable, time_axis: int, times: slice, particles: slice):
+    """
+    读取(时间, 粒子)块,轨迹变量的维度顺序为 (time, particle) 或 (particle, time)
+
+    Returns:
+    np.ndarray: (时次数, 粒子数)
+    """
+    index = [0]*variable.ndim
+    index[time_axis] = times
+    index[1-time_axis] = particles
+    data = np.asarray(variable[tuple(index)], dtype=np.float64)
+    return data if time_axis == 0 else data.T
+
+def time_axis_of(src: nc.Dataset, name: str):
+    """
+    轨迹变量中时间维的位置: 合并文件的粒子维为particle,其余情况取无限长或名为time的维度,默认第一维
+
+    Returns:
+    int: 0或1
+    """
+    dimensions = src.variables[name].dimensions
+    if 'particle' in dimensions:
+        return 1 - dimensions.index('particle')
+    for axis, dim in enumerate(dimensions):
+        if dim.lower() == 'time' or src.dimensions[dim].isunlimited():
+            return axis
+    return 0
+
+def valid_positions(x: np.ndarray, y: np.ndarray):
+    """坐标有效(非填充值、非nan)"""
+    return np.isfinite(x) & np.isfinite(y) & (np.abs(x) < INVALID_POSITION) & (np.abs(y) < INVALID_POSITION)
+
+def bin_time_chunk(path: str, names: tuple, start: int, stop: int, particle_chunk: int):
+    """
+    统计时次[start, stop)内各分箱的粒子数: 按粒子分块读取,以 时次*分箱数+分箱 为键做一次bincount
+
+    Parameters:
+    path (str): 轨迹文件
+    names (tuple): (x变量名, y变量名, 有效标记变量名或None)
+    start, stop (int): 时次范围
+    particle_chunk (int): 每次读取的粒子数
+
+    Returns:
+    tuple: (start, (时次数, 分箱数) 粒子数)
+    """
+    x_name, y_name, active_name = names
+    num_times, num_bins = stop-start, _BINS.size
+    counts = np.zeros(num_times*num_bins, dtype=np.int64)
+    with nc.Dataset(path, 'r') as src:
+        src.set_auto_mask(False)
+        x_var, y_var = src.variables[x_name], src.variables[y_name]
+        time_axis = time_axis_of(src, x_name)
+        num_particles = x_var.shape[1-time_axis]
+        offsets = (np.arange(num_times, dtype=np.int64)*num_bins)[:, None]
+        for first in range(0, num_particles, particle_chunk):
+            particles = slice(first, min(first+particle_chunk, num_particles))
+            x = read_block(x_var, time_axis, slice(start, stop), particles)
+            y = read_block(y_var, time_axis, slice(start, stop), particles)
+            valid = valid_positions(x, y)
+            if active_name is not None:
+                valid &= read_block(src.variables[active_name], time_axis, slice(start, stop), particles) > 0
+            cell = _BINS.locate_steps(x, y, valid)
+            keys = (offsets + cell)[cell >= 0]
+            counts += np.bincount(keys, minlength=counts.size)
+    return start, counts.reshape(num_times, num_bins)
+
+class ElementBins: # 以FVCOM单元为分箱,由网格定位索引确定粒子所在单元
+    def __init__(self, mesh, cart_shp: bool):
+        """
+        :param mesh: FVCOMMeshIndex网格定位索引
+        :param cart_shp: True为投影坐标(米), False为经纬度
+        """
+        self.mesh = mesh
+        self.size = mesh.nele
+        tri_x, tri_y = mesh.tri_x, mesh.tri_y
+        area = 0.5*np.abs((tri_x[:, 1]-tri_x[:, 0])*(tri_y[:, 2]-tri_y[:, 0]) - (tri_x[:, 2]-tri_x[:, 0])*(tri_y[:, 1]-tri_y[:, 0]))
+        if not cart_shp:    # 度² -> 米²
+            area = area*np.deg2rad(1.0)**2*EARTH_RADIUS**2*np.cos(np.deg2rad(tri_y.mean(axis=1)))
+        self.area = area
+        self.center_x, self.center_y = mesh.centroids
+
+    def locate_steps(self, x: np.ndarray, y: np.ndarray, valid: np.ndarray):
+        """
+        连续时次的粒子所在单元: 首个时次分桶定位,之后由上一时次的单元沿相邻单元行走(相邻输出时次间粒子移动距离较小)
+
+        Returns:
+        np.ndarray: (时次数, 粒子数) 单元编号,无效或网格外为-1
+        """
+        cell = np.full(x.shape, -1, dtype=np.int64)
+        previous = np.full(x.shape[1], -1, dtype=np.int64)
+        for step in range(x.shape[0]):
+            current = valid[step]
+            walk = current & (previous >= 0)
+            search = current & ~walk
+            cell[step, walk], _ = self.mesh.walk(x[step, walk], y[step, walk], previous[walk])
+            cell[step, search] = self.mesh.locate(x[step, search], y[step, search])
+            previous = np.where(current, cell[step], previous)
+        return cell
+
+class GridBins: # 以规则网格为分箱,粒子所在格点直接由坐标计算
+    def __init__(self, bounds: list, resolution: float, cart_shp: bool):
+        """
+        :param bounds: [xmin, ymin, xmax, ymax]
+        :param resolution: 格距(与坐标单位相同)
+        :param cart_shp: True为投影坐标(米), False为经纬度
+        """
+        self.x0, self.y0, x1, y1 = [float(value) for value in bounds]
+        self.resolution = float(resolution)
+        self.nx = max(1, int(np.ceil((x1-self.x0)/self.resolution)))
+        self.ny = max(1, int(np.ceil((y1-self.y0)/self.resolution)))
+        self.size = self.nx*self.ny
+        self.x = self.x0 + (np.arange(self.nx)+0.5)*self.resolution
+        self.y = self.y0 + (np.arange(self.ny)+0.5)*self.resolution
+        area = np.full((self.ny, self.nx), self.resolution**2)
+        if not cart_shp:
+            area = area*np.deg2rad(1.0)**2*EARTH_RADIUS**2*np.cos(np.deg2rad(self.y))[:, None]
+        self.area = area.ravel()
+
+    def locate_steps(self, x: np.ndarray, y: np.ndarray, valid: np.ndarray):
+        """粒子所在格点,无效或范围外为-1"""
+        i = np.floor((np.where(valid, x, self.x0)-self.x0)/self.resolution).astype(np.int64)
+        j = np.floor((np.where(valid, y, self.y0)-self.y0)/self.resolution).astype(np.int64)
+        inside = valid & (i >= 0) & (i < self.nx) & (j >= 0) & (j < self.ny)
+        return np.where(inside, j*self.nx + i, -1)
+
+class TrajectoryPostProcessor: # 由轨迹文件流式计算粒子密度、滞留时间与源-汇连通矩阵
+    def __init__(self, tracker, settings: dict):
+        """
+        :param tracker: LagrangianTracking_FVCOMOffline实例(提供日志、输出目录、追踪方向、输出间隔与网格)
+        :param settings: 配置文件的PostProcessing节
+        """
+        self.tracker = tracker
+        self.logger = tracker.logger
+        self.settings = settings
+        self.x_name, self.y_name = settings.get('Variables', ['x', 'y'])
+        self.time_chunk = max(1, int(settings.get('TimeChunk', 24)))
+        self.particle_chunk = max(1, int(settings.get('ParticleChunk', 250000)))
+        self.workers = max(1, int(settings.get('Workers', 1)))
+
+    def output_file(self):
+        """结果文件: PostProcessing.Output,留空为 OUTDIR/{CaseName}_density.nc"""
+        tracker = self.tracker
+        return self.settings.get('Output', '') or os.path.join(tracker.directory, tracker.outdir, f"{tracker.casename}_density.nc")
+
+    def bounds(self):
+        """规则网格与区域划分的范围: PostProcessing.Bounds,留空为FVCOM网格范围"""
+        bounds = self.settings.get('Bounds', [])
+        if bounds:
+            return [float(value) for value in bounds]
+        mesh = self.tracker.load_mesh()
+        return [mesh.x0, mesh.y0, mesh.x1, mesh.y1]
+
+    def create_bins(self):
+        """按PostProcessing.Bins建立分箱(element: FVCOM单元, grid: 规则网格)"""
+        mode = self.settings.get('Bins', 'element')
+        if mode == 'element':
+            return ElementBins(self.tracker.load_mesh(), self.tracker.cart_shp)
+        elif mode == 'grid':
+            return GridBins(self.bounds(), float(self.settings.get('Resolution', 0.01)), self.tracker.cart_shp)
+        self.logger.error('未知的分箱方式: {}'.format(mode))
+        raise ValueError
+
+    def regions(self):
+        """
+        连通矩阵的区域: PostProcessing.Regions,留空时将范围均分为RegionGrid个区域
+
+        Returns:
+        np.ndarray: (区域数, 4) 各区域的 [xmin, ymin, xmax, ymax]
+        """
+        regions = self.settings.get('Regions', [])
+        if regions:
+            return np.array(regions, dtype=np.float64).reshape(-1, 4)
+        nx, ny = [int(value) for value in self.settings.get('RegionGrid', [4, 4])]
+        xmin, ymin, xmax, ymax = self.bounds()
+        xs, ys = np.linspace(xmin, xmax, nx+1), np.linspace(ymin, ymax, ny+1)
+        j, i = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+        return np.stack([xs[i.ravel()], ys[j.ravel()], xs[i.ravel()+1], ys[j.ravel()+1]], axis=1)
+
+    @staticmethod
+    def region_of(x: np.ndarray, y: np.ndarray, regions: np.ndarray):
+        """粒子所在区域(按顺序取第一个包含它的区域),不在任何区域内为区域数"""
+        region = np.full(x.size, regions.shape[0], dtype=np.int64)
+        unassigned = valid_positions(x, y)
+        for i_region, (xmin, ymin, xmax, ymax) in enumerate(regions):
+            inside = unassigned & (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+            region[inside] = i_region
+            unassigned &= ~inside
+        return region
+
+    def connectivity(self, src: nc.Dataset, time_axis: int, num_times: int, regions: np.ndarray, inverse: bool):
+        """
+        源区域 -> 汇区域的粒子数: 由首末时次的位置确定(追溯时首时次为汇、末时次为源),最后一行/列为区域外
+
+        Returns:
+        np.ndarray: (区域数+1, 区域数+1)
+        """
+        x_var, y_var = src.variables[self.x_name], src.variables[self.y_name]
+        num_particles = x_var.shape[1-time_axis]
+        size = regions.shape[0] + 1
+        matrix = np.zeros(size*size, dtype=np.int64)
+        for first in range(0, num_particles, self.particle_chunk):
+            particles = slice(first, min(first+self.particle_chunk, num_particles))
+            ends = [self.region_of(read_block(x_var, time_axis, slice(step, step+1), particles)[0],
+                                   read_block(y_var, time_axis, slice(step, step+1), particles)[0], regions)
+                    for step in (0, num_times-1)]
+            source, destination = ends[::-1] if inverse else ends
+            matrix += np.bincount(source*size + destination, minlength=matrix.size)
+        return matrix.reshape(size, size)
+
+    def chunk_results(self, path: str, names: tuple, num_times: int, bins):
+        """逐个时间块的粒子数(按时间顺序),Workers大于1时由进程池并行计算"""
+        starts = list(range(0, num_times, self.time_chunk))
+        stops = [min(start+self.time_chunk, num_times) for start in starts]
+        if self.workers == 1 or len(starts) == 1:
+            init_worker(bins)
+            for start, stop in zip(starts, stops):
+                yield bin_time_chunk(path, names, start, stop, self.particle_chunk)
+            return
+        # 同时提交的时间块不超过进程数的两倍,已完成但尚未写出的结果占用的内存有上限
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(starts)), initializer=init_worker, initargs=(bins,)) as pool:
+            pending = collections.deque()
+            for start, stop in zip(starts, stops):
+                pending.append(pool.submit(bin_time_chunk, path, names, start, stop, self.particle_chunk))
+                if len(pending) >= 2*self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def create_output(self, dst: nc.Dataset, bins, regions: np.ndarray, num_times: int):
+        """建立结果文件结构: 规则网格为(time, y, x),单元为(time, nele)"""
+        dst.createDimension('time', num_times)
+        if isinstance(bins, GridBins):
+            dst.createDimension('y', bins.ny)
+            dst.createDimension('x', bins.nx)
+            cell_dims = ('y', 'x')
+            dst.createVariable('x', 'f8', ('x',))[:] = bins.x
+            dst.createVariable('y', 'f8', ('y',))[:] = bins.y
+        else:
+            dst.createDimension('nele', bins.size)
+            cell_dims = ('nele',)
+            dst.createVariable('xc', 'f8', ('nele',))[:] = bins.center_x
+            dst.createVariable('yc', 'f8', ('nele',))[:] = bins.center_y
+        shape = [len(dst.dimensions[dim]) for dim in cell_dims]
+        area = dst.createVariable('area', 'f8', cell_dims)
+        area.units = 'm2'
+        area[...] = bins.area.reshape(shape)
+        count = dst.createVariable('count', 'i4', ('time',)+cell_dims, zlib=True, chunksizes=[1]+shape)
+        count.long_name = 'number of particles'
+        concentration = dst.createVariable('concentration', 'f4', ('time',)+cell_dims, zlib=True, chunksizes=[1]+shape)
+        concentration.long_name = 'particles per unit area'
+        concentration.units = 'm-2'
+        residence = dst.createVariable('residence_time', 'f8', cell_dims)
+        residence.long_name = 'mean time spent in cell per particle'
+        residence.units = 'hours'
+        dst.createDimension('region', regions.shape[0])
+        dst.createDimension('bound', 4)
+        dst.createDimension('source', regions.shape[0]+1)
+        dst.createDimension('destination', regions.shape[0]+1)
+        dst.createVariable('region_bounds', 'f8', ('region', 'bound'))[:] = regions
+        matrix = dst.createVariable('connectivity', 'i8', ('source', 'destination'))
+        matrix.long_name = 'particles from source region to destination region, last index is outside all regions'
+        dst.createVariable('connectivity_probability', 'f8', ('source', 'destination'))
+        return cell_dims, shape
+
+    def run(self, path: str):
+        """
+        流式计算并写入结果文件: 各时次各分箱的粒子数与浓度、各分箱的平均滞留时间、源-汇连通矩阵
+
+        Parameters:
+        path (str): 轨迹文件(合并文件或NumPy引擎输出)
+
+        Returns:
+        str: 结果文件路径
+        """
+        output_file = self.output_file()
+        self.logger.info(f"开始 - 轨迹后处理: {path}")
+        bins = self.create_bins()
+        regions = self.regions()
+        with nc.Dataset(path, 'r') as src:
+            src.set_auto_mask(False)
+            for name in (self.x_name, self.y_name):
+                if name not in src.variables:
+                    self.logger.error('{}中没有坐标变量{}'.format(path, name))
+                    raise RuntimeError
+            x_var = src.variables[self.x_name]
+            time_axis = time_axis_of(src, self.x_name)
+            num_times, num_particles = x_var.shape[time_axis], x_var.shape[1-time_axis]
+            active_name = 'active' if 'active' in src.variables else None
+            inverse = bool(int(src.getncattr('inverse'))) if 'inverse' in src.ncattrs() else bool(self.tracker.inverse)
+            matrix = self.connectivity(src, time_axis, num_times, regions, inverse)
+            times = src.variables['time'] if 'time' in src.variables else None
+            self.logger.info('粒子数 {}, 输出时次 {}, 分箱 {}, 区域 {}, 进程 {}'.format(
+                num_particles, num_times, bins.size, regions.shape[0], self.workers))
+
+            os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+            tmp_file = output_file + '.tmp'
+            with nc.Dataset(tmp_file, 'w', format='NETCDF4') as dst:
+                dst.setncattr('source_file', os.path.abspath(path))
+                dst.setncattr('inverse', int(inverse))
+                cell_dims, shape = self.create_output(dst, bins, regions, num_times)
+                if times is not None and times.ndim == 1 and times.shape[0] == num_times:
+                    out = dst.createVariable('time', times.dtype, ('time',))
+                    out.setncatts({attr: times.getncattr(attr) for attr in times.ncattrs() if attr != '_FillValue'})
+                    out[:] = times[:]
+                residence = np.zeros(bins.size, dtype=np.float64)
+                for start, counts in self.chunk_results(path, (self.x_name, self.y_name, active_name), num_times, bins):
+                    stop = start + counts.shape[0]
+                    dst.variables['count'][start:stop] = counts.reshape([-1]+shape)
+                    dst.variables['concentration'][start:stop] = (counts/bins.area).reshape([-1]+shape)
+                    residence += counts.sum(axis=0)
+                    self.logger.debug('已处理时次 {}-{}/{}'.format(start, stop, num_times))
+                # 平均滞留时间: 各输出时次的粒子数乘以输出间隔,除以粒子总数
+                dst.variables['residence_time'][...] = (residence*float(self.tracker.dtout)/max(num_particles, 1)).reshape(shape)
+                dst.variables['connectivity'][...] = matrix
+                totals = matrix.sum(axis=1, keepdims=True)
+                dst.variables['connectivity_probability'][...] = matrix/np.where(totals > 0, totals, 1)
+        os.replace(tmp_file, output_file)
+        self.logger.info(f"结束 - 轨迹后处理结果已写入: {output_file}")
+        return output_file
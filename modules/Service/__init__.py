@@ -0,0 +1,470 @@
+import os
+import copy
+import glob
+import json
+import uuid
+import time
+import signal
+import socket
+import shutil
+import asyncio
+import multiprocessing
+import toml
+from datetime import datetime
+from ..Log import AppLogger, stop_listeners, restart_listeners
+from ..FVCOMnetCDFReader import FVCOMResultProcessor, get_cache_directory
+from ..MeshIndex import FVCOMMeshIndex
+from ..LagrangianTracking import LagrangianTracking_FVCOMOffline, configure_run
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+JOB_PARAMETERS = ('starttime', 'endtime', 'geoarea', 'casename', 'lagini', 'dragc', 'rotation_angle', 'cart_shp',
+                  'threads', 'workers', 'engine', 'particles')     # 与main.py的命令行参数相同,另加粒子文件particles
+FINISHED_STATES = ('done', 'failed')
+
+def write_json(path: str, data: dict):
+    """先写临时文件再替换,读取方不会看到写了一半的文件"""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as fout:
+        json.dump(data, fout, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, path)
+
+def read_json(path: str):
+    """读取JSON文件,不存在或不完整时返回None"""
+    try:
+        with open(path, 'r', encoding='utf-8') as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return None
+
+def describe_error(error: BaseException):
+    """作业记录中的错误说明: 异常类型与信息"""
+    message = str(error)
+    return '{}: {}'.format(type(error).__name__, message) if message else type(error).__name__
+
+def send_request(socket_path: str, request: dict):
+    """
+    向常驻服务发送一条请求并返回响应(均为一行JSON)
+
+    Parameters:
+    socket_path (str): 服务的UNIX套接字
+    request (dict): 请求,command为 submit(附params)、status(附job)、wait(附job, 可选timeout秒)或 list
+
+    Returns:
+    dict: 响应, ok为False时error为原因
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request, ensure_ascii=False)+'\n').encode('utf-8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    return json.loads(response.decode('utf-8'))
+
+def spool_submit(spool: str, params: dict, name: str = None):
+    """
+    以文件方式提交作业: 先写临时文件再改名为 {name}.json,服务扫描提交目录时不会读到写了一半的文件
+
+    Returns:
+    str: 作业文件路径,状态写入 {spool}/status/{name}.json
+    """
+    name = name or '{}_{}'.format(datetime.now().strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:6])
+    os.makedirs(spool, exist_ok=True)
+    path = os.path.join(spool, name + '.json')
+    tmp_file = os.path.join(spool, '.' + name + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as fout:
+        json.dump(params, fout, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, path)
+    return path
+
+def run_job_process(configfile: str, netcdf_data: FVCOMResultProcessor, mesh: FVCOMMeshIndex, executable: str, result_file: str):
+    """
+    作业子进程: 由服务fork产生,直接继承已扫描的时间索引、网格索引与已编译的ptraj,运行追踪后将结果写入result_file
+    """
+    # 恢复默认信号处理,子进程收到的信号不转发给服务的事件循环
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # 继承的记录器(时间索引、网格索引等)仍指向服务进程的日志队列,改由本进程的后台线程写出
+    restart_listeners()
+    try:
+        tracker = LagrangianTracking_FVCOMOffline(configfile, run=False, netcdf_data=netcdf_data)
+        tracker.mesh = mesh
+        result = {'state': 'done', 'products': tracker.run(executable)}
+    except KeyboardInterrupt:      # 服务停止时收到SIGTERM,ptraj进程组已终止
+        result = {'state': 'failed', 'error': '作业被终止'}
+    except BaseException as error:
+        result = {'state': 'failed', 'error': describe_error(error)}
+    finally:
+        stop_listeners()
+    write_json(result_file, result)
+
+class TrackingService: # 常驻追踪服务: FVCOM时间索引、网格索引与已编译的ptraj常驻内存,经UNIX套接字或提交目录接收作业
+    def __init__(self, configfile: str):
+        """
+        初始化服务并读取FVCOM输出的时间索引
+
+        Parameters:
+        configfile (str): 基础配置文件路径,各作业在其基础上按作业参数修改
+        """
+        self.configpath = configfile
+        self.configfile = toml.load(configfile)
+        self.logger = AppLogger.from_config('TrackingService', self.configfile)
+        # 原地修复会在作业运行(读取FVCOM输出)期间修改文件,并使文件签名在每次扫描后变化
+        if self.configfile['FVCOMOutputDirectory'].get('Harmonize', 'off') == 'inplace':
+            self.logger.error('常驻服务不支持FVCOMOutputDirectory.Harmonize = "inplace",请先用main.py修复或改为"check"')
+            raise ValueError
+        settings = self.configfile.get('Service', {})
+        general = self.configfile['Lagrangian']['General']
+        self.directory = general['Directory']
+        self.casename = general['CaseName']
+        self.inpdir = self.configfile['Lagrangian']['IOLocation']['INPDIR']
+        self.outdir = self.configfile['Lagrangian']['IOLocation']['OUTDIR']
+        self.root = os.path.join(self.directory, 'service')
+        self.socket_path = settings.get('Socket', '') or os.path.join(self.root, 'service.sock')
+        self.spool = settings.get('Spool', '') or os.path.join(self.root, 'spool')
+        self.workers = max(1, int(settings.get('Workers', 2)))
+        self.queue_size = max(1, int(settings.get('QueueSize', 64)))
+        self.poll_interval = float(settings.get('PollInterval', 1.0))
+        self.preload = settings.get('Preload', True)
+        self.context = multiprocessing.get_context('fork')
+        self.jobs = {}          # 作业编号 -> 作业记录(与status.json相同)
+        self.events = {}        # 作业编号 -> 结束事件(wait请求等待)
+        self.processes = {}     # 作业编号 -> 运行中的子进程
+        self.queue = None
+        self.warm_lock = None   # 准备常驻数据与fork互斥: fork时父进程中没有打开的NetCDF文件与进行中的编译
+        self.stopping = False
+        self.netcdf_data = None
+        self.signature = None   # FVCOM输出文件的(路径, 大小, 修改时间),变化时重新读取时间索引
+        self.meshes = {}        # 投影坐标 -> 网格定位索引
+        self.executables = {}   # (追溯, 投影坐标) -> 已编译的ptraj
+        self.refresh()
+
+    def refresh(self):
+        """FVCOM输出目录的文件有增减或变化时重新读取时间索引(只扫描新增/变化的文件),网格索引随之重新建立"""
+        directory = self.configfile['FVCOMOutputDirectory']['Directory']
+        if self.signature is not None and self.signature == self.file_signature(directory):
+            return
+        self.logger.info('开始 - 读取指定目录下netCDF文件')
+        self.netcdf_data = FVCOMResultProcessor(self.configpath)
+        self.logger.info('结束 - 读取指定目录下netCDF文件')
+        self.signature = self.file_signature(directory)     # 服务只允许Harmonize为'off'或'check',扫描不修改文件
+        self.meshes = {}
+
+    @staticmethod
+    def file_signature(directory: str):
+        signature = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.nc'))):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+        return signature
+
+    def warm(self, inverse: bool, cart_shp: bool, engine: str):
+        """
+        准备(已有时直接复用)作业所需的网格定位索引与ptraj可执行文件
+
+        Returns:
+        tuple: (网格定位索引, ptraj可执行文件; numpy引擎为None)
+        """
+        if cart_shp not in self.meshes:
+            coordinates = self.netcdf_data.mesh_coordinates(cart_shp)
+            with self.netcdf_data.open_multifile_dataset() as dataset:
+                self.meshes[cart_shp] = FVCOMMeshIndex.from_dataset(dataset, cart_shp, get_cache_directory(self.configfile), self.logger,
+                                                                    coordinates)
+        if engine != 'ptraj':
+            return self.meshes[cart_shp], None
+        mode = (inverse, cart_shp)
+        if mode not in self.executables:
+            tracker = LagrangianTracking_FVCOMOffline(self.configpath, run=False, netcdf_data=self.netcdf_data)
+            tracker.inverse, tracker.cart_shp = inverse, cart_shp
+            self.executables[mode] = tracker.compile_ptraj()
+        return self.meshes[cart_shp], self.executables[mode]
+
+    def preload_modes(self):
+        """Service.Preload为真时,启动时即准备基础配置坐标系下追踪与追溯两种模式"""
+        general = self.configfile['Lagrangian']['General']
+        cart_shp = bool(self.configfile['Lagrangian']['ProjectionControl']['CART_SHP'])
+        for inverse in (False, True):
+            self.warm(inverse, cart_shp, general.get('Engine', 'ptraj'))
+
+    def setup_job(self, job: dict):
+        """
+        建立作业目录(与集合成员相同: 链接基础INPDIR中的文件、独立的OUTDIR与日志),按作业参数写入配置
+
+        Returns:
+        tuple: (作业配置文件路径, 配置)
+        """
+        directory = job['directory']
+        params = job['params']
+        inpdir = os.path.join(directory, self.inpdir)
+        os.makedirs(inpdir, exist_ok=True)
+        os.makedirs(os.path.join(directory, self.outdir), exist_ok=True)
+
+        data = copy.deepcopy(self.configfile)
+        configure_run(data, params, self.netcdf_data, self.logger)
+        general = data['Lagrangian']['General']
+        general['Directory'] = directory
+        data['Log']['File'] = os.path.join(directory, 'log')
+        if params.get('workers') is None and int(data['General'].get('Workers', 0)) == 0:
+            # 同时运行的作业平分CPU
+            data['General']['Workers'] = max(1, (os.cpu_count() or 1)//self.workers)
+
+        # 链接基础INPDIR中的FVCOM输出与粒子文件(作业给出粒子文件时复制该文件),拆分生成的子算例文件各作业独立
+        base_inpdir = os.path.abspath(os.path.join(self.directory, self.inpdir))
+        particles = params.get('particles')
+        for name in os.listdir(base_inpdir):
+            if name.startswith(self.casename+'_') or name.startswith(general['CaseName']+'_') or name.startswith('pbs'):
+                continue
+            if particles is not None and name == 'particles.dat':
+                continue
+            link = os.path.join(inpdir, name)
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(base_inpdir, name), link)
+        if particles is not None:
+            shutil.copyfile(particles, os.path.join(inpdir, 'particles.dat'))
+
+        configfile = os.path.join(directory, 'config.toml')
+        with open(configfile, 'w', encoding='utf-8') as fout:
+            toml.dump(data, fout)
+        return configfile, data
+
+    def prepare_job(self, job: dict):
+        """刷新时间索引、建立作业目录并准备常驻数据"""
+        self.refresh()
+        configfile, data = self.setup_job(job)
+        general = data['Lagrangian']['General']
+        mesh, executable = self.warm(bool(general['Inverse']), bool(data['Lagrangian']['ProjectionControl']['CART_SHP']),
+                                     general.get('Engine', 'ptraj'))
+        return configfile, mesh, executable
+
+    def update(self, job: dict, **fields):
+        """更新作业记录并写入 {作业目录}/status.json(由提交目录提交的作业同时写入 {Spool}/status/{文件名}.json)"""
+        job.update(fields)
+        write_json(os.path.join(job['directory'], 'status.json'), job)
+        if job.get('spool'):
+            write_json(os.path.join(self.spool, 'status', job['spool'] + '.json'), job)
+        if job['state'] in FINISHED_STATES and job['id'] in self.events:
+            self.events[job['id']].set()
+
+    def submit(self, params: dict, source: str, spool: str = None):
+        """
+        检查作业参数并加入队列
+
+        Parameters:
+        params (dict): 作业参数,键与main.py的命令行参数相同(starttime与endtime必需),另可给出粒子文件particles
+        source (str): 提交方式, 'socket' 或 'spool'
+        spool (str): 提交目录中的作业文件名(不含.json)
+
+        Returns:
+        dict: 作业记录
+        """
+        if not isinstance(params, dict):
+            raise ValueError('作业参数须为JSON对象')
+        unknown = sorted(set(params) - set(JOB_PARAMETERS))
+        if unknown:
+            raise ValueError('未知的作业参数: {}'.format(unknown))
+        missing = [name for name in ('starttime', 'endtime') if params.get(name) is None]
+        if missing:
+            raise ValueError('缺少作业参数: {}'.format(missing))
+        for name in ('starttime', 'endtime'):
+            datetime.strptime(params[name], TIME_FORMAT)
+        if params.get('particles') is not None and not os.path.isfile(params['particles']):
+            raise ValueError('粒子文件不存在: {}'.format(params['particles']))
+        if self.stopping:
+            raise ValueError('服务正在停止')
+        if self.queue.full():
+            raise ValueError('作业队列已满({}个)'.format(self.queue_size))
+        job_id = '{}_{}'.format(datetime.now().strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:6])
+        job = {'id': job_id, 'state': 'queued', 'source': source, 'spool': spool, 'params': params,
+               'directory': os.path.join(self.root, 'jobs', job_id), 'submitted': datetime.now().strftime(TIME_FORMAT)}
+        os.makedirs(job['directory'], exist_ok=True)
+        self.jobs[job_id] = job
+        self.events[job_id] = asyncio.Event()
+        self.update(job)
+        self.queue.put_nowait(job)
+        self.logger.info('收到作业{}({}): {} 至 {}, 排队{}个'.format(job_id, source, params['starttime'], params['endtime'], self.queue.qsize()))
+        return job
+
+    def recover(self):
+        """重新加入上次服务停止时仍在排队的作业,运行中被中断的作业标记为失败"""
+        for status_file in sorted(glob.glob(os.path.join(self.root, 'jobs', '*', 'status.json'))):
+            job = read_json(status_file)
+            if job is None or job.get('id') in self.jobs:
+                continue
+            self.jobs[job['id']] = job
+            self.events[job['id']] = asyncio.Event()
+            if job['state'] == 'running':
+                self.update(job, state='failed', error='服务停止时作业仍在运行')
+            elif job['state'] == 'queued':
+                if self.queue.full():
+                    self.update(job, state='failed', error='服务重启时作业队列已满')
+                else:
+                    self.queue.put_nowait(job)
+                    self.logger.info('重新加入排队的作业{}'.format(job['id']))
+            else:
+                self.events[job['id']].set()
+
+    async def run_job(self, job: dict):
+        """在fork出的子进程中运行一个作业(准备常驻数据与fork在锁内完成),结束后记录状态与结果"""
+        result_file = os.path.join(job['directory'], 'result.json')
+        if os.path.exists(result_file):
+            os.remove(result_file)
+        started = time.monotonic()
+        try:
+            async with self.warm_lock:
+                configfile, mesh, executable = await asyncio.to_thread(self.prepare_job, job)
+                process = self.context.Process(target=run_job_process, name='job-{}'.format(job['id']),
+                                               args=(configfile, self.netcdf_data, mesh, executable, result_file))
+                process.start()
+        except Exception as error:
+            self.logger.error('作业{}准备失败: {}'.format(job['id'], describe_error(error)))
+            self.update(job, state='failed', error=describe_error(error),
+                        finished=datetime.now().strftime(TIME_FORMAT))
+            return
+        self.processes[job['id']] = process
+        self.update(job, state='running', pid=process.pid, config=configfile, log=os.path.join(job['directory'], 'log'),
+                    started=datetime.now().strftime(TIME_FORMAT))
+        self.logger.info('开始 - 作业{}(进程{}), 准备用时{:.2f}秒'.format(job['id'], process.pid, time.monotonic()-started))
+        await self.wait_process(process)
+        del self.processes[job['id']]
+        result = read_json(result_file) or {'state': 'failed', 'error': '作业进程异常退出(返回值{})'.format(process.exitcode)}
+        self.update(job, finished=datetime.now().strftime(TIME_FORMAT), seconds=round(time.monotonic()-started, 3), **result)
+        if job['state'] == 'done':
+            self.logger.info('结束 - 作业{}, 用时{:.2f}秒, 结果: {}'.format(job['id'], job['seconds'], job.get('products')))
+        else:
+            self.logger.error('作业{}运行失败: {}, 日志: {}'.format(job['id'], job.get('error'), job['log']))
+
+    @staticmethod
+    async def wait_process(process):
+        """在事件循环中等待子进程结束(监听其sentinel),不占用线程"""
+        loop = asyncio.get_running_loop()
+        exited = asyncio.Event()
+        loop.add_reader(process.sentinel, exited.set)
+        try:
+            await exited.wait()
+        finally:
+            loop.remove_reader(process.sentinel)
+        process.join()
+
+    async def worker(self, running: set):
+        """从队列中依次领取作业; 服务停止时未开始的作业保持排队状态,重启后继续"""
+        while True:
+            job = await self.queue.get()
+            if self.stopping:
+                continue
+            task = asyncio.create_task(self.run_job(job))
+            running.add(task)
+            try:
+                await task
+            finally:
+                running.discard(task)
+
+    async def watch_spool(self):
+        """按间隔扫描提交目录中的 *.json 作业文件: 接受的移入accepted/,无效的移入rejected/; 队列已满时留待下次扫描"""
+        for name in ('accepted', 'rejected', 'status'):
+            os.makedirs(os.path.join(self.spool, name), exist_ok=True)
+        while True:
+            for path in sorted(glob.glob(os.path.join(self.spool, '*.json'))):
+                if self.queue.full():
+                    break
+                name = os.path.splitext(os.path.basename(path))[0]
+                params = read_json(path)
+                try:
+                    job = self.submit(params, 'spool', name)
+                except (ValueError, TypeError) as error:
+                    self.logger.warning('提交目录中的作业文件{}无效: {}'.format(path, error))
+                    os.replace(path, os.path.join(self.spool, 'rejected', os.path.basename(path)))
+                    write_json(os.path.join(self.spool, 'status', name + '.json'), {'state': 'rejected', 'error': str(error)})
+                    continue
+                os.replace(path, os.path.join(self.spool, 'accepted', job['id'] + '.json'))
+            await asyncio.sleep(self.poll_interval)
+
+    async def handle_request(self, request: dict):
+        command = request.get('command')
+        if command == 'submit':
+            return {'ok': True, 'job': self.submit(request.get('params'), 'socket')}
+        if command == 'list':
+            return {'ok': True, 'jobs': [{key: job.get(key) for key in ('id', 'state', 'submitted', 'seconds')} for job in self.jobs.values()]}
+        if command in ('status', 'wait'):
+            job_id = request.get('job')
+            if job_id not in self.jobs:
+                raise ValueError('未知的作业: {}'.format(job_id))
+            if command == 'wait':
+                try:
+                    await asyncio.wait_for(self.events[job_id].wait(), request.get('timeout'))
+                except asyncio.TimeoutError:
+                    pass
+            return {'ok': True, 'job': self.jobs[job_id]}
+        raise ValueError('未知的请求: {}'.format(command))
+
+    async def handle_client(self, reader, writer):
+        """每个连接一条请求、一条响应(各为一行JSON)"""
+        try:
+            request = json.loads((await reader.readline()).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('请求须为JSON对象')
+            response = await self.handle_request(request)
+        except (ValueError, TypeError) as error:
+            response = {'ok': False, 'error': str(error)}
+        try:
+            writer.write((json.dumps(response, ensure_ascii=False)+'\n').encode('utf-8'))
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.queue_size)
+        self.warm_lock = asyncio.Lock()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            try:
+                send_request(self.socket_path, {'command': 'list'})
+            except OSError:
+                os.remove(self.socket_path)     # 上次未正常停止留下的套接字
+            else:
+                self.logger.error('服务已在运行: {}'.format(self.socket_path))
+                raise RuntimeError
+        if self.preload:
+            self.logger.info('开始 - 预先准备网格索引与ptraj')
+            async with self.warm_lock:
+                await asyncio.to_thread(self.preload_modes)
+            self.logger.info('结束 - 预先准备网格索引与ptraj')
+        self.recover()
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        running = set()
+        tasks = [asyncio.create_task(self.worker(running)) for _ in range(self.workers)]
+        tasks.append(asyncio.create_task(self.watch_spool()))
+        self.logger.info('追踪服务已启动: 套接字 {}, 提交目录 {}, 同时运行{}个作业, 队列上限{}个'.format(
+            self.socket_path, self.spool, self.workers, self.queue_size))
+        try:
+            await stop.wait()
+        finally:
+            self.logger.info('开始 - 停止追踪服务, 终止{}个运行中的作业'.format(len(self.processes)))
+            self.stopping = True
+            server.close()
+            for process in list(self.processes.values()):
+                process.terminate()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.logger.info('结束 - 停止追踪服务')
+
+    def serve(self):
+        """运行服务,直到收到SIGINT/SIGTERM: 运行中的作业被终止并记为失败,排队的作业在下次启动时继续"""
+        asyncio.run(self.main())
@@ -0,0 +1,230 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+import netCDF4 as nc
+from datetime import datetime, timedelta
+from ..FVCOMnetCDFReader import FVCOMResultProcessor, get_cache_directory
+
+SUBSET_BLOCK = 24       # 裁剪时每次读写的时次数
+
+def tracking_window(tracker, dataset):
+    """
+    追踪时段覆盖的全局时间索引: 起点取不晚于开始的时次,终点取不早于结束的时次,并沿追踪方向多留一个时次
+
+    Parameters:
+    tracker: LagrangianTracking_FVCOMOffline实例(提供起止时间与追踪方向)
+    dataset (FVCOMMultiFileDataset): FVCOM多文件数据集
+
+    Returns:
+    tuple: (首个时次, 末个时次)
+    """
+    start = datetime(int(tracker.yearlag), int(tracker.monthlag), int(tracker.daylag), int(tracker.hourlag))
+    end = start + (-1 if tracker.inverse else 1)*timedelta(seconds=float(tracker.tdrift)*float(tracker.instp))
+    last_index = len(dataset) - 1
+    def floor(time):
+        offset = (np.datetime64(time, 'us') - dataset.start_time)/dataset.time_step
+        return int(np.floor(offset))
+    def ceil(time):
+        offset = (np.datetime64(time, 'us') - dataset.start_time)/dataset.time_step
+        return int(np.ceil(offset))
+    if tracker.inverse:     # 追溯: 向较早的时间多留一个时次
+        first, last = floor(end) - 1, ceil(start)
+    else:
+        first, last = floor(start), ceil(end) + 1
+    if last < 0 or first > last_index:
+        tracker.logger.error('追踪时段 {} - {} 不在FVCOM输出时间范围内'.format(min(start, end), max(start, end)))
+        raise RuntimeError
+    return max(first, 0), min(last, last_index)
+
+class FVCOMInputStager: # 为单次追踪准备输入目录: 只链接与追踪时段重叠的FVCOM输出,可选裁剪为子区域
+    def __init__(self, tracker, settings: dict):
+        """
+        :param tracker: LagrangianTracking_FVCOMOffline实例(提供日志、运行目录、起止时间、网格与粒子范围)
+        :param settings: 配置文件的Lagrangian.Staging节
+        """
+        self.tracker = tracker
+        self.logger = tracker.logger
+        self.settings = settings
+        self.inpdir = os.path.join(tracker.directory, tracker.inpdir)
+        self.directory = os.path.join(tracker.directory, self.relative_directory(tracker, settings))
+
+    @staticmethod
+    def relative_directory(tracker, settings: dict):
+        """分阶段输入目录(相对于Lagrangian.General.Directory,写入namelist的INPDIR)"""
+        return settings.get('Directory', '') or f"{tracker.casename}_INPDIR"
+
+    def time_window(self, dataset):
+        """追踪时段(含余量)覆盖的全局时间索引,见tracking_window"""
+        return tracking_window(self.tracker, dataset)
+
+    def select_files(self):
+        """
+        与追踪时段(含余量)重叠的FVCOM输出文件
+
+        Returns:
+        list: 文件路径(按时间顺序)
+        """
+        if self.tracker.netcdf_data is None:
+            self.tracker.netcdf_data = FVCOMResultProcessor(self.tracker.configpath)
+        with self.tracker.netcdf_data.open_multifile_dataset() as dataset:
+            first, last = self.time_window(dataset)
+            files = [dataset.files[i_file] for i_file in np.unique(dataset.file_of_index[first:last+1])]
+            self.logger.info('追踪时段覆盖时次 {} - {},需要{}/{}个FVCOM输出文件'.format(
+                dataset.index_to_time(first), dataset.index_to_time(last), len(files), len(dataset.files)))
+        return files
+
+    def subset_bounds(self):
+        """
+        子区域范围: Lagrangian.Staging.Bounds,未给定时为粒子范围外扩Buffer(与网格坐标单位相同)
+
+        Returns:
+        list: [xmin, ymin, xmax, ymax]
+        """
+        bounds = self.settings.get('Bounds', [])
+        if bounds:
+            return [float(value) for value in bounds]
+        if self.tracker.particle_bounds is None:
+            self.logger.error('没有粒子范围,无法确定子区域,请设置Lagrangian.Staging.Bounds')
+            raise RuntimeError
+        buffer = float(self.settings.get('Buffer', 0.5))
+        xmin, ymin, xmax, ymax = self.tracker.particle_bounds
+        return [xmin-buffer, ymin-buffer, xmax+buffer, ymax+buffer]
+
+    def subset_mesh(self, bounds: list):
+        """
+        选出单元中心位于范围内的单元及其节点
+
+        Returns:
+        tuple: (节点序号, 单元序号),均为0起始且升序
+        """
+        mesh = self.tracker.load_mesh()
+        xmin, ymin, xmax, ymax = bounds
+        center_x, center_y = mesh.tri_x.mean(axis=1), mesh.tri_y.mean(axis=1)
+        elements = np.flatnonzero((center_x >= xmin) & (center_x <= xmax) & (center_y >= ymin) & (center_y <= ymax))
+        if elements.size == 0:
+            self.logger.error('子区域 {} 内没有网格单元'.format(bounds))
+            raise RuntimeError
+        nodes = np.unique(mesh.nv[elements])
+        self.logger.info('子区域 {}: 单元 {}/{}, 节点 {}/{}'.format(
+            [round(value, 4) for value in bounds], elements.size, mesh.nv.shape[0], nodes.size, mesh.node_x.size))
+        return nodes, elements
+
+    def subset_file(self, path: str, nodes: np.ndarray, elements: np.ndarray, variables: list, key: str):
+        """
+        将一个FVCOM输出裁剪为子区域与所需变量,写入缓存目录(同一文件、范围与变量只写一次);
+        nv按子区域重新编号,nbe中位于子区域外的相邻单元记为0(开边界)
+
+        Returns:
+        str: 裁剪后的文件路径
+        """
+        stat = os.stat(path)
+        digest = hashlib.sha1('{}:{}:{}:{}'.format(os.path.realpath(path), stat.st_size, stat.st_mtime_ns, key).encode('utf-8')).hexdigest()[:16]
+        output = os.path.join(get_cache_directory(self.tracker.configfile), 'staged', digest, os.path.basename(path))
+        if os.path.exists(output):
+            return output
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        node_map = np.zeros(self.tracker.load_mesh().node_x.size + 1, dtype=np.int64)
+        node_map[nodes+1] = np.arange(1, nodes.size+1)          # 原编号(1起始) -> 新编号,子区域外为0
+        element_map = np.zeros(self.tracker.load_mesh().nv.shape[0] + 1, dtype=np.int64)
+        element_map[elements+1] = np.arange(1, elements.size+1)
+        subsets = {'node': nodes, 'nele': elements}
+        tmp_file = output + '.tmp'
+        with nc.Dataset(path, 'r') as src, nc.Dataset(tmp_file, 'w', format=src.data_model) as dst:
+            src.set_auto_mask(False)
+            dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+            dst.setncattr('staged_from', os.path.realpath(path))
+            for name, dim in src.dimensions.items():
+                dst.createDimension(name, None if dim.isunlimited() else (subsets[name].size if name in subsets else len(dim)))
+            for name in variables:
+                if name not in src.variables:
+                    continue
+                var = src.variables[name]
+                fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                filters = var.filters() or {}
+                out = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value, zlib=bool(filters.get('zlib')),
+                                         complevel=int(filters.get('complevel') or 4))
+                out.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs() if attr != '_FillValue'})
+                # 子区域维度先读取连续范围再在内存中抽取,避免逐点读取
+                axes = [(axis, subsets[dim]) for axis, dim in enumerate(var.dimensions) if dim in subsets]
+                time_axis = var.dimensions.index('time') if 'time' in var.dimensions else None
+                num_times = var.shape[time_axis] if time_axis is not None else 1
+                for start in range(0, num_times, SUBSET_BLOCK):
+                    index = [slice(None)]*var.ndim
+                    if time_axis is not None:
+                        index[time_axis] = slice(start, min(start+SUBSET_BLOCK, num_times))
+                    for axis, subset in axes:
+                        index[axis] = slice(int(subset[0]), int(subset[-1])+1)
+                    data = np.asarray(var[tuple(index)])
+                    for axis, subset in axes:
+                        data = np.take(data, subset-subset[0], axis=axis)
+                    if name == 'nv':
+                        data = node_map[data]
+                    elif name == 'nbe':
+                        data = element_map[data]
+                    out_index = [slice(None)]*var.ndim
+                    if time_axis is not None:
+                        out_index[time_axis] = index[time_axis]
+                    out[tuple(out_index)] = data
+        os.replace(tmp_file, output)
+        return output
+
+    def link(self, target: str, link: str):
+        """建立(或替换)符号链接"""
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.abspath(target), link)
+
+    def mirror(self, source: str, destination: str, archive_dir: str, archive_files: set):
+        """
+        将原INPDIR中的非FVCOM输出条目(粒子文件、子算例文件等)链接到分阶段目录,
+        FVCOM输出所在的目录逐级重建,其中的FVCOM输出文件不链接(由stage按时段加入)
+        """
+        os.makedirs(destination, exist_ok=True)
+        for entry in os.scandir(source):
+            real = os.path.realpath(entry.path)
+            target = os.path.join(destination, entry.name)
+            if real in archive_files:
+                continue
+            if entry.is_dir() and os.path.commonpath([real, archive_dir]) == real:
+                self.mirror(entry.path, target, archive_dir, archive_files)
+            else:
+                self.link(entry.path, target)
+
+    def stage(self):
+        """
+        建立分阶段输入目录 {Directory}/{Lagrangian.Staging.Directory}: 保持原INPDIR的目录结构,
+        只包含与追踪时段重叠的FVCOM输出(链接,或Subset为真时链接到裁剪后的文件)
+
+        Returns:
+        str: 分阶段输入目录
+        """
+        self.logger.info(f"开始 - 准备分阶段输入目录: {self.directory}")
+        files = self.select_files()
+        archive_dir = os.path.realpath(self.tracker.configfile['FVCOMOutputDirectory']['Directory'])
+        archive_files = {os.path.realpath(path) for path in self.tracker.netcdf_data.fvcom_files}
+        if os.path.lexists(self.directory):
+            shutil.rmtree(self.directory)   # 只含链接与目录,不会删除链接指向的文件
+        self.mirror(self.inpdir, self.directory, archive_dir, archive_files)
+
+        # FVCOM输出在原INPDIR中的相对位置,不在INPDIR下时放在分阶段目录的顶层
+        inpdir = os.path.realpath(self.inpdir)
+        if os.path.commonpath([inpdir, archive_dir]) == inpdir:
+            staged_archive = os.path.join(self.directory, os.path.relpath(archive_dir, inpdir))
+        else:
+            self.logger.warning('FVCOM输出目录 {} 不在INPDIR下,分阶段目录中放在顶层'.format(archive_dir))
+            staged_archive = self.directory
+        if self.settings.get('Subset', False):
+            bounds = self.subset_bounds()
+            nodes, elements = self.subset_mesh(bounds)
+            variables = list(self.settings.get('Variables', []))
+            key = '{}:{}'.format(bounds, sorted(variables))
+            for i_file, path in enumerate(files):
+                self.link(self.subset_file(path, nodes, elements, variables, key), os.path.join(staged_archive, os.path.basename(path)))
+                self.logger.debug('已裁剪 {}/{}: {}'.format(i_file+1, len(files), path))
+        else:
+            for path in files:
+                self.link(path, os.path.join(staged_archive, os.path.basename(path)))
+        self.logger.info(f"结束 - 分阶段输入目录包含{len(files)}个FVCOM输出文件")
+        return self.directory
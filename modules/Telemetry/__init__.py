@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+def peak_rss(pid: int):
+    """
+    进程的峰值常驻内存(字节),读取/proc/<pid>/status的VmHWM
+
+    Returns:
+    int: 峰值内存,进程已结束或无法读取时为None
+    """
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as fin:
+            for line in fin:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class RunTelemetry: # 粒子追踪运行遥测: 各子算例的模拟速度、剩余时间、返回值与峰值内存
+    def __init__(self, tasks: list, logger, interval: float = 30.0, jsonl_file: str = None, prometheus_file: str = None):
+        """
+        :param tasks: 任务列表(与run_tasks相同)
+        :param logger: 日志
+        :param interval: 汇总进度写入日志与快照的最小间隔(秒)
+        :param jsonl_file: JSON-lines快照文件,为None时不写
+        :param prometheus_file: Prometheus textfile collector文件,为None时不写
+        """
+        self.logger = logger
+        self.interval = interval
+        self.jsonl_file = jsonl_file
+        self.prometheus_file = prometheus_file
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_emit = None
+        self.progress_sum = 0.0     # 各子算例进度(0-1)之和,增量更新
+        self.shards = [{
+            'idx': task['idx'],
+            'case': task['case'],
+            'member': task.get('member'),
+            'state': 'pending',
+            'status': None,
+            'attempts': 0,
+            'pid': None,
+            'started': None,
+            'elapsed': 0.0,
+            'hours_done': 0,
+            'hours_total': None,
+            'progress': 0.0,
+            'rate': None,           # 模拟小时/墙钟秒
+            'eta': None,            # 剩余秒数
+            'returncode': None,
+            'peak_rss': None,
+        } for task in tasks]
+
+    @property
+    def progress(self):
+        """总体进度(百分比)"""
+        return 100.0*self.progress_sum/max(len(self.shards), 1)
+
+    def start(self, i_task: int, pid: int):
+        """记录子算例(重新)启动,重试时进度从0开始"""
+        with self.lock:
+            shard = self.shards[i_task]
+            self.progress_sum -= shard['progress']
+            shard.update(state='running', pid=pid, started=time.monotonic(), attempts=shard['attempts']+1,
+                         hours_done=0, progress=0.0, rate=None, eta=None, returncode=None, status=None)
+
+    def sample(self, i_task: int):
+        """无输出时采样运行中子算例的峰值内存"""
+        with self.lock:
+            shard = self.shards[i_task]
+            rss = peak_rss(shard['pid']) if shard['state'] == 'running' else None
+            if rss is not None:
+                shard['peak_rss'] = max(rss, shard['peak_rss'] or 0)
+
+    def update(self, i_task: int, hours_done: int, hours_total: int):
+        """记录子算例的进度行(已模拟小时/总小时),按间隔输出汇总"""
+        now = time.monotonic()
+        with self.lock:
+            shard = self.shards[i_task]
+            progress = hours_done/hours_total if hours_total > 0 else 0.0
+            self.progress_sum += progress - shard['progress']
+            shard.update(hours_done=hours_done, hours_total=hours_total, progress=progress, elapsed=now-shard['started'])
+            if shard['elapsed'] > 0 and hours_done > 0:
+                shard['rate'] = hours_done/shard['elapsed']
+                shard['eta'] = (hours_total-hours_done)/shard['rate']
+            rss = peak_rss(shard['pid'])
+            if rss is not None:
+                shard['peak_rss'] = max(rss, shard['peak_rss'] or 0)
+        self.maybe_emit(now)
+
+    def finish(self, i_task: int, returncode: int, rss: int = None, status: str = None):
+        """记录子算例结束: 返回值、状态(done/failed/timeout/stalled,默认由返回值判断)与峰值内存"""
+        now = time.monotonic()
+        status = status or ('done' if returncode == 0 else 'failed')
+        with self.lock:
+            shard = self.shards[i_task]
+            self.progress_sum += (1.0 if status == 'done' else shard['progress']) - shard['progress']
+            shard.update(state='done' if status == 'done' else 'failed', status=status, returncode=returncode,
+                         elapsed=now-shard['started'], eta=0.0 if status == 'done' else None)
+            if status == 'done':
+                shard['progress'] = 1.0
+            if rss is not None:
+                shard['peak_rss'] = max(rss, shard['peak_rss'] or 0)
+        if status != 'done':
+            self.logger.warning('[{:02d}] {} 异常结束({}),返回值 {}'.format(shard['idx'], shard['case'], status, returncode))
+        self.maybe_emit(now)
+
+    def maybe_emit(self, now: float = None, force: bool = False):
+        """距上次输出超过interval(或force)时,写入汇总日志与快照"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if not force and self.last_emit is not None and now - self.last_emit < self.interval:
+                return
+            self.last_emit = now
+            snapshot = self.snapshot(now)
+        running = [shard for shard in snapshot['shards'] if shard['state'] == 'running']
+        message = '总体进度: {:.1f}%, 运行中 {}, 完成 {}, 失败 {}'.format(
+            snapshot['progress'], snapshot['running'], snapshot['done'], snapshot['failed'])
+        if snapshot['eta'] is not None:
+            message += ', 预计剩余 {:.0f} 秒'.format(snapshot['eta'])
+        if running:
+            slowest = min(running, key=lambda shard: shard['progress'])
+            message += ', 最慢 [{:02d}] {} {:.1f}%'.format(slowest['idx'], slowest['case'], 100*slowest['progress'])
+        self.logger.info(message)
+        self.write(snapshot)
+
+    def snapshot(self, now: float = None):
+        """当前状态的快照(调用方持有锁)"""
+        now = time.monotonic() if now is None else now
+        shards = []
+        for shard in self.shards:
+            shard = dict(shard)
+            if shard['state'] == 'running':
+                shard['elapsed'] = now - shard['started']
+            shard.pop('started')
+            shards.append(shard)
+        states = [shard['state'] for shard in shards]
+        etas = [shard['eta'] for shard in shards if shard['state'] == 'running' and shard['eta'] is not None]
+        elapsed = now - self.started
+        progress = self.progress
+        # 剩余时间: 运行中子算例的最大剩余时间,尚有排队任务时按总体速度外推
+        if states.count('pending') and progress > 0:
+            eta = elapsed*(100.0-progress)/progress
+        else:
+            eta = max(etas) if etas else None
+        return {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'elapsed': elapsed,
+            'progress': progress,
+            'eta': eta,
+            'pending': states.count('pending'),
+            'running': states.count('running'),
+            'done': states.count('done'),
+            'failed': states.count('failed'),
+            'shards': shards,
+        }
+
+    def write(self, snapshot: dict):
+        """追加JSON-lines快照并(原子地)更新Prometheus文件"""
+        if self.jsonl_file:
+            with open(self.jsonl_file, 'a') as fout:
+                fout.write(json.dumps(snapshot, ensure_ascii=False)+'\n')
+        if self.prometheus_file:
+            lines = [
+                '# HELP ptraj_progress_percent Overall tracking progress.',
+                '# TYPE ptraj_progress_percent gauge',
+                'ptraj_progress_percent {:.3f}'.format(snapshot['progress']),
+                '# HELP ptraj_shards Number of shards by state.',
+                '# TYPE ptraj_shards gauge',
+            ]
+            for state in ('pending', 'running', 'done', 'failed'):
+                lines.append('ptraj_shards{{state="{}"}} {}'.format(state, snapshot[state]))
+            metrics = (('progress', 'ptraj_shard_progress_ratio', 'Shard progress (0-1).'),
+                       ('rate', 'ptraj_shard_rate_hours_per_second', 'Simulated hours per wall-clock second.'),
+                       ('eta', 'ptraj_shard_eta_seconds', 'Estimated remaining seconds.'),
+                       ('peak_rss', 'ptraj_shard_peak_rss_bytes', 'Peak resident set size (VmHWM).'),
+                       ('returncode', 'ptraj_shard_exit_code', 'Exit code of finished shards.'))
+            for key, name, doc in metrics:
+                lines.append('# HELP {} {}'.format(name, doc))
+                lines.append('# TYPE {} gauge'.format(name))
+                for shard in snapshot['shards']:
+                    if shard[key] is not None:
+                        labels = 'case="{}"'.format(shard['case'])
+                        if shard['member'] is not None:
+                            labels += ',member="{}"'.format(shard['member'])
+                        lines.append('{}{{{}}} {}'.format(name, labels, shard[key]))
+            tmp_file = self.prometheus_file + '.tmp'
+            with open(tmp_file, 'w') as fout:
+                fout.write('\n'.join(lines)+'\n')
+            os.replace(tmp_file, self.prometheus_file)
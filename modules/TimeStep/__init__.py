@@ -0,0 +1,145 @@
+import os
+import json
+import math
+import hashlib
+import numpy as np
+from ..FVCOMnetCDFReader import FVCOMResultProcessor, get_cache_directory
+from ..Staging import tracking_window
+
+EARTH_RADIUS = 6371000.0    # 地球半径(米)
+
+def element_edge_length(node_x: np.ndarray, node_y: np.ndarray, nv: np.ndarray, cart_shp: bool):
+    """
+    各单元的最短边长(米,向量化)
+
+    Parameters:
+    node_x, node_y (np.ndarray): 节点坐标(投影坐标或经纬度)
+    nv (np.ndarray): (nele, 3) 单元节点编号, 从0开始
+    cart_shp (bool): True为投影坐标(米), False为经纬度(按边中点纬度换算为米)
+
+    Returns:
+    np.ndarray: (nele,) 最短边长
+    """
+    x, y = node_x[nv], node_y[nv]
+    dx = x - np.roll(x, -1, axis=1)
+    dy = y - np.roll(y, -1, axis=1)
+    if not cart_shp:
+        middle = np.deg2rad(0.5*(y + np.roll(y, -1, axis=1)))
+        dx = np.deg2rad(dx)*EARTH_RADIUS*np.cos(middle)
+        dy = np.deg2rad(dy)*EARTH_RADIUS
+    return np.hypot(dx, dy).min(axis=1)
+
+class CFLTimeStepSelector: # 按追踪时段内的最大粒子Courant数选择ptraj的积分步长DTI
+    def __init__(self, tracker, settings: dict):
+        """
+        :param tracker: LagrangianTracking_FVCOMOffline实例(提供日志、起止时间、风拖曳设置与网格)
+        :param settings: 配置文件的Lagrangian.CFL节
+        """
+        self.tracker = tracker
+        self.logger = tracker.logger
+        self.settings = settings
+        self.courant = float(settings.get('Courant', 0.5))
+        self.divisor = float(settings.get('Divisor', 20))
+
+    def courant_rate(self, dataset, first: int, last: int):
+        """
+        追踪时段内单位步长的最大Courant数 max(|漂移速度|/最短边长),逐时次读取(内存中只有一个时次的流场)
+
+        Returns:
+        dict: rate(1/秒), index(出现最大值的全局时次), element(所在单元,0起始)
+        """
+        tracker = self.tracker
+        mesh = tracker.load_mesh()
+        inverse_length = 1.0/element_edge_length(mesh.node_x, mesh.node_y, mesh.nv, tracker.cart_shp)
+        dragc = float(tracker.dragc)
+        wind = dragc != 0 and 'uwind_speed' in dataset.variables and 'vwind_speed' in dataset.variables
+        if dragc != 0 and not wind:
+            self.logger.warning('FVCOM输出中缺少uwind_speed/vwind_speed,Courant数不含风拖曳项')
+        angle = np.deg2rad(float(tracker.rotate_angle))
+        best = {'rate': 0.0, 'index': first, 'element': 0}
+        for index in range(first, last+1):
+            u = dataset.read('u', index, index+1)[0]
+            v = dataset.read('v', index, index+1)[0]
+            if wind:    # 与ptraj相同: 流速加上按ROTATE_ANGLE旋转的风速乘以Dragc
+                uw = dataset.read('uwind_speed', index, index+1)[0]
+                vw = dataset.read('vwind_speed', index, index+1)[0]
+                u = u + dragc*(uw*np.cos(angle) + vw*np.sin(angle))
+                v = v + dragc*(-uw*np.sin(angle) + vw*np.cos(angle))
+            rate = np.hypot(u, v).reshape(-1, inverse_length.size).max(axis=0)*inverse_length     # 各层取最大
+            element = int(np.argmax(rate))
+            if rate[element] > best['rate']:
+                best = {'rate': float(rate[element]), 'index': index, 'element': element}
+        return best
+
+    def cached_rate(self, dataset, first: int, last: int):
+        """按(时段内的FVCOM输出文件, 时段, 风拖曳设置, 坐标系)缓存courant_rate的结果"""
+        tracker = self.tracker
+        entries = tracker.netcdf_data.time_index.sorted_entries()
+        used = {dataset.files[i_file] for i_file in np.unique(dataset.file_of_index[first:last+1])}
+        key = json.dumps({
+            'files': [[entry['path'], entry['size'], entry['mtime']] for entry in entries if entry['path'] in used],
+            'window': [first, last],
+            'dragc': float(tracker.dragc),
+            'rotate_angle': float(tracker.rotate_angle),
+            'cart_shp': bool(tracker.cart_shp),
+        }, sort_keys=True)
+        cache_file = os.path.join(get_cache_directory(tracker.configfile), 'cfl_{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as fin:
+                    result = json.load(fin)
+                self.logger.info('使用已缓存的Courant数: {}'.format(cache_file))
+                return result
+            except (OSError, ValueError):
+                pass
+        result = self.courant_rate(dataset, first, last)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(result, fout)
+        os.replace(tmp_file, cache_file)
+        return result
+
+    @staticmethod
+    def largest_divisor(instp: float, limit: float):
+        """
+        不超过limit且整除INSTP的最大步长: INSTP为整数秒时取其整数因数,否则(或limit不足1秒时)取 INSTP/n
+
+        Returns:
+        float: 步长(秒)
+        """
+        if limit >= instp:
+            return float(instp)
+        if float(instp).is_integer() and limit >= 1:
+            instp = int(instp)
+            divisors = [d for i in range(1, math.isqrt(instp)+1) if instp % i == 0 for d in (i, instp//i)]
+            return float(max(d for d in divisors if d <= limit))
+        return instp/math.ceil(instp/limit)
+
+    def select(self):
+        """
+        计算追踪时段内的最大Courant数,选择满足 Courant数 <= Lagrangian.CFL.Courant 且整除INSTP的最大DTI,
+        并与固定步长 INSTP/Divisor 比较,记录预计加速比
+
+        Returns:
+        float: DTI(秒)
+        """
+        tracker = self.tracker
+        instp = float(tracker.instp)
+        self.logger.info('开始 - 按CFL条件选择积分步长DTI')
+        if tracker.netcdf_data is None:
+            tracker.netcdf_data = FVCOMResultProcessor(tracker.configpath)
+        with tracker.netcdf_data.open_multifile_dataset() as dataset:
+            first, last = tracking_window(tracker, dataset)
+            result = self.cached_rate(dataset, first, last)
+            when = dataset.index_to_time(result['index'])
+        limit = self.courant/result['rate'] if result['rate'] > 0 else math.inf
+        dti = self.largest_divisor(instp, limit)
+        fixed = instp/self.divisor
+        self.logger.info('最大Courant数 {:.4g}/秒(时次 {}, 单元 {}), 稳定步长上限 {:.4g} 秒'.format(
+            result['rate'], when, result['element']+1, limit))
+        if fixed*result['rate'] > self.courant:
+            self.logger.warning('固定步长 {:g} 秒的Courant数为 {:.3f},超过 {:g}'.format(fixed, fixed*result['rate'], self.courant))
+        self.logger.info('结束 - DTI = {:g} 秒(每个INSTP {}个子步), 固定步长 {:g} 秒(每个INSTP {:g}个子步), 预计加速 {:.2f} 倍'.format(
+            dti, int(round(instp/dti)), fixed, self.divisor, dti/fixed))
+        return dti
@@ -0,0 +1,366 @@
+import os
+import json
+import shutil
+import numpy as np
+import netCDF4 as nc
+from datetime import datetime
+from ..MeshIndex import expand_ranges
+from ..PostProcessing import time_axis_of, valid_positions, read_block
+
+SPAN_GAP = 1024     # 从轨迹文件读取位置时,间隔不超过该值的粒子列合并为一段连续读取
+
+class TrajectoryIndex: # 轨迹输出的时空查询索引: 粒子分块 x 时间分块 x 空间瓦片的粒子列表(内存映射),位置从轨迹文件或可选的副本读取
+    VERSION = 2
+
+    def __init__(self, directory: str, logger=None):
+        """
+        打开已建立的索引(只读内存映射,不读入数据); 未保存位置副本时,轨迹文件须与建立索引时一致
+
+        Parameters:
+        directory (str): 索引目录
+        logger: 日志记录器
+        """
+        self.directory = directory
+        self.logger = logger
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as fin:
+            self.meta = json.load(fin)
+        if self.meta.get('version') != self.VERSION:
+            raise ValueError('索引版本不符: {}'.format(directory))
+        tiles = self.meta['tiles']
+        self.x0, self.y0, self.tile_size, self.nx, self.ny = tiles['x0'], tiles['y0'], tiles['size'], tiles['nx'], tiles['ny']
+        self.num_tiles = self.nx*self.ny
+        self.num_times, self.num_particles = self.meta['num_times'], self.meta['num_particles']
+        self.time_chunk, self.particle_chunk = self.meta['time_chunk'], self.meta['particle_chunk']
+        self.num_blocks = -(-self.num_particles//self.particle_chunk)
+        self.num_chunks = -(-self.num_times//self.time_chunk)
+        self.source = None          # 未保存位置副本时按需打开的轨迹文件
+        if self.meta['positions']:
+            self.position = np.load(os.path.join(directory, 'position.npy'), mmap_mode='r')        # (时次, 粒子, 2)
+        else:
+            self.position = None
+            if not self.is_current(directory, self.meta['source']):
+                raise ValueError('轨迹文件已变化或不存在,需要重建索引: {}'.format(self.meta['source']))
+        self.bucket_start = np.load(os.path.join(directory, 'bucket_start.npy'), mmap_mode='r')    # CSR偏移
+        self.bucket_particles = np.memmap(os.path.join(directory, 'bucket_particles.bin'), dtype=np.int32, mode='r') \
+            if self.bucket_start[-1] > 0 else np.zeros(0, dtype=np.int32)
+        self.particle_id = np.load(os.path.join(directory, 'particle_id.npy'), mmap_mode='r')
+        self.id_order = np.load(os.path.join(directory, 'id_order.npy'), mmap_mode='r')             # 按编号排序的粒子列
+        self.times = np.load(os.path.join(directory, 'times.npy'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """关闭按需打开的轨迹文件"""
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+    @staticmethod
+    def is_current(directory: str, path: str):
+        """索引存在且与轨迹文件(大小与修改时间)一致"""
+        meta_file = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_file) or not os.path.exists(path):
+            return False
+        try:
+            with open(meta_file, 'r', encoding='utf-8') as fin:
+                meta = json.load(fin)
+        except (OSError, ValueError):
+            return False
+        stat = os.stat(path)
+        return meta.get('version') == TrajectoryIndex.VERSION and meta.get('source') == os.path.abspath(path) \
+            and meta.get('size') == stat.st_size and meta.get('mtime') == stat.st_mtime_ns
+
+    @classmethod
+    def build(cls, path: str, directory: str, bounds: list, tile_size: float, time_chunk: int = 24, particle_chunk: int = 250000,
+              variables: tuple = ('x', 'y'), positions: bool = False, logger=None):
+        """
+        由轨迹文件(合并文件或NumPy引擎输出)流式建立索引,轨迹文件未变化时直接打开已有索引
+
+        Parameters:
+        path (str): 轨迹文件
+        directory (str): 索引目录
+        bounds (list): 瓦片网格的范围 [xmin, ymin, xmax, ymax],范围外的点归入边缘瓦片
+        tile_size (float): 瓦片边长(与坐标单位相同)
+        time_chunk (int): 每个时间块的输出时次数
+        particle_chunk (int): 每个粒子块的粒子数(每次读取的粒子数)
+        variables (tuple): 坐标变量名
+        positions (bool): 同时保存按时次排列的位置副本position.npy(时次 x 粒子 x 2,未压缩),查询不再读取轨迹文件
+        logger: 日志记录器
+
+        Returns:
+        TrajectoryIndex: 索引
+        """
+        if cls.is_current(directory, path):
+            index = cls(directory, logger)
+            if index.meta['positions'] == bool(positions):
+                if logger:
+                    logger.info('轨迹索引已是最新: {}'.format(directory))
+                return index
+            index.close()
+        x_name, y_name = variables
+        x0, y0, x1, y1 = [float(value) for value in bounds]
+        tile_size = float(tile_size)
+        nx = max(1, int(np.ceil((x1-x0)/tile_size)))
+        ny = max(1, int(np.ceil((y1-y0)/tile_size)))
+        num_tiles = nx*ny
+        if logger:
+            logger.info('开始 - 建立轨迹索引: {} -> {}'.format(path, directory))
+        tmp_dir = directory.rstrip('/') + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        stat = os.stat(path)
+        with nc.Dataset(path, 'r') as src:
+            src.set_auto_mask(False)
+            x_var, y_var = src.variables[x_name], src.variables[y_name]
+            time_axis = time_axis_of(src, x_name)
+            num_times, num_particles = x_var.shape[time_axis], x_var.shape[1-time_axis]
+            particle_dim = x_var.dimensions[1-time_axis]
+            active = src.variables['active'] if 'active' in src.variables and src.variables['active'].shape == x_var.shape else None
+            particle_id = np.asarray(src.variables['particle_id'][:]) if 'particle_id' in src.variables \
+                and src.variables['particle_id'].dimensions == (particle_dim,) else np.arange(1, num_particles+1)
+            time_units = ''
+            if 'time' in src.variables and src.variables['time'].shape == (num_times,):
+                times = np.asarray(src.variables['time'][:], dtype=np.float64)
+                time_units = getattr(src.variables['time'], 'units', '')
+            else:
+                times = np.arange(num_times, dtype=np.float64)
+            np.save(os.path.join(tmp_dir, 'particle_id.npy'), particle_id)
+            np.save(os.path.join(tmp_dir, 'id_order.npy'), np.argsort(particle_id, kind='stable'))
+            np.save(os.path.join(tmp_dir, 'times.npy'), times)
+
+            num_chunks = -(-num_times//time_chunk)
+            num_blocks = -(-num_particles//particle_chunk)
+            # 位置副本与轨迹文件的精度一致,查询结果与直接读取轨迹文件相同
+            position = np.lib.format.open_memmap(os.path.join(tmp_dir, 'position.npy'), mode='w+',
+                                                 dtype=np.result_type(x_var.dtype, np.float32),
+                                                 shape=(num_times, num_particles, 2)) if positions else None
+            # 每次读取的时次数取轨迹文件时间方向块大小(向上取整为time_chunk的倍数),每个压缩块只解压一次
+            chunking = x_var.chunking()
+            span = time_chunk*max(1, -(-int(chunking[time_axis])//time_chunk)) if isinstance(chunking, list) else time_chunk
+            counts = np.zeros(num_blocks*num_chunks*num_tiles, dtype=np.int64)
+            with open(os.path.join(tmp_dir, 'bucket_particles.bin'), 'wb') as fout:
+                for block in range(num_blocks):
+                    first = block*particle_chunk
+                    particles = slice(first, min(first+particle_chunk, num_particles))
+                    for span_start in range(0, num_times, span):
+                        span_slice = slice(span_start, min(span_start+span, num_times))
+                        x = read_block(x_var, time_axis, span_slice, particles)
+                        y = read_block(y_var, time_axis, span_slice, particles)
+                        valid = valid_positions(x, y)
+                        if active is not None:
+                            valid &= read_block(active, time_axis, span_slice, particles) > 0
+                        if position is not None:
+                            position[span_slice, particles, 0] = np.where(valid, x, np.nan)
+                            position[span_slice, particles, 1] = np.where(valid, y, np.nan)
+                        i = np.clip(np.floor((np.where(valid, x, x0)-x0)/tile_size).astype(np.int64), 0, nx-1)
+                        j = np.clip(np.floor((np.where(valid, y, y0)-y0)/tile_size).astype(np.int64), 0, ny-1)
+                        tile = np.where(valid, j*nx + i, -1)
+                        for offset in range(0, x.shape[0], time_chunk):
+                            # 时间块内每个(瓦片, 粒子)只记一次: 先去掉与上一时次相同的瓦片(粒子大多停留在同一瓦片),再排序去重
+                            chunk_tile = tile[offset:offset+time_chunk]
+                            changed = chunk_tile >= 0
+                            changed[1:] &= chunk_tile[1:] != chunk_tile[:-1]
+                            column = np.broadcast_to(np.arange(x.shape[1], dtype=np.int64), chunk_tile.shape)[changed]
+                            keys = np.unique(chunk_tile[changed]*x.shape[1] + column)
+                            tiles, columns = keys//x.shape[1], keys % x.shape[1] + first
+                            bucket = (block*num_chunks + (span_start+offset)//time_chunk)*num_tiles
+                            counts[bucket:bucket+num_tiles] = np.bincount(tiles, minlength=num_tiles)
+                            fout.write(columns.astype(np.int32).tobytes())
+                    if logger:
+                        logger.debug('已建立索引粒子块 {}/{}'.format(block+1, num_blocks))
+            if position is not None:
+                position.flush()
+                del position
+        np.save(os.path.join(tmp_dir, 'bucket_start.npy'), np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        meta = {
+            'version': cls.VERSION,
+            'source': os.path.abspath(path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'num_times': num_times,
+            'num_particles': num_particles,
+            'time_chunk': time_chunk,
+            'particle_chunk': particle_chunk,
+            'time_units': time_units,
+            'variables': [x_name, y_name],
+            'time_axis': time_axis,
+            'active': active is not None,
+            'positions': bool(positions),
+            'tiles': {'x0': x0, 'y0': y0, 'size': tile_size, 'nx': nx, 'ny': ny},
+        }
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as fout:
+            json.dump(meta, fout, ensure_ascii=False, indent=1)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_dir, directory)
+        if logger:
+            logger.info('结束 - 轨迹索引: {}个粒子, {}个时次, {}x{}个瓦片, {}条记录'.format(
+                num_particles, num_times, nx, ny, int(counts.sum())))
+        return cls(directory, logger)
+
+    def read_positions(self, steps: slice, columns):
+        """
+        读取时次范围steps内粒子列columns的位置: 有位置副本时从内存映射读取,否则从轨迹文件读取,
+        排序后相邻的列(间隔不超过SPAN_GAP、每段不超过ParticleChunk列)合并为一段,每段按TimeChunk个时次读取
+
+        Parameters:
+        steps (slice): 连续的时次范围
+        columns (array_like): 粒子列(可重复、无序)
+
+        Returns:
+        np.ndarray: (时次数, 列数, 2),无效或已失效的位置为nan
+        """
+        columns = np.asarray(columns, dtype=np.int64)
+        if self.position is not None:
+            return np.asarray(self.position[steps, columns], dtype=np.float64)
+        first, stop, _ = steps.indices(self.num_times)
+        xy = np.full((max(stop-first, 0), columns.size, 2), np.nan)
+        if xy.size == 0:
+            return xy
+        if self.source is None:
+            self.source = nc.Dataset(self.meta['source'], 'r')
+            self.source.set_auto_mask(False)
+        x_name, y_name = self.meta['variables']
+        x_var, y_var = self.source.variables[x_name], self.source.variables[y_name]
+        active = self.source.variables['active'] if self.meta['active'] else None
+        time_axis = self.meta['time_axis']
+        unique, inverse = np.unique(columns, return_inverse=True)
+        segment = np.concatenate([[0], np.cumsum(np.diff(unique) > SPAN_GAP)])
+        segment_start = unique[np.concatenate([[0], np.flatnonzero(np.diff(segment))+1])][segment]
+        key = segment*(self.num_particles+1) + (unique - segment_start)//self.particle_chunk
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(key))+1, [unique.size]])
+        values = np.full((xy.shape[0], unique.size, 2), np.nan)
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            span = slice(int(unique[a]), int(unique[b-1])+1)
+            picked = unique[a:b] - unique[a]
+            for chunk_start in range(first, stop, self.time_chunk):
+                times = slice(chunk_start, min(chunk_start+self.time_chunk, stop))
+                x = read_block(x_var, time_axis, times, span)[:, picked]
+                y = read_block(y_var, time_axis, times, span)[:, picked]
+                valid = valid_positions(x, y)
+                if active is not None:
+                    valid &= read_block(active, time_axis, times, span)[:, picked] > 0
+                values[times.start-first:times.stop-first, a:b, 0] = np.where(valid, x, np.nan)
+                values[times.start-first:times.stop-first, a:b, 1] = np.where(valid, y, np.nan)
+        return values[:, inverse.ravel()]
+
+    def step_of(self, time):
+        """
+        时间 -> 输出时次: 整数为时次本身,datetime按轨迹文件time变量的units换算后取最近的时次
+
+        Returns:
+        int: 输出时次
+        """
+        if isinstance(time, (int, np.integer)):
+            step = int(time)
+        else:
+            if not self.meta['time_units']:
+                raise ValueError('轨迹文件的time变量没有units,只能按时次查询')
+            if isinstance(time, str):
+                time = datetime.strptime(time, '%Y-%m-%d %H:%M:%S')
+            value = nc.date2num(time, self.meta['time_units'])
+            step = int(np.argmin(np.abs(self.times - value)))
+        if not 0 <= step < self.num_times:
+            raise IndexError('时次 {} 超出范围 [0, {})'.format(step, self.num_times))
+        return step
+
+    def columns_of(self, ids):
+        """
+        粒子编号 -> 轨迹数据中的粒子列
+
+        Returns:
+        np.ndarray: 粒子列,不存在的编号为-1
+        """
+        ids = np.atleast_1d(np.asarray(ids))
+        sorted_ids = self.particle_id[self.id_order]
+        found = np.clip(np.searchsorted(sorted_ids, ids), 0, max(self.num_particles-1, 0))
+        return np.where(sorted_ids[found] == ids, self.id_order[found], -1)
+
+    def in_box(self, bounds: list, start=0, end=None):
+        """
+        在时段[start, end]内经过范围bounds的粒子: 只读取与时段重叠的时间块、与范围相交的瓦片的粒子列表,再由位置逐一核对
+
+        Parameters:
+        bounds (list): [xmin, ymin, xmax, ymax]
+        start, end: 起止时间(datetime、'%Y-%m-%d %H:%M:%S'或时次),end为None时到最后一个时次
+
+        Returns:
+        dict: particle_id(粒子编号), first_step(首次位于范围内的时次), first_time(对应的time变量值)
+        """
+        xmin, ymin, xmax, ymax = [float(value) for value in bounds]
+        first_step = self.step_of(start)
+        last_step = self.step_of(self.num_times-1 if end is None else end)
+        if last_step < first_step:
+            first_step, last_step = last_step, first_step
+        i0, i1 = [int(np.clip(np.floor((value-self.x0)/self.tile_size), 0, self.nx-1)) for value in (xmin, xmax)]
+        j0, j1 = [int(np.clip(np.floor((value-self.y0)/self.tile_size), 0, self.ny-1)) for value in (ymin, ymax)]
+        tiles = (np.arange(j0, j1+1)[:, None]*self.nx + np.arange(i0, i1+1)[None, :]).ravel()
+        blocks = np.arange(self.num_blocks)
+        found_columns, found_steps = [], []
+        found = np.zeros(0, dtype=np.int64)
+        for chunk in range(first_step//self.time_chunk, last_step//self.time_chunk+1):
+            # 本时间块中位于相交瓦片内的粒子(各粒子块的CSR区间),已找到的粒子不再核对
+            keys = ((blocks*self.num_chunks + chunk)[:, None]*self.num_tiles + tiles[None, :]).ravel()
+            starts = np.asarray(self.bucket_start[keys])
+            candidates = np.unique(np.asarray(self.bucket_particles[expand_ranges(starts, np.asarray(self.bucket_start[keys+1]) - starts)]))
+            candidates = candidates[~np.isin(candidates, found, assume_unique=True)]
+            if candidates.size == 0:
+                continue
+            # 读取本时间块内候选列的位置核对(每次至多ParticleChunk个候选,内存与块大小成正比)
+            steps = slice(max(first_step, chunk*self.time_chunk), min(last_step, (chunk+1)*self.time_chunk-1)+1)
+            first_seen = np.full(candidates.size, -1, dtype=np.int64)
+            for batch in range(0, candidates.size, self.particle_chunk):
+                xy = self.read_positions(steps, candidates[batch:batch+self.particle_chunk])
+                inside = (xy[..., 0] >= xmin) & (xy[..., 0] <= xmax) & (xy[..., 1] >= ymin) & (xy[..., 1] <= ymax)
+                first_seen[batch:batch+self.particle_chunk] = np.where(inside.any(axis=0), steps.start + np.argmax(inside, axis=0), -1)
+            hit = first_seen >= 0
+            found_columns.append(candidates[hit])
+            found_steps.append(first_seen[hit])
+            found = np.sort(np.concatenate([found, candidates[hit]]))
+        columns = np.concatenate(found_columns) if found_columns else np.zeros(0, dtype=np.int64)
+        steps = np.concatenate(found_steps) if found_steps else np.zeros(0, dtype=np.int64)
+        return {'particle_id': np.asarray(self.particle_id[columns]), 'first_step': steps, 'first_time': self.times[steps]}
+
+    def positions(self, ids, time):
+        """
+        给定粒子在某一时刻的位置: 只读取该时次中这些粒子的位置
+
+        Parameters:
+        ids (array_like): 粒子编号(如某次释放的粒子)
+        time: 时间(datetime、'%Y-%m-%d %H:%M:%S'或时次)
+
+        Returns:
+        dict: particle_id, x, y(不存在、无效或已失效的粒子为nan)
+        """
+        ids = np.atleast_1d(np.asarray(ids))
+        columns = self.columns_of(ids)
+        xy = np.full((ids.size, 2), np.nan)
+        found = columns >= 0
+        if self.logger and not np.all(found):
+            self.logger.warning('{}个粒子编号不在轨迹中'.format(int(np.sum(~found))))
+        order = np.argsort(columns[found])     # 按列顺序读取,内存映射按页顺序访问
+        step = self.step_of(time)
+        xy[np.flatnonzero(found)[order]] = self.read_positions(slice(step, step+1), columns[found][order])[0]
+        return {'particle_id': ids, 'x': xy[:, 0], 'y': xy[:, 1]}
+
+    def trajectories(self, ids, start=0, end=None):
+        """
+        给定粒子在时段[start, end]内的轨迹
+
+        Returns:
+        dict: particle_id, steps(时次), x, y(时次数 x 粒子数)
+        """
+        ids = np.atleast_1d(np.asarray(ids))
+        columns = self.columns_of(ids)
+        first_step = self.step_of(start)
+        last_step = self.step_of(self.num_times-1 if end is None else end)
+        steps = np.arange(min(first_step, last_step), max(first_step, last_step)+1)
+        xy = np.full((steps.size, ids.size, 2), np.nan)
+        found = np.flatnonzero(columns >= 0)
+        xy[:, found] = self.read_positions(slice(steps[0], steps[-1]+1), columns[found])
+        return {'particle_id': ids, 'steps': steps, 'x': xy[..., 0], 'y': xy[..., 1]}
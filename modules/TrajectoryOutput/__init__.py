@@ -0,0 +1,166 @@
+import os
+import glob
+import netCDF4 as nc
+import numpy as np
+from ..Log import AppLogger
+
+CHUNK_VALUES = 1 << 18  # 每个压缩块的目标数值个数(float64约2MB)
+
+def merged_chunksizes(dimensions: tuple, sizes: dict, particle_dim: str, time_dim: str):
+    """
+    合并文件的分块大小: 时间与粒子两个方向都只跨越少量块,
+    按粒子读取整条轨迹与按时次读取全部粒子都只需读取少量块
+
+    Returns:
+    list: 各维度的块大小
+    """
+    time_chunk = min(sizes.get(time_dim, 1), 128) if time_dim in dimensions else 1
+    others = int(np.prod([sizes[dim] for dim in dimensions if dim not in (particle_dim, time_dim)], dtype=np.int64))
+    particle_chunk = max(1, CHUNK_VALUES//(time_chunk*max(others, 1)))
+    chunks = []
+    for dim in dimensions:
+        if dim == time_dim:
+            chunks.append(max(1, time_chunk))
+        elif dim == particle_dim:
+            chunks.append(max(1, min(sizes[dim], particle_chunk)))
+        else:
+            chunks.append(max(1, sizes[dim]))
+    return chunks
+
+class TrajectoryMerger: # 将各子算例的ptraj输出流式合并为一个分块压缩的NetCDF文件
+    def __init__(self, logger: AppLogger, particle_dim: str = 'particle', complevel: int = 4, source_dim: str = 'nlag'):
+        """
+        :param logger: 日志
+        :param particle_dim: 合并文件中粒子维度的名称
+        :param complevel: zlib压缩等级
+        :param source_dim: 子算例输出(ptraj)中粒子维度的名称,为空时按长度识别
+        """
+        self.logger = logger
+        self.particle_dim = particle_dim
+        self.complevel = complevel
+        self.source_dim = source_dim
+
+    @staticmethod
+    def find_output(outdir: str, case: str, pattern: str = '{case}*.nc'):
+        """
+        查找子算例的输出文件
+
+        Returns:
+        str: 输出文件路径,不存在时为None
+        """
+        paths = sorted(glob.glob(os.path.join(outdir, pattern.format(case=case))))
+        return paths[0] if paths else None
+
+    @staticmethod
+    def particle_dimension(dataset: nc.Dataset, num_particles: int, name: str = 'nlag'):
+        """
+        子算例输出中的粒子维度与时间维度: 粒子维度按名称查找,长度须等于子算例的粒子数;
+        名称为空时取长度等于粒子数的维度(时间维度除外),不唯一时无法识别
+
+        Returns:
+        tuple: (粒子维度名, 时间维度名或None)
+
+        Raises:
+        ValueError: 粒子维度不存在、长度不符或无法唯一识别
+        """
+        time_dim = None
+        for dim_name, dim in dataset.dimensions.items():
+            if dim.isunlimited() or dim_name.lower() == 'time':
+                time_dim = dim_name
+                break
+        if name:
+            if name not in dataset.dimensions:
+                raise ValueError('未找到粒子维度{}(现有维度: {})'.format(name, list(dataset.dimensions)))
+            if len(dataset.dimensions[name]) != num_particles:
+                raise ValueError('粒子维度{}的长度为{},与子算例的粒子数{}不符'.format(name, len(dataset.dimensions[name]), num_particles))
+            return name, time_dim
+        candidates = [dim_name for dim_name, dim in dataset.dimensions.items() if len(dim) == num_particles and dim_name != time_dim]
+        if len(candidates) != 1:
+            raise ValueError('{}个维度的长度等于粒子数{}{},请设置Lagrangian.Merge.ParticleDimension'.format(
+                len(candidates), num_particles, candidates))
+        return candidates[0], time_dim
+
+    def merge(self, shards: list, output_file: str):
+        """
+        合并子算例输出: 逐个子算例、逐个变量读取并写入全局粒子维度的对应位置,
+        峰值内存约为一个子算例的一个变量
+
+        Parameters:
+        shards (list): [(输出文件, 原始粒子编号数组或.ids.npy路径), ...],顺序即合并后的粒子顺序
+        output_file (str): 合并文件路径
+
+        Returns:
+        str: 合并文件路径
+        """
+        if not shards:
+            self.logger.error('没有可合并的子算例输出')
+            raise RuntimeError
+        headers = []
+        for path, ids in shards:
+            ids = np.load(ids, mmap_mode='r') if isinstance(ids, str) else np.asarray(ids)
+            with nc.Dataset(path, 'r') as src:
+                try:
+                    particle_dim, time_dim = self.particle_dimension(src, ids.size, self.source_dim)
+                except ValueError as error:
+                    self.logger.error('{}: {}'.format(path, error))
+                    raise RuntimeError
+                num_times = len(src.dimensions[time_dim]) if time_dim is not None else None
+            headers.append((path, ids, particle_dim, time_dim, num_times))
+        if len({header[4] for header in headers}) > 1:
+            self.logger.error('各子算例输出的时次数不一致: {}'.format(sorted({header[4] for header in headers})))
+            raise RuntimeError
+        num_particles = sum(header[1].size for header in headers)
+        self.logger.info('开始 - 合并{}个子算例输出(共{}个粒子): {}'.format(len(headers), num_particles, output_file))
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        first_path, _, first_pdim, first_tdim, num_times = headers[0]
+        tmp_file = output_file + '.tmp'
+        with nc.Dataset(first_path, 'r') as first, nc.Dataset(tmp_file, 'w', format='NETCDF4') as dst:
+            first.set_auto_mask(False)
+            dst.setncatts({name: first.getncattr(name) for name in first.ncattrs()})
+            dst.setncattr('merged_shards', len(headers))
+            # 维度: 粒子维度替换为全局粒子维度,其余沿用第一个子算例
+            sizes = {}
+            for name, dim in first.dimensions.items():
+                if name == first_pdim:
+                    continue
+                dst.createDimension(name, len(dim))     # 时次数已知,固定长度便于分块
+                sizes[name] = len(dim)
+            dst.createDimension(self.particle_dim, num_particles)
+            sizes[self.particle_dim] = num_particles
+            particle_id = dst.createVariable('particle_id', 'i8', (self.particle_dim,), zlib=True, complevel=self.complevel)
+            particle_id.long_name = 'original particle id from particles.dat'
+
+            merged = []
+            for name, var in first.variables.items():
+                attrs = {attr: var.getncattr(attr) for attr in var.ncattrs() if attr != '_FillValue'}
+                fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                if first_pdim in var.dimensions:
+                    dimensions = tuple(self.particle_dim if dim == first_pdim else dim for dim in var.dimensions)
+                    out = dst.createVariable(name, var.dtype, dimensions, zlib=True, complevel=self.complevel, shuffle=True,
+                                             chunksizes=merged_chunksizes(dimensions, sizes, self.particle_dim, first_tdim),
+                                             fill_value=fill_value)
+                    out.setncatts(attrs)
+                    merged.append(name)
+                else:           # 与粒子无关的变量(如时间)直接复制
+                    out = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+                    out.setncatts(attrs)
+                    out[...] = var[...]
+
+            offset = 0
+            for path, ids, particle_dim, time_dim, _ in headers:
+                count = ids.size
+                particle_id[offset:offset+count] = ids
+                with nc.Dataset(path, 'r') as src:
+                    src.set_auto_mask(False)
+                    for name in merged:
+                        var = src.variables[name]
+                        axis = var.dimensions.index(particle_dim)
+                        index = [slice(None)]*len(var.dimensions)
+                        index[axis] = slice(offset, offset+count)
+                        dst.variables[name][tuple(index)] = var[...]
+                offset += count
+                self.logger.debug('已合并: {}'.format(path))
+        os.replace(tmp_file, output_file)
+        self.logger.info('结束 - 合并子算例输出: {}'.format(output_file))
+        return output_file
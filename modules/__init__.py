@@ -1,3 +1,16 @@
 from modules.Log import AppLogger                           # 日志类
 from modules.FVCOMnetCDFReader import FVCOMResultProcessor  # FVCOM输出文件处理类
-from modules.LagrangianTracking import LagrangianTracking_FVCOMOffline   # FVCOM离线拉格朗日追踪类
\ No newline at end of file
+from modules.FVCOMnetCDFReader import FVCOMMultiFileDataset # FVCOM多文件只读虚拟数据集
+from modules.LagrangianTracking import LagrangianTracking_FVCOMOffline   # FVCOM离线拉格朗日追踪类
+from modules.MeshIndex import FVCOMMeshIndex                 # FVCOM网格点-单元定位索引类
+from modules.ParticleTracker import NumPyParticleTracker   # 纯NumPy向量化粒子追踪类
+from modules.Ensemble import LagrangianEnsemble             # 参数网格集合试验类
+from modules.TrajectoryOutput import TrajectoryMerger       # 子算例轨迹输出合并类
+from modules.Telemetry import RunTelemetry                  # 粒子追踪运行遥测类
+from modules.ClusterBackend import ClusterBackend, SlurmBackend, LocalBackend   # SLURM作业数组/本机执行后端
+from modules.Benchmark import PipelineBenchmark               # 合成数据基准测试类
+from modules.Staging import FVCOMInputStager                # 按追踪时段/子区域准备输入目录
+from modules.TimeStep import CFLTimeStepSelector            # 按CFL条件选择积分步长
+from modules.PostProcessing import TrajectoryPostProcessor  # 粒子密度/滞留时间/连通矩阵后处理类
+from modules.TrajectoryIndex import TrajectoryIndex         # 轨迹时空查询索引类
+from modules.Service import TrackingService                 # 常驻追踪服务(时间索引、网格与ptraj常驻内存)
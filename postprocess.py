@@ -0,0 +1,25 @@
+import argparse
+import os
+import modules
+
+if __name__ == "__main__":
+    # 创建命令行参数解析器
+    parser = argparse.ArgumentParser(description='由拉格朗日追踪轨迹计算粒子密度、滞留时间与源-汇连通矩阵')
+    parser.add_argument('--config', type=str, default='configuration/config.toml', help='配置文件路径,默认: configuration/config.toml')
+    parser.add_argument('--input', type=str, default=None, help='轨迹文件 (默认: 合并文件 OUTDIR/{CaseName}_merged.nc)')
+    parser.add_argument('--output', type=str, default=None, help='结果文件 (默认: 使用配置文件)')
+    parser.add_argument('--bins', type=str, default=None, help='分箱方式,element或grid (默认: 使用配置文件)')
+    parser.add_argument('--workers', type=int, default=None, help='并行处理时间块的进程数 (默认: 使用配置文件)')
+
+    # 解析命令行参数
+    args = parser.parse_args()
+    tracker = modules.LagrangianTracking_FVCOMOffline(args.config, run=False)
+    settings = dict(tracker.postprocessing)
+    if args.output is not None:
+        settings['Output'] = args.output
+    if args.bins is not None:
+        settings['Bins'] = args.bins
+    if args.workers is not None:
+        settings['Workers'] = args.workers
+    path = args.input or tracker.merge.get('Output', '') or os.path.join(tracker.directory, tracker.outdir, f"{tracker.casename}_merged.nc")
+    modules.TrajectoryPostProcessor(tracker, settings).run(path)
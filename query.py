@@ -0,0 +1,53 @@
+import argparse
+import os
+import toml
+import numpy as np
+import modules
+
+if __name__ == "__main__":
+    # 创建命令行参数解析器
+    parser = argparse.ArgumentParser(description='查询轨迹时空索引: 时段内经过范围的粒子 / 粒子在某一时刻的位置')
+    parser.add_argument('--config', type=str, default='configuration/config.toml', help='配置文件路径,默认: configuration/config.toml')
+    parser.add_argument('--index', type=str, default=None, help='索引目录 (默认: TrajectoryIndex.Directory 或 OUTDIR/{CaseName}_index)')
+    parser.add_argument('--box', type=float, nargs=4, default=None, help='范围 xmin ymin xmax ymax')
+    parser.add_argument('--start', type=str, default=None, help='起始时间,格式: "2025-05-29 06:00:00" 或输出时次 (默认: 第一个时次)')
+    parser.add_argument('--end', type=str, default=None, help='终止时间,格式同上 (默认: 最后一个时次)')
+    parser.add_argument('--ids', type=int, nargs='+', default=None, help='粒子编号(particles.dat中的编号)')
+    parser.add_argument('--time', type=str, default=None, help='查询粒子位置的时刻,格式同上')
+    parser.add_argument('--output', type=str, default=None, help='结果写入的CSV文件 (默认: 输出到屏幕)')
+
+    # 解析命令行参数
+    args = parser.parse_args()
+    configfile = toml.load(args.config)
+    logger = modules.AppLogger.from_config('TrajectoryIndex', configfile)
+    directory = args.index
+    if directory is None:
+        general = configfile['Lagrangian']['General']
+        directory = configfile.get('TrajectoryIndex', {}).get('Directory', '') or \
+            os.path.join(general['Directory'], configfile['Lagrangian']['IOLocation']['OUTDIR'], f"{general['CaseName']}_index")
+    index = modules.TrajectoryIndex(directory, logger)
+
+    def parse_time(value, default):
+        if value is None:
+            return default
+        return int(value) if value.isdigit() else value
+
+    if args.box is not None:
+        result = index.in_box(args.box, parse_time(args.start, 0), parse_time(args.end, None))
+        header = 'particle_id,first_step,first_time'
+        rows = np.column_stack([result['particle_id'], result['first_step'], result['first_time']])
+        logger.info('{}个粒子经过范围 {}'.format(result['particle_id'].size, args.box))
+    elif args.ids is not None and args.time is not None:
+        result = index.positions(args.ids, parse_time(args.time, None))
+        header = 'particle_id,x,y'
+        rows = np.column_stack([result['particle_id'], result['x'], result['y']])
+    else:
+        logger.error('请给出 --box(可选 --start/--end) 或 --ids 与 --time')
+        raise ValueError
+    if args.output:
+        np.savetxt(args.output, rows, delimiter=',', header=header, comments='', fmt='%.10g')
+        logger.info('结果已写入: {}'.format(args.output))
+    else:
+        print(header)
+        for row in rows:
+            print(','.join('{:.10g}'.format(value) for value in row))
@@ -0,0 +1,61 @@
+import argparse
+import os
+import json
+import toml
+import modules
+from modules.Service import send_request, spool_submit, JOB_PARAMETERS
+
+if __name__ == "__main__":
+    # 创建命令行参数解析器
+    parser = argparse.ArgumentParser(description='常驻追踪服务: 时间索引、网格与ptraj常驻内存,经UNIX套接字或提交目录接收追踪/追溯作业')
+    parser.add_argument('--config', type=str, default='configuration/config.toml', help='基础配置文件路径,默认: configuration/config.toml')
+    parser.add_argument('--socket', type=str, default=None, help='服务的UNIX套接字 (默认: 使用配置文件)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('serve', help='启动服务')
+    submit = commands.add_parser('submit', help='提交作业,参数与main.py相同,未给出的使用基础配置文件中的值')
+    submit.add_argument('--starttime', type=str, required=True, help='追踪/追溯起始时间')
+    submit.add_argument('--endtime', type=str, required=True, help='追踪/追溯终止时间')
+    submit.add_argument('--geoarea', type=str, default=None, help='网格位置')
+    submit.add_argument('--casename', type=str, default=None, help='追踪namelist文件名,*_run.dat')
+    submit.add_argument('--lagini', type=str, default=None, help='粒子位置文件名,*.dat')
+    submit.add_argument('--dragc', type=str, default=None, help='风拖曳系数')
+    submit.add_argument('--rotation_angle', type=str, default=None, help='旋转角')
+    submit.add_argument('--cart_shp', type=str, default=None, help='坐标系统,T为投影坐标,F为球(经纬度)坐标')
+    submit.add_argument('--threads', type=str, default=None, help='线程数量,分为多少个子任务运行')
+    submit.add_argument('--workers', type=str, default=None, help='同时运行的ptraj进程数 (默认: 同时运行的作业平分CPU)')
+    submit.add_argument('--engine', type=str, default=None, help='追踪引擎,ptraj或numpy')
+    submit.add_argument('--particles', type=str, default=None, help='粒子文件(格式同particles.dat) (默认: 使用INPDIR/particles.dat)')
+    submit.add_argument('--wait', action='store_true', help='等待作业结束后输出结果')
+    submit.add_argument('--spool', action='store_true', help='写入提交目录而不经套接字提交')
+    status = commands.add_parser('status', help='查询作业状态')
+    status.add_argument('job', type=str, help='作业编号')
+    status.add_argument('--wait', action='store_true', help='等待作业结束')
+    commands.add_parser('list', help='列出全部作业')
+
+    # 解析命令行参数
+    args = parser.parse_args()
+    if args.command == 'serve':
+        modules.TrackingService(args.config).serve()
+    else:
+        configfile = toml.load(args.config)
+        settings = configfile.get('Service', {})
+        root = os.path.join(configfile['Lagrangian']['General']['Directory'], 'service')
+        socket_path = args.socket or settings.get('Socket', '') or os.path.join(root, 'service.sock')
+        if args.command == 'submit':
+            params = {name: getattr(args, name) for name in JOB_PARAMETERS if getattr(args, name) is not None}
+            if 'particles' in params:
+                params['particles'] = os.path.abspath(params['particles'])
+            if args.spool:
+                path = spool_submit(settings.get('Spool', '') or os.path.join(root, 'spool'), params)
+                response = {'ok': True, 'spool': path}
+            else:
+                response = send_request(socket_path, {'command': 'submit', 'params': params})
+                if response['ok'] and args.wait:
+                    response = send_request(socket_path, {'command': 'wait', 'job': response['job']['id']})
+        elif args.command == 'status':
+            response = send_request(socket_path, {'command': 'wait' if args.wait else 'status', 'job': args.job})
+        else:
+            response = send_request(socket_path, {'command': 'list'})
+        print(json.dumps(response, ensure_ascii=False, indent=2))
+        if not response['ok']:
+            raise SystemExit(1)
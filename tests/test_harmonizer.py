@@ -0,0 +1,40 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4 as nc
+import numpy as np
+from modules.FVCOMnetCDFReader import FVCOMVariableHarmonizer, harmonize_file
+
+def write_file(path, static: bool):
+    with nc.Dataset(path, 'w') as dataset:
+        dataset.createDimension('node', 4)
+        dataset.createDimension('time', None)
+        dataset.createVariable('wts', 'f4', ('time', 'node'))[:] = np.ones((2, 4))
+        if static:
+            dataset.createVariable('a1u', 'f4', ('node',))[:] = np.arange(4)
+
+def test_concurrent_repair_modifies_once(tmp_path):
+    paths = [str(tmp_path / 'fvcom_{}.nc'.format(i)) for i in range(2)]
+    write_file(paths[0], True)
+    write_file(paths[1], False)
+    harmonizer = FVCOMVariableHarmonizer(str(tmp_path / 'ledger.json'), str(tmp_path / 'grid.nc'), logging.getLogger('test'),
+                                         {'wts': 'omega'}, ['a1u'], 'inplace')
+    assert harmonizer.build_grid_file(paths) == []
+    # 两个进程同时修复同一文件: 加锁后重新检查,只有一个进程修改
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(harmonize_file, [paths[1]]*2, [{'wts': 'omega'}]*2, [['a1u']]*2, [str(tmp_path / 'grid.nc')]*2,
+                                  [harmonizer.lock_dir]*2))
+    assert sorted(len(result['actions']) for result in results) == [0, 2]
+    assert all(not result['renames'] and not result['missing'] for result in results)
+    with nc.Dataset(paths[1]) as dataset:
+        assert set(dataset.variables) == {'omega', 'a1u'}
+        assert np.array_equal(dataset.variables['a1u'][:], np.arange(4))
+
+def test_check_mode_does_not_modify(tmp_path):
+    path = str(tmp_path / 'fvcom.nc')
+    write_file(path, False)
+    entries = FVCOMVariableHarmonizer(str(tmp_path / 'ledger.json'), str(tmp_path / 'grid.nc'), logging.getLogger('test'),
+                                      {'wts': 'omega'}, ['a1u'], 'check').run([path])
+    assert entries[path]['renames'] == [('wts', 'omega')]
+    assert entries[path]['missing'] == ['a1u']
+    with nc.Dataset(path) as dataset:
+        assert set(dataset.variables) == {'wts'}
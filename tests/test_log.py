@@ -0,0 +1,28 @@
+import os
+import multiprocessing
+from modules.Log import AppLogger, restart_listeners, stop_listeners
+
+logger = None       # 父进程中创建、由fork出的子进程继承的记录器
+
+def child(restart: bool):
+    if restart:
+        restart_listeners()
+    logger.info('child {} restart={}'.format(os.getpid(), restart))
+    stop_listeners()
+
+def test_inherited_logger_writes_after_fork(tmp_path):
+    global logger
+    path = tmp_path / 'run.log'
+    logger = AppLogger('test.fork', 'INFO', path)
+    context = multiprocessing.get_context('fork')
+    for restart in (True, False):
+        process = context.Process(target=child, args=(restart,))
+        process.start()
+        process.join(10)
+        assert process.exitcode == 0
+    logger.info('parent')
+    stop_listeners()
+    text = path.read_text(encoding='utf-8')
+    assert 'restart=True' in text          # 子进程中继承的记录器重新启动后台线程后照常写出
+    assert 'restart=False' not in text     # 不重新启动时写入父进程的队列,无人读取
+    assert 'parent' in text
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from modules.MeshIndex import FVCOMMeshIndex, element_neighbors, barycentric
+
+def jittered_mesh(n: int = 24, seed: int = 0):
+    """扰动的规则网格三角化,中间挖去一块(非凸区域)"""
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(120.0, 121.0, n+1), np.linspace(33.0, 34.0, n+1))
+    interior = (x > 120.0) & (x < 121.0) & (y > 33.0) & (y < 34.0)
+    x = x + interior*rng.uniform(-0.3, 0.3, x.shape)/n
+    y = y + interior*rng.uniform(-0.3, 0.3, y.shape)/n
+    node = np.arange((n+1)**2).reshape(n+1, n+1)
+    triangles = []
+    for j in range(n):
+        for i in range(n):
+            if n//3 <= i < n//2 and n//3 <= j < 2*n//3:
+                continue
+            a, b, c, d = node[j, i], node[j, i+1], node[j+1, i+1], node[j+1, i]
+            triangles += [(a, b, c), (a, c, d)]
+    return x.ravel(), y.ravel(), np.array(triangles)
+
+def brute_force(mesh: FVCOMMeshIndex, px: np.ndarray, py: np.ndarray):
+    """每个点与全部单元比较: 包含该点的单元集合"""
+    weights = barycentric(np.repeat(px, mesh.nele), np.repeat(py, mesh.nele), np.tile(mesh.tri_x, (px.size, 1)), np.tile(mesh.tri_y, (px.size, 1)))
+    return (weights.min(axis=1) >= -FVCOMMeshIndex.EPSILON).reshape(px.size, mesh.nele)
+
+@pytest.fixture(scope='module')
+def mesh():
+    return FVCOMMeshIndex(*jittered_mesh())
+
+def test_locate_matches_brute_force(mesh):
+    rng = np.random.default_rng(1)
+    px, py = rng.uniform(119.9, 121.1, 3000), rng.uniform(32.9, 34.1, 3000)
+    # 加上网格节点与边中点: 落在边上的点可属于任一相邻单元
+    px = np.concatenate([px, mesh.node_x, mesh.tri_x[:, :2].mean(axis=1)])
+    py = np.concatenate([py, mesh.node_y, mesh.tri_y[:, :2].mean(axis=1)])
+    element = mesh.locate(px, py, chunk_size=1000)
+    contains = brute_force(mesh, px, py)
+    found = element >= 0
+    np.testing.assert_array_equal(found, contains.any(axis=1))
+    assert contains[np.flatnonzero(found), element[found]].all()
+    assert (~found).sum() > 0 and found.sum() > 0
+
+def test_walk_matches_locate(mesh):
+    rng = np.random.default_rng(2)
+    start = rng.integers(0, mesh.nele, 2000)
+    centers_x, centers_y = mesh.tri_x[start].mean(axis=1), mesh.tri_y[start].mean(axis=1)
+    px, py = centers_x + rng.normal(0, 0.05, start.size), centers_y + rng.normal(0, 0.05, start.size)
+    element, weights = mesh.walk(px, py, start)
+    contains = brute_force(mesh, px, py)
+    found = element >= 0
+    np.testing.assert_array_equal(found, contains.any(axis=1))
+    assert contains[np.flatnonzero(found), element[found]].all()
+    np.testing.assert_allclose(weights[found].sum(axis=1), 1.0)
+    assert np.isnan(weights[~found]).all()
+
+def test_neighbors_and_cache(mesh, tmp_path):
+    nbe = element_neighbors(mesh.nv)
+    # 相邻关系对称,且相邻单元共用与第k个节点相对的边
+    inner = np.argwhere(nbe >= 0)
+    for element, k in inner[:500]:
+        neighbor = nbe[element, k]
+        assert element in nbe[neighbor]
+        assert set(mesh.nv[element]) - {mesh.nv[element, k]} <= set(mesh.nv[neighbor])
+    mesh.save(str(tmp_path / 'mesh.npz'))
+    loaded = FVCOMMeshIndex.load(str(tmp_path / 'mesh.npz'))
+    px, py = np.random.default_rng(3).uniform(120, 121, 500), np.random.default_rng(4).uniform(33, 34, 500)
+    np.testing.assert_array_equal(loaded.locate(px, py), mesh.locate(px, py))
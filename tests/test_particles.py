@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import modules.LagrangianTracking as tracking
+from modules.LagrangianTracking import LagrangianTracking_FVCOMOffline, cost_bounds
+from modules.ParticleTracker import read_particle_chunks
+
+def test_write_shard(tmp_path, monkeypatch):
+    # 小块大小使写出跨越多个格式化块与读取块
+    monkeypatch.setattr(tracking, 'WRITE_ROWS', 3)
+    monkeypatch.setattr(tracking, 'PARTICLE_CHUNK', 4)
+    particles = np.column_stack([[17, 3, 250, 9, 1000, 42, 8], 120 + np.arange(7)/8, 33 + np.arange(7)/16])
+    LagrangianTracking_FVCOMOffline.write_shard(str(tmp_path / 'case_000'), particles)
+    lines = (tmp_path / 'case_000.dat').read_text().splitlines()
+    assert lines[0] == '7'
+    assert lines[1] == '  1 120.000000 33.0000000 0.000'
+    assert lines[7] == '  7 120.750000 33.3750000 0.000'
+    assert len(lines) == 8
+    np.testing.assert_array_equal(np.load(tmp_path / 'case_000.ids.npy'), particles[:, 0])
+    np.testing.assert_allclose(np.loadtxt(tmp_path / 'case_000.dat', skiprows=1)[:, 1:3], particles[:, 1:])
+
+def test_read_particle_chunks(tmp_path):
+    path = tmp_path / 'particles.dat'
+    path.write_text('5\n1 120.1 33.1 0.0\n2 120.2 33.2 0.0\n3 120.3 33.3 0.0\n4 120.4 33.4 0.0\n5 120.5 33.5 0.0\n')
+    chunks = list(read_particle_chunks(str(path), 2))
+    assert [chunk.shape for chunk in chunks] == [(2, 3), (2, 3), (1, 3)]
+    np.testing.assert_array_equal(np.concatenate(chunks)[:, 0], np.arange(1, 6))
+    assert [chunk.shape[0] for chunk in read_particle_chunks(str(path), 5)] == [5]
+    (tmp_path / 'empty.dat').write_text('0\n')
+    assert list(read_particle_chunks(str(tmp_path / 'empty.dat'))) == []
+
+@pytest.mark.parametrize('seed, num_particles, num_shards', [(0, 1000, 7), (1, 50, 50), (2, 10000, 100), (3, 20, 1)])
+def test_cost_bounds(seed, num_particles, num_shards):
+    rng = np.random.default_rng(seed)
+    cost = rng.pareto(1.5, num_particles) + 0.01
+    bounds = cost_bounds(cost, num_shards)
+    assert bounds[0] == 0 and bounds[-1] == num_particles and bounds.size == num_shards + 1
+    assert np.all(np.diff(bounds) >= 1)     # 每段至少一个粒子
+    if num_shards < num_particles:
+        # 各段的计算量与平均值相差不超过最大的单个粒子计算量
+        totals = np.add.reduceat(cost, bounds[:-1])
+        assert np.all(np.abs(totals - cost.sum()/num_shards) <= cost.max() + 1e-9)
+
+def test_cost_bounds_uniform():
+    np.testing.assert_array_equal(cost_bounds(np.ones(10), 5), [0, 2, 4, 6, 8, 10])
+    np.testing.assert_array_equal(cost_bounds(np.ones(3), 0), [0])
+    # 计算量集中在开头时后面的段仍各有一个粒子
+    np.testing.assert_array_equal(cost_bounds(np.array([100.0, 1, 1, 1]), 3), [0, 1, 2, 4])
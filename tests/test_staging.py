@@ -0,0 +1,66 @@
+import logging
+import numpy as np
+import netCDF4 as nc
+from types import SimpleNamespace
+from modules.Staging import FVCOMInputStager
+
+def grid(n=4):
+    """n*n个节点的规则网格,每个方格分为两个三角形; nv从0开始"""
+    node = np.arange(n*n).reshape(n, n)
+    nv = []
+    for j in range(n-1):
+        for i in range(n-1):
+            nv.append([node[j, i], node[j, i+1], node[j+1, i+1]])
+            nv.append([node[j, i], node[j+1, i+1], node[j+1, i]])
+    x, y = np.meshgrid(np.arange(n, dtype=float), np.arange(n, dtype=float))
+    return x.ravel(), y.ravel(), np.array(nv)
+
+def neighbors(nv):
+    """nbe: 每个单元与各节点相对的边上的相邻单元(1起始,边界为0)"""
+    owner = {}
+    for element, tri in enumerate(nv):
+        for k in range(3):
+            owner.setdefault(frozenset((tri[(k+1) % 3], tri[(k+2) % 3])), []).append(element)
+    nbe = np.zeros(nv.shape, dtype=np.int32)
+    for element, tri in enumerate(nv):
+        for k in range(3):
+            others = [e for e in owner[frozenset((tri[(k+1) % 3], tri[(k+2) % 3]))] if e != element]
+            nbe[element, k] = others[0] + 1 if others else 0
+    return nbe
+
+def test_subset_file_renumbers_mesh(tmp_path):
+    x, y, nv = grid()
+    nbe = neighbors(nv)
+    num_times = 30
+    source = str(tmp_path / 'fvcom_0001.nc')
+    with nc.Dataset(source, 'w') as dst:
+        dst.createDimension('time', None)
+        dst.createDimension('node', x.size)
+        dst.createDimension('nele', nv.shape[0])
+        dst.createDimension('three', 3)
+        dst.createVariable('x', 'f4', ('node',))[:] = x
+        dst.createVariable('nv', 'i4', ('three', 'nele'))[:] = nv.T + 1
+        dst.createVariable('nbe', 'i4', ('three', 'nele'))[:] = nbe.T
+        u = dst.createVariable('u', 'f4', ('time', 'nele'))
+        u[:] = np.arange(num_times)[:, None]*100 + np.arange(nv.shape[0])
+    tracker = SimpleNamespace(configfile={'Cache': {'Directory': str(tmp_path / 'cache')}}, logger=logging.getLogger('test'),
+                              directory=str(tmp_path), inpdir='INPDIR', casename='test', load_mesh=lambda: SimpleNamespace(node_x=x, nv=nv))
+    stager = FVCOMInputStager(tracker, {})
+    # 左下两行方格: 单元0-7,用到节点0-11
+    elements = np.arange(8)
+    nodes = np.unique(nv[elements])
+    output = stager.subset_file(source, nodes, elements, ['x', 'nv', 'nbe', 'u', 'missing'], 'key')
+    with nc.Dataset(output, 'r') as src:
+        assert len(src.dimensions['node']) == nodes.size
+        assert len(src.dimensions['nele']) == elements.size
+        assert 'missing' not in src.variables
+        np.testing.assert_array_equal(src.variables['x'][:], x[nodes])
+        sub_nv = src.variables['nv'][:].T - 1
+        np.testing.assert_array_equal(nodes[sub_nv], nv[elements])
+        sub_nbe = src.variables['nbe'][:].T
+        inside = np.isin(nbe[elements] - 1, elements)
+        np.testing.assert_array_equal(sub_nbe == 0, ~inside)
+        np.testing.assert_array_equal(elements[sub_nbe[inside] - 1], nbe[elements][inside] - 1)
+        np.testing.assert_array_equal(src.variables['u'][:], np.arange(num_times)[:, None]*100 + elements)
+    # 同一文件与范围只写一次
+    assert stager.subset_file(source, nodes, elements, ['x', 'nv', 'nbe', 'u'], 'key') == output
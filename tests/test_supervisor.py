@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import pytest
+import modules.LagrangianTracking as tracking
+from modules.LagrangianTracking import LagrangianTracking_FVCOMOffline
+from modules.Telemetry import RunTelemetry
+
+def make_tracker():
+    """只带run_case/supervise所需属性的追踪器(不读取配置)"""
+    tracker = object.__new__(LagrangianTracking_FVCOMOffline)
+    tracker.logger = logging.getLogger('test.supervisor')
+    tracker.output_logger = logging.getLogger('test.supervisor.output')
+    tracker.total_progress = 0.0
+    return tracker
+
+def stub(tmp_path, name: str, body: str):
+    """写入可执行的Python替身ptraj"""
+    path = tmp_path / name
+    path.write_text('#!{}\nimport sys, time, os\n{}\n'.format(sys.executable, body))
+    path.chmod(0o755)
+    return str(path)
+
+def supervise(tmp_path, executable: str, workers: int = 1, **kwargs):
+    tasks = [{'idx': 0, 'case': 'case_000', 'cwd': str(tmp_path), 'executable': executable}]
+    tracker = make_tracker()
+    telemetry = RunTelemetry(tasks, tracker.logger, 3600.0)
+    started = time.monotonic()
+    results = asyncio.run(tracker.supervise(tasks, workers, telemetry, **kwargs))
+    return results[0], time.monotonic() - started, telemetry
+
+def test_done(tmp_path):
+    executable = stub(tmp_path, 'ok', 'for i in range(3):\n    print("{} / 3 finished (hours)".format(i+1), flush=True)')
+    result, _, telemetry = supervise(tmp_path, executable)
+    assert (result['returncode'], result['status'], result['attempts']) == (0, 'done', 1)
+    assert telemetry.progress == 100.0
+
+def test_chatty_process_stalls(tmp_path):
+    # 持续输出非进度行: 每读到一行都检查距上次进度的时间
+    executable = stub(tmp_path, 'chatty', 'while True:\n    print("iteration", flush=True)\n    time.sleep(0.01)')
+    result, elapsed, _ = supervise(tmp_path, executable, stall_timeout=1.0)
+    assert result['status'] == 'stalled'
+    assert elapsed < 5.0
+
+def test_chatty_process_times_out(tmp_path):
+    # 持续输出进度行,但超过运行时长上限
+    executable = stub(tmp_path, 'slow', 'i = 0\nwhile True:\n    i += 1\n    print("{} / 100000 finished (hours)".format(i), flush=True)\n    time.sleep(0.01)')
+    result, elapsed, _ = supervise(tmp_path, executable, wall_timeout=1.0, stall_timeout=60.0)
+    assert result['status'] == 'timeout'
+    assert elapsed < 5.0
+
+def test_silent_process_stalls(tmp_path):
+    executable = stub(tmp_path, 'silent', 'time.sleep(60)')
+    result, elapsed, _ = supervise(tmp_path, executable, stall_timeout=0.5)
+    assert result['status'] == 'stalled'
+    assert elapsed < 5.0
+
+def test_memory_sampled_under_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracking, 'SUPERVISOR_TICK', 0.1)
+    samples = []
+    monkeypatch.setattr(RunTelemetry, 'sample', lambda self, i_task: samples.append(i_task))
+    executable = stub(tmp_path, 'chatty', 'end = time.time() + 1.0\nwhile time.time() < end:\n    print("iteration", flush=True)\n    time.sleep(0.005)')
+    result, _, _ = supervise(tmp_path, executable)
+    assert result['status'] == 'done'
+    assert len(samples) >= 5
+
+def test_long_line_fails(tmp_path):
+    executable = stub(tmp_path, 'long', 'print("x"*(1 << 17), flush=True)\ntime.sleep(60)')
+    result, elapsed, _ = supervise(tmp_path, executable)
+    assert result['status'] == 'failed'
+    assert elapsed < 20.0
+
+def test_missing_executable_is_retried(tmp_path):
+    result, _, _ = supervise(tmp_path, str(tmp_path / 'missing'), retries=2, backoff=0.0)
+    assert (result['returncode'], result['status'], result['attempts']) == (None, 'failed', 3)
+
+def test_retry_after_failure(tmp_path):
+    # 第一次运行返回1,重试时成功
+    executable = stub(tmp_path, 'flaky', 'if not os.path.exists("marker"):\n    open("marker", "w").close()\n    sys.exit(1)')
+    result, _, _ = supervise(tmp_path, executable, retries=1, backoff=0.0)
+    assert (result['returncode'], result['status'], result['attempts']) == (0, 'done', 2)
+
+def test_on_result_called_once_per_task(tmp_path):
+    executable = stub(tmp_path, 'ok', 'pass')
+    tasks = [{'idx': i, 'case': 'case_{:03d}'.format(i), 'cwd': str(tmp_path), 'executable': executable} for i in range(4)]
+    tracker = make_tracker()
+    recorded = []
+    results = asyncio.run(tracker.supervise(tasks, 2, RunTelemetry(tasks, tracker.logger, 3600.0), on_result=recorded.append))
+    assert [result['case'] for result in results] == [task['case'] for task in tasks]
+    assert sorted(result['case'] for result in recorded) == [task['case'] for task in tasks]
@@ -0,0 +1,56 @@
+import os
+import json
+import logging
+from datetime import datetime
+from modules.FVCOMnetCDFReader import FVCOMTimeIndex
+
+def scan(path):
+    """替身扫描函数: 记录被扫描的文件"""
+    scan.calls.append(path)
+    return {'start_time': datetime(2025, 1, 1), 'end_time': datetime(2025, 1, 1, 23), 'total_timesteps': 24, 'time_step': 3600.0}
+
+def make_files(tmp_path, count):
+    files = []
+    for i in range(count):
+        path = tmp_path / 'fvcom_{:04d}.nc'.format(i)
+        path.write_bytes(b'x'*(i+1))
+        files.append(str(path))
+    return files
+
+def test_only_new_or_changed_files_are_scanned(tmp_path):
+    logger = logging.getLogger('test')
+    index_file = str(tmp_path / 'time_index.json')
+    files = make_files(tmp_path, 3)
+    scan.calls = []
+    assert FVCOMTimeIndex(index_file, logger).update(files, scan) == 3
+    # 重新读取索引: 未变化的文件不扫描
+    index = FVCOMTimeIndex(index_file, logger)
+    assert index.update(files, scan) == 0
+    # 修改时间或大小变化的文件、新增的文件重新扫描,删除的文件移出索引
+    stat = os.stat(files[0])
+    os.utime(files[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    with open(files[1], 'ab') as fout:
+        fout.write(b'y')
+    files += make_files(tmp_path, 4)[3:]
+    os.remove(files[2])
+    del files[2]
+    scan.calls = []
+    assert index.update(files, scan) == 3
+    assert sorted(scan.calls) == sorted([files[0], files[1], files[2]])
+    assert [entry['path'] for entry in FVCOMTimeIndex(index_file, logger).sorted_entries()] == sorted(files)
+
+def test_corrupt_or_old_index_is_rebuilt(tmp_path):
+    logger = logging.getLogger('test')
+    index_file = str(tmp_path / 'time_index.json')
+    files = make_files(tmp_path, 2)
+    scan.calls = []
+    FVCOMTimeIndex(index_file, logger).update(files, scan)
+    with open(index_file, 'r') as fin:
+        data = json.load(fin)
+    data['version'] = FVCOMTimeIndex.VERSION + 1
+    with open(index_file, 'w') as fout:
+        json.dump(data, fout)
+    assert FVCOMTimeIndex(index_file, logger).update(files, scan) == 2
+    with open(index_file, 'w') as fout:
+        fout.write('{"version": 1, "files": [')
+    assert FVCOMTimeIndex(index_file, logger).update(files, scan) == 2
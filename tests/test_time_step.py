@@ -0,0 +1,39 @@
+import logging
+import contextlib
+import pytest
+import modules.TimeStep as time_step
+from modules.TimeStep import CFLTimeStepSelector
+
+@pytest.mark.parametrize('instp, limit, expected', [
+    (3600, 5000, 3600.0),   # 上限超过INSTP: 取INSTP
+    (3600, 50, 50.0),       # 3600的因数中不超过50的最大值
+    (3600, 47, 45.0),
+    (3600, 7, 6.0),
+    (3600, 0.3, 3600/12000),    # 不足1秒: 取 INSTP/n
+    (100.5, 30, 100.5/4),       # 非整数INSTP: 取 INSTP/n
+])
+def test_largest_divisor(instp, limit, expected):
+    dti = CFLTimeStepSelector.largest_divisor(instp, limit)
+    assert dti == pytest.approx(expected)
+    assert dti <= limit or dti == instp
+    assert (instp/dti) == pytest.approx(round(instp/dti))
+
+class Dataset:
+    def index_to_time(self, index):
+        return index
+
+class NetCDFData:
+    @contextlib.contextmanager
+    def open_multifile_dataset(self):
+        yield Dataset()
+
+class Tracker:
+    instp = 3600
+    logger = logging.getLogger('test')
+    netcdf_data = NetCDFData()
+
+@pytest.mark.parametrize('rate, expected', [(0.01, 50.0), (0.0, 3600.0), (1.0, 0.5)])
+def test_select(monkeypatch, rate, expected):
+    monkeypatch.setattr(time_step, 'tracking_window', lambda tracker, dataset: (0, 10))
+    monkeypatch.setattr(CFLTimeStepSelector, 'cached_rate', lambda self, dataset, first, last: {'rate': rate, 'index': 5, 'element': 0})
+    assert CFLTimeStepSelector(Tracker(), {'Courant': 0.5, 'Divisor': 20}).select() == pytest.approx(expected)
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import netCDF4 as nc
+import pytest
+from modules.TrajectoryIndex import TrajectoryIndex
+
+NUM_TIMES, NUM_PARTICLES = 30, 5000
+
+@pytest.fixture(scope='module')
+def trajectory(tmp_path_factory):
+    """随机游走的合成合并轨迹文件(time, particle),部分粒子中途失效"""
+    path = str(tmp_path_factory.mktemp('trajectory') / 'merged.nc')
+    rng = np.random.default_rng(0)
+    x = 120.0 + np.cumsum(rng.normal(0, 0.01, (NUM_TIMES, NUM_PARTICLES)), axis=0) + rng.uniform(0, 1, NUM_PARTICLES)
+    y = 33.0 + np.cumsum(rng.normal(0, 0.01, (NUM_TIMES, NUM_PARTICLES)), axis=0) + rng.uniform(0, 1, NUM_PARTICLES)
+    active = np.ones((NUM_TIMES, NUM_PARTICLES), dtype=np.int8)
+    active[20:, ::7] = 0
+    x[25:, ::11] = 9.9e36
+    with nc.Dataset(path, 'w') as dst:
+        dst.createDimension('time', None)
+        dst.createDimension('particle', NUM_PARTICLES)
+        time = dst.createVariable('time', 'f8', ('time',))
+        time.units = 'hours since 2025-01-01 00:00:00'
+        time[:] = np.arange(NUM_TIMES)
+        dst.createVariable('particle_id', 'i4', ('particle',))[:] = rng.permutation(NUM_PARTICLES) + 1
+        dst.createVariable('x', 'f4', ('time', 'particle'), chunksizes=(8, 1000))[:] = x
+        dst.createVariable('y', 'f4', ('time', 'particle'), chunksizes=(8, 1000))[:] = y
+        dst.createVariable('active', 'i1', ('time', 'particle'))[:] = active
+    with nc.Dataset(path) as src:
+        src.set_auto_mask(False)
+        x, y = np.asarray(src['x'][:], dtype=np.float64), np.asarray(src['y'][:], dtype=np.float64)
+        particle_id = src['particle_id'][:]
+    valid = (np.abs(x) < 1e30) & (active > 0)
+    return path, np.where(valid, x, np.nan), np.where(valid, y, np.nan), particle_id
+
+@pytest.fixture(scope='module', params=[False, True], ids=['source', 'copy'])
+def index(request, trajectory, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('index') / 'index')
+    index = TrajectoryIndex.build(trajectory[0], directory, [120.0, 33.0, 121.0, 34.0], 0.1, time_chunk=8, particle_chunk=1200,
+                                  positions=request.param)
+    yield index
+    index.close()
+
+def test_position_copy_is_optional(index):
+    assert os.path.exists(os.path.join(index.directory, 'position.npy')) == index.meta['positions']
+
+@pytest.mark.parametrize('box, start, end', [([120.3, 33.3, 120.5, 33.6], 0, None), ([120.0, 33.0, 121.0, 34.0], 5, 21),
+                                             ([119.0, 32.0, 120.2, 33.1], 22, 10), ([120.61, 33.72, 120.62, 33.73], 3, 3)])
+def test_in_box_matches_brute_force(index, trajectory, box, start, end):
+    _, x, y, particle_id = trajectory
+    first, last = sorted((start, NUM_TIMES-1 if end is None else end))
+    steps = slice(first, last+1)
+    inside = (x[steps] >= box[0]) & (x[steps] <= box[2]) & (y[steps] >= box[1]) & (y[steps] <= box[3])
+    columns = np.flatnonzero(inside.any(axis=0))
+    expected = dict(zip(particle_id[columns], first + np.argmax(inside[:, columns], axis=0)))
+    result = index.in_box(box, start, end)
+    assert dict(zip(result['particle_id'], result['first_step'])) == expected
+    assert len(result['particle_id']) == len(expected)
+
+def test_positions_and_trajectories(index, trajectory):
+    _, x, y, particle_id = trajectory
+    ids = np.array([particle_id[4999], particle_id[0], particle_id[77], particle_id[0], NUM_PARTICLES + 10])
+    result = index.positions(ids, '2025-01-01 21:00:00')
+    np.testing.assert_array_equal(result['x'][:4], x[21, [4999, 0, 77, 0]])
+    np.testing.assert_array_equal(result['y'][:4], y[21, [4999, 0, 77, 0]])
+    assert np.isnan(result['x'][4])
+    result = index.trajectories(ids[:4], 26, 2)
+    np.testing.assert_array_equal(result['steps'], np.arange(2, 27))
+    np.testing.assert_array_equal(result['x'], x[2:27][:, [4999, 0, 77, 0]])
+
+def test_changed_source_requires_rebuild(index, trajectory):
+    if index.meta['positions']:
+        return
+    os.utime(trajectory[0], ns=(0, 0))
+    try:
+        with pytest.raises(ValueError):
+            TrajectoryIndex(index.directory)
+    finally:
+        stat = os.stat(trajectory[0])
+        os.utime(trajectory[0], ns=(stat.st_atime_ns, index.meta['mtime']))
@@ -0,0 +1,45 @@
+import logging
+import numpy as np
+import netCDF4 as nc
+import pytest
+from modules.TrajectoryOutput import TrajectoryMerger
+
+def write_shard(path, num_particles, num_times=4, extra=None):
+    """ptraj格式的子算例输出: time(无限长) x nlag"""
+    with nc.Dataset(path, 'w') as dst:
+        dst.createDimension('time', None)
+        dst.createDimension('nlag', num_particles)
+        if extra:
+            dst.createDimension(extra, num_particles)
+        dst.createVariable('time', 'f4', ('time',))[:] = np.arange(num_times)
+        dst.createVariable('x', 'f4', ('time', 'nlag'))[:] = np.arange(num_times*num_particles).reshape(num_times, num_particles)
+
+def test_particle_dimension_by_name(tmp_path):
+    path = str(tmp_path / 'shard.nc')
+    write_shard(path, 3, extra='three')
+    with nc.Dataset(path) as src:
+        assert TrajectoryMerger.particle_dimension(src, 3) == ('nlag', 'time')
+        with pytest.raises(ValueError):
+            TrajectoryMerger.particle_dimension(src, 3, '')       # nlag与three长度相同,无法按长度识别
+        with pytest.raises(ValueError):
+            TrajectoryMerger.particle_dimension(src, 5)
+        with pytest.raises(ValueError):
+            TrajectoryMerger.particle_dimension(src, 3, 'particle')
+
+def test_particle_dimension_by_length(tmp_path):
+    path = str(tmp_path / 'shard.nc')
+    write_shard(path, 4)        # 粒子数与时次数相同时不会取时间维度
+    with nc.Dataset(path) as src:
+        assert TrajectoryMerger.particle_dimension(src, 4, '') == ('nlag', 'time')
+
+def test_merge(tmp_path):
+    shards = []
+    for i, count in enumerate((3, 5)):
+        path = str(tmp_path / 'case_{}.nc'.format(i))
+        write_shard(path, count)
+        shards.append((path, np.arange(count) + 10*i))
+    output_file = TrajectoryMerger(logging.getLogger('test')).merge(shards, str(tmp_path / 'merged.nc'))
+    with nc.Dataset(output_file) as merged:
+        assert merged.variables['x'].dimensions == ('time', 'particle')
+        np.testing.assert_array_equal(merged.variables['particle_id'][:], [0, 1, 2, 10, 11, 12, 13, 14])
+        np.testing.assert_array_equal(merged.variables['x'][1], [3, 4, 5, 5, 6, 7, 8, 9])